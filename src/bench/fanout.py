@@ -0,0 +1,65 @@
+"""
+Fan-out benchmark
+Measures advertise_version() latency for a resource with a fixed number of
+subscribers while the number of unrelated subscriptions on the server grows.
+
+Usage: python fanout.py [subscribers-of-resource]
+"""
+
+import os
+import sys
+import time
+import json
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "server"))
+
+from flask import Flask
+from braid import Braid
+from core import Patch, Subscription, Version
+
+UNRELATED = [1000, 10000, 100000]
+ROUNDS = 200
+
+
+class FakeRequest:
+    def __init__(self, path):
+        self.path = path
+
+
+def populate(braid, resource: str, count: int, start: int = 0):
+    for i in range(start, start + count):
+        subscription = Subscription(FakeRequest(resource), i, lambda: None)
+        braid.subscriptions.add(subscription)
+
+
+def drain(braid, resource: str):
+    for subscription in braid.subscriptions.for_resource(resource):
+        subscription.send_queue.clear()
+
+
+def run(subscribers: int):
+    braid = Braid(Flask(__name__))
+    version = Version(
+        version="1",
+        patches=[Patch(json.dumps({"type": "title", "value": "x"}), None, ("json", ".title"))],
+    )
+    populate(braid, "/post/1", subscribers)
+    populated = 0
+    print(f"{'unrelated':>10} {'mean us':>10} {'p99 us':>10}")
+    for unrelated in UNRELATED:
+        populate(braid, "/other", unrelated - populated, start=subscribers + populated)
+        populated = unrelated
+        samples = []
+        for _ in range(ROUNDS):
+            start = time.perf_counter()
+            braid.advertise_version(version, "/post/1")
+            samples.append(time.perf_counter() - start)
+            drain(braid, "/post/1")
+        samples.sort()
+        mean = sum(samples) / len(samples) * 1e6
+        p99 = samples[int(len(samples) * 0.99) - 1] * 1e6
+        print(f"{unrelated:>10} {mean:>10.1f} {p99:>10.1f}")
+
+
+if __name__ == "__main__":
+    run(int(sys.argv[1]) if len(sys.argv) > 1 else 10)
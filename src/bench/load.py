@@ -0,0 +1,288 @@
+"""
+Load benchmark
+Runs the server/main.py sample app locally, drives N concurrent subscribers
+and M PUT writers against one resource and reports:
+    advertise-to-receive latency percentiles
+    PUT throughput
+    server CPU time and RSS per subscriber
+    patch parse throughput
+Results are saved as JSON, and compared against a previous run with --compare.
+
+Usage: python load.py [--subscribers N] [--writers M] [--duration S]
+                      [--output results.json] [--compare baseline.json]
+"""
+
+import os
+import sys
+import json
+import time
+import socket
+import argparse
+import platform
+import tempfile
+import threading
+import subprocess
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+SERVER_DIR = os.path.join(BENCH_DIR, "..", "server")
+CLIENT_DIR = os.path.join(BENCH_DIR, "..", "client")
+sys.path.insert(0, SERVER_DIR)
+sys.path.insert(0, CLIENT_DIR)
+
+import requests
+from stream import VersionParser
+
+# starts the sample app without the debug reloader, which would fork a second process
+SERVER_BOOTSTRAP = """
+import sys
+from werkzeug.serving import WSGIRequestHandler
+import main
+WSGIRequestHandler.protocol_version = "HTTP/1.1"
+main.app.run(host="127.0.0.1", port=int(sys.argv[1]), threaded=True)
+"""
+
+PATCH = (
+    "Content-Length: {length}\r\n"
+    "Content-Range: json .latest_change\r\n"
+    "\r\n"
+    "{content}\r\n"
+)
+
+# metrics where a larger value is better, all others are better when smaller
+HIGHER_IS_BETTER = {"put_per_second", "parse_mb_per_second", "delivered_ratio"}
+
+
+def free_port() -> int:
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+def process_usage(pid: int) -> dict:
+    """
+    CPU seconds and resident memory of a process, read from /proc
+    """
+    try:
+        with open(f"/proc/{pid}/stat") as f:
+            fields = f.read().rsplit(")", 1)[1].split()
+        ticks = os.sysconf("SC_CLK_TCK")
+        cpu = (int(fields[11]) + int(fields[12])) / ticks
+        with open(f"/proc/{pid}/status") as f:
+            rss = next(int(line.split()[1]) * 1024 for line in f if line.startswith("VmRSS:"))
+        return {"cpu_seconds": cpu, "rss_bytes": rss}
+    except (OSError, StopIteration):
+        return {"cpu_seconds": None, "rss_bytes": None}
+
+
+def percentile(samples: list, p: float):
+    if not samples:
+        return None
+    samples = sorted(samples)
+    return samples[min(len(samples) - 1, int(len(samples) * p / 100))]
+
+
+class Run(object):
+    def __init__(self, args):
+        self.args = args
+        self.port = free_port()
+        self.url = f"http://127.0.0.1:{self.port}/post/1"
+        # version id -> time the PUT was sent
+        self.sent = {}
+        self.latencies = []
+        self.received = 0
+        self.lock = threading.Lock()
+        self.stop = threading.Event()
+
+    def start_server(self, store_path: str):
+        self.server = subprocess.Popen(
+            [sys.executable, "-c", SERVER_BOOTSTRAP, str(self.port)],
+            cwd=SERVER_DIR,
+            # the sample app fsyncs its store, keep it out of the source tree
+            env=dict(os.environ, BRAID_STORE_PATH=store_path),
+            stdout=subprocess.DEVNULL,
+            stderr=subprocess.DEVNULL,
+        )
+        deadline = time.time() + 10
+        while time.time() < deadline:
+            try:
+                requests.get(f"http://127.0.0.1:{self.port}/heartbeat", timeout=1)
+                return
+            except requests.ConnectionError:
+                time.sleep(0.1)
+        raise RuntimeError("Sample server did not start")
+
+    def subscriber(self, i: int, ready: threading.Barrier):
+        headers = {"Subscribe": "keep-alive", "Peer": f"subscriber-{i}"}
+        with requests.get(self.url, headers=headers, stream=True) as r:
+            ready.wait()
+            parser = VersionParser()
+            for chunk in r.iter_content(chunk_size=None):
+                if self.stop.is_set():
+                    return
+                versions = parser.feed(chunk)
+                now = time.perf_counter()
+                with self.lock:
+                    for version in versions:
+                        sent = self.sent.get(version.version)
+                        if sent is not None:
+                            self.latencies.append(now - sent)
+                            self.received += 1
+
+    def writer(self, w: int, counts: list):
+        session = requests.Session()
+        content = json.dumps({"type": "title", "value": "x" * self.args.patch_size})
+        body = PATCH.format(length=len(content), content=content).encode()
+        n = 0
+        while not self.stop.is_set():
+            version = f"w{w}-{n}"
+            headers = {
+                "Version": version,
+                "Parents": f"w{w}-{n - 1}" if n else "1",
+                "Patches": "1",
+                "Content-Type": "application/json",
+            }
+            with self.lock:
+                self.sent[version] = time.perf_counter()
+            session.put(self.url, data=body, headers=headers)
+            n += 1
+            counts[w] = n
+            if self.args.rate:
+                time.sleep(1 / self.args.rate)
+
+    def run(self) -> dict:
+        args = self.args
+        store = tempfile.TemporaryDirectory(prefix="braid-load-")
+        self.start_server(store.name)
+        try:
+            idle = process_usage(self.server.pid)
+            ready = threading.Barrier(args.subscribers + 1)
+            for i in range(args.subscribers):
+                threading.Thread(target=self.subscriber, args=(i, ready), daemon=True).start()
+            ready.wait(timeout=60)
+            time.sleep(0.5)
+            subscribed = process_usage(self.server.pid)
+            counts = [0] * args.writers
+            writers = [
+                threading.Thread(target=self.writer, args=(w, counts), daemon=True)
+                for w in range(args.writers)
+            ]
+            start = time.perf_counter()
+            for thread in writers:
+                thread.start()
+            time.sleep(args.duration)
+            self.stop.set()
+            for thread in writers:
+                thread.join()
+            elapsed = time.perf_counter() - start
+            # let in-flight versions arrive
+            time.sleep(0.5)
+            loaded = process_usage(self.server.pid)
+        finally:
+            self.server.terminate()
+            self.server.wait()
+            store.cleanup()
+        puts = sum(counts)
+        rss_per_subscriber = None
+        if args.subscribers and idle["rss_bytes"] is not None:
+            rss_per_subscriber = (
+                subscribed["rss_bytes"] - idle["rss_bytes"]
+            ) / args.subscribers
+        cpu_per_put = None
+        if puts and loaded["cpu_seconds"] is not None:
+            cpu_per_put = (loaded["cpu_seconds"] - subscribed["cpu_seconds"]) * 1000 / puts
+        return {
+            "put_per_second": puts / elapsed,
+            "latency_p50_ms": ms(percentile(self.latencies, 50)),
+            "latency_p90_ms": ms(percentile(self.latencies, 90)),
+            "latency_p99_ms": ms(percentile(self.latencies, 99)),
+            "latency_max_ms": ms(max(self.latencies, default=None)),
+            "delivered_ratio": self.received / (puts * args.subscribers) if puts else None,
+            "server_rss_bytes_per_subscriber": rss_per_subscriber,
+            "server_cpu_ms_per_put": cpu_per_put,
+        }
+
+
+def ms(seconds):
+    return None if seconds is None else seconds * 1000
+
+
+def parse_throughput(size: int = 8 * 1024 * 1024) -> float:
+    """
+    Patch parser throughput in MB/s over a multi-patch body of the given size
+    """
+    import io
+    from core import Patch
+
+    content = json.dumps({"type": "title", "value": "x" * 100})
+    patch = PATCH.format(length=len(content), content=content).encode()
+    body = patch * (size // len(patch))
+    start = time.perf_counter()
+    for _ in Patch.iter_from_stream(io.BytesIO(body), len(body)):
+        pass
+    return len(body) / (time.perf_counter() - start) / 1e6
+
+
+def compare(results: dict, baseline: dict, threshold: float) -> bool:
+    """
+    Print the change of every metric, returns False if any regressed past threshold
+    """
+    ok = True
+    for name, value in results["metrics"].items():
+        before = baseline.get("metrics", {}).get(name)
+        if value is None or not before:
+            continue
+        change = (value - before) / before
+        worse = -change if name in HIGHER_IS_BETTER else change
+        flag = ""
+        if worse > threshold:
+            flag = "  REGRESSION"
+            ok = False
+        print(f"{name:>34} {before:>12.3f} -> {value:>12.3f} ({change:+.1%}){flag}")
+    return ok
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument("--subscribers", type=int, default=50)
+    parser.add_argument("--writers", type=int, default=2)
+    parser.add_argument("--duration", type=float, default=10)
+    parser.add_argument("--rate", type=float, default=0, help="PUTs per second per writer, 0 for unthrottled")
+    parser.add_argument("--patch-size", type=int, default=64)
+    parser.add_argument("--output", default=None)
+    parser.add_argument("--compare", default=None)
+    parser.add_argument("--threshold", type=float, default=0.1, help="relative change counted as a regression")
+    args = parser.parse_args()
+
+    metrics = Run(args).run()
+    metrics["parse_mb_per_second"] = parse_throughput()
+    results = {
+        "params": {
+            "subscribers": args.subscribers,
+            "writers": args.writers,
+            "duration": args.duration,
+            "rate": args.rate,
+            "patch_size": args.patch_size,
+        },
+        "environment": {
+            "python": platform.python_version(),
+            "machine": platform.machine(),
+            "cpus": os.cpu_count(),
+        },
+        "time": time.strftime("%Y-%m-%dT%H:%M:%S"),
+        "metrics": metrics,
+    }
+    print(json.dumps(results, indent=2))
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(results, f, indent=2)
+    if args.compare:
+        with open(args.compare) as f:
+            baseline = json.load(f)
+        if baseline.get("params") != results["params"]:
+            print("warning: baseline was run with different parameters", file=sys.stderr)
+        if not compare(results, baseline, args.threshold):
+            sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
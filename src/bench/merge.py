@@ -0,0 +1,106 @@
+"""
+Merge benchmark
+Replays synthetic typing traces through the text merge type: mostly
+sequential keystrokes near a cursor, some backspaces and cursor jumps,
+one version per keystroke.
+
+Usage: python merge.py [keystrokes]
+"""
+
+import os
+import sys
+import time
+import random
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "server"))
+
+from core import Patch, Version
+from merge import TextDocument
+
+
+def typing_trace(keystrokes: int, seed: int = 1):
+    """
+    Yields (start, end, text) edits of a single typist
+    """
+    rng = random.Random(seed)
+    length = cursor = 0
+    for _ in range(keystrokes):
+        roll = rng.random()
+        if roll < 0.02:
+            cursor = rng.randint(0, length)
+        if roll < 0.12 and cursor > 0:
+            # backspace
+            yield cursor - 1, cursor, ""
+            cursor -= 1
+            length -= 1
+        else:
+            yield cursor, cursor, rng.choice("abcdefghijklmnopqrstuvwxyz      \n")
+            cursor += 1
+            length += 1
+
+
+def sequential(keystrokes: int):
+    document = TextDocument()
+    parents = []
+    start = time.perf_counter()
+    for i, (begin, end, text) in enumerate(typing_trace(keystrokes)):
+        version = f"a-{i}"
+        document.apply(
+            Version(
+                version,
+                parents=parents,
+                merge_type="text",
+                patches=[Patch(text, None, ("text", f"[{begin}:{end}]"))],
+            )
+        )
+        parents = [version]
+    return time.perf_counter() - start, document
+
+
+def concurrent(keystrokes: int, lag: int = 8):
+    """
+    Two typists on one server, each sees the other's versions lag keystrokes late
+    """
+    server = TextDocument()
+    replicas = [TextDocument(), TextDocument()]
+    traces = [typing_trace(keystrokes // 2, seed) for seed in (1, 2)]
+    outboxes = [[], []]
+    elapsed = 0.0
+    for step in range(keystrokes // 2):
+        for typist, replica in enumerate(replicas):
+            begin, end, text = next(traces[typist])
+            length = len(replica)
+            begin, end = min(begin, length), min(end, length)
+            version = Version(
+                f"{typist}-{step}",
+                parents=sorted(replica.heads),
+                merge_type="text",
+                patches=[Patch(text, None, ("text", f"[{begin}:{end}]"))],
+            )
+            replica.apply(version)
+            outboxes[typist].append(version)
+        if step % lag == lag - 1:
+            for typist, outbox in enumerate(outboxes):
+                start = time.perf_counter()
+                for version in outbox:
+                    server.apply(version)
+                elapsed += time.perf_counter() - start
+                for version in outbox:
+                    replicas[1 - typist].apply(version)
+                outbox.clear()
+    return elapsed, server
+
+
+def spans(document: TextDocument) -> int:
+    return sum(len(chunk) for chunk in document.chunks)
+
+
+if __name__ == "__main__":
+    keystrokes = int(sys.argv[1]) if len(sys.argv) > 1 else 100000
+    print(f"{'trace':>12} {'keystrokes':>10} {'ops/s':>10} {'us/op':>8} {'chars':>8} {'spans':>8}")
+    for name, run in (("sequential", sequential), ("concurrent", concurrent)):
+        elapsed, document = run(keystrokes)
+        print(
+            f"{name:>12} {keystrokes:>10} {keystrokes / elapsed:>10.0f} "
+            f"{elapsed / keystrokes * 1e6:>8.1f} {len(document):>8} {spans(document):>8}"
+        )
@@ -0,0 +1,369 @@
+"""
+BraidiPy asyncio Client
+Follows any number of resources from one event loop. Requests and subscriptions
+share a pool of keep-alive HTTP/1.1 connections instead of a thread each.
+"""
+
+import asyncio
+from stream import VersionParser
+
+# methods resent on a new connection when a reused one turns out to be closed,
+# a PUT may have been applied already
+RETRY_METHODS = ("GET", "HEAD", "OPTIONS")
+
+
+class StaleConnection(ConnectionError):
+    """
+    The connection failed before any byte of the response arrived
+    """
+
+
+class Response:
+    """
+    Response read off a pooled connection
+    The body is read lazily, either whole with read() or as it arrives with
+    iter_chunks(). The connection goes back to the pool once the body is consumed.
+    """
+
+    def __init__(self, connection, status: int, headers: dict, method: str):
+        self.connection = connection
+        self.status = status
+        self.headers = headers
+        self.method = method
+        self.done = False
+        if method == "HEAD" or status in (204, 304) or 100 <= status < 200:
+            self._finish()
+
+    def __repr__(self):
+        return f"<Response [{self.status}]>"
+
+    @property
+    def ok(self) -> bool:
+        return 200 <= self.status < 300
+
+    async def read(self) -> bytes:
+        return b"".join([chunk async for chunk in self.iter_chunks()])
+
+    async def iter_chunks(self, chunk_size: int = 65536):
+        """
+        Yield the body as it arrives, decoding chunked transfer encoding
+        """
+        if self.done:
+            return
+        reader = self.connection.reader
+        try:
+            if "chunked" in self.headers.get("transfer-encoding", "").lower():
+                while True:
+                    size = int((await reader.readline()).split(b";", 1)[0], 16)
+                    if size == 0:
+                        # trailers end with a blank line
+                        while (await reader.readline()) not in (b"\r\n", b"\n", b""):
+                            pass
+                        break
+                    yield await reader.readexactly(size)
+                    await reader.readline()
+            elif "content-length" in self.headers:
+                remaining = int(self.headers["content-length"])
+                while remaining:
+                    chunk = await reader.read(min(remaining, chunk_size))
+                    if not chunk:
+                        raise ConnectionError("Connection closed before the end of the body")
+                    remaining -= len(chunk)
+                    yield chunk
+            else:
+                # body delimited by the end of the connection
+                self.connection.keep_alive = False
+                while True:
+                    chunk = await reader.read(chunk_size)
+                    if not chunk:
+                        break
+                    yield chunk
+        except BaseException:
+            self.close()
+            raise
+        self._finish()
+
+    def _finish(self):
+        if not self.done:
+            self.done = True
+            self.connection.release()
+
+    def close(self):
+        """
+        Abandon the rest of the body, the connection can not be reused
+        """
+        if not self.done:
+            self.done = True
+            self.connection.keep_alive = False
+            self.connection.release()
+
+
+class Connection:
+    def __init__(self, pool, reader, writer):
+        self.pool = pool
+        self.reader = reader
+        self.writer = writer
+        self.keep_alive = True
+        # taken from the idle connections of the pool
+        self.reused = False
+
+    async def request(self, method: str, path: str, headers: dict, body: bytes) -> Response:
+        lines = [f"{method} {path} HTTP/1.1", f"Host: {self.pool.host}:{self.pool.port}"]
+        lines += [f"{name}: {value}" for name, value in headers.items()]
+        if body or method in ("POST", "PUT", "PATCH"):
+            lines.append(f"Content-Length: {len(body)}")
+        try:
+            self.writer.write(("\r\n".join(lines) + "\r\n\r\n").encode("latin-1") + body)
+            await self.writer.drain()
+            status_line = await self.reader.readline()
+        except ConnectionError as e:
+            raise StaleConnection(f"Connection failed before the response: {e}")
+        if not status_line:
+            raise StaleConnection("Connection closed by server")
+        version, status = status_line.decode("latin-1").split(None, 2)[:2]
+        response_headers = {}
+        while True:
+            line = await self.reader.readline()
+            if line in (b"\r\n", b"\n", b""):
+                break
+            name, _, value = line.decode("latin-1").partition(":")
+            response_headers[name.strip().lower()] = value.strip()
+        connection = response_headers.get("connection", "").lower()
+        if connection == "close" or (version == "HTTP/1.0" and connection != "keep-alive"):
+            self.keep_alive = False
+        return Response(self, int(status), response_headers, method)
+
+    def release(self):
+        self.pool.release(self)
+
+    def close(self):
+        self.keep_alive = False
+        self.writer.close()
+
+
+class ConnectionPool:
+    """
+    Keep-alive connections to one host
+    Connections are handed to one request at a time and returned when its
+    response has been read. If max_connections is set, callers wait for a free
+    connection beyond that many, subscriptions included.
+    """
+
+    def __init__(self, host: str, port: int, max_connections: int = None):
+        self.host = host
+        self.port = port
+        self.idle = []
+        self.slots = asyncio.Semaphore(max_connections) if max_connections else None
+
+    async def acquire(self) -> Connection:
+        if self.slots is not None:
+            await self.slots.acquire()
+        while self.idle:
+            connection = self.idle.pop()
+            if not connection.reader.at_eof() and not connection.writer.is_closing():
+                connection.reused = True
+                return connection
+            connection.close()
+        try:
+            reader, writer = await asyncio.open_connection(self.host, self.port)
+        except BaseException:
+            if self.slots is not None:
+                self.slots.release()
+            raise
+        return Connection(self, reader, writer)
+
+    def release(self, connection: Connection):
+        if connection.keep_alive:
+            self.idle.append(connection)
+        else:
+            connection.close()
+        if self.slots is not None:
+            self.slots.release()
+
+    def close(self):
+        for connection in self.idle:
+            connection.close()
+        self.idle.clear()
+
+
+class AsyncSubscription:
+    """
+    Async iterator over the Versions of a subscribed resource, or of many
+    resources for a multiplexed stream
+    """
+
+    def __init__(self, client, path: str, headers: dict):
+        self.client = client
+        self.path = path
+        self.headers = headers
+        self.response = None
+        self.active = True
+
+    def __repr__(self):
+        return f"<AsyncSubscription {self.path}>"
+
+    def __aiter__(self):
+        return self._versions()
+
+    async def _versions(self):
+        parser = VersionParser()
+        try:
+            self.response = await self.client.request("GET", self.path, self.headers)
+            if not self.response.ok:
+                raise ValueError(f"Subscription request for resource {self.path} failed with status code {self.response.status}")
+            async for chunk in self.response.iter_chunks():
+                for version in parser.feed(chunk):
+                    yield version
+                if not self.active:
+                    break
+        except (ConnectionError, ValueError, asyncio.IncompleteReadError):
+            # reading a response closed by close() fails, that is expected
+            if self.active:
+                raise
+        finally:
+            self.close()
+
+    @property
+    def multiplex_id(self) -> str:
+        """
+        ID of a multiplexed stream, None until its response started
+        """
+        if self.response is None:
+            return None
+        return self.response.headers.get("multiplex-id")
+
+    async def add(self, resources: list) -> tuple:
+        """
+        Add resources to a running multiplexed stream
+        """
+        return await self._change_resources("POST", resources)
+
+    async def remove(self, resources: list) -> tuple:
+        """
+        Remove resources from a running multiplexed stream
+        """
+        return await self._change_resources("DELETE", resources)
+
+    async def _change_resources(self, method: str, resources: list) -> tuple:
+        if self.multiplex_id is None:
+            raise ValueError(f"No multiplexed stream is running at {self.path}")
+        headers = {"Multiplex-Id": self.multiplex_id, "Resources": ", ".join(resources)}
+        return await self.client.fetch(method, self.path, headers)
+
+    def close(self):
+        self.active = False
+        self.client.subscriptions.discard(self)
+        if self.response is not None:
+            self.response.close()
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *args):
+        self.close()
+
+
+class AsyncBraidClient:
+    """
+    asyncio Braid client
+    Usage:
+        async with AsyncBraidClient("localhost", 8080) as client:
+            async for version in client.subscribe("/post/1"):
+                ...
+    """
+
+    def __init__(self, host: str = "localhost", port: int = 8080, max_connections: int = None):
+        self.host = host
+        self.port = port
+        self.pool = ConnectionPool(host, port, max_connections)
+        self.subscriptions = set()
+
+    def __repr__(self):
+        return f"<AsyncBraidClient({self.host}, {self.port})>"
+
+    async def request(self, method: str, path: str, headers: dict = None, body: bytes = b"") -> Response:
+        """
+        Send a request over a pooled connection
+        Returns:
+            Response whose body has not been read yet
+        """
+        path = path if path[0] == "/" else f"/{path}"
+        if isinstance(body, str):
+            body = body.encode("utf-8")
+        connection = await self.pool.acquire()
+        while True:
+            try:
+                return await connection.request(method, path, headers or {}, body)
+            except StaleConnection:
+                connection.close()
+                connection.release()
+                if not connection.reused or method not in RETRY_METHODS:
+                    raise
+                # the server closed the idle keep-alive connection, retry on another one
+                connection = await self.pool.acquire()
+            except BaseException:
+                connection.close()
+                connection.release()
+                raise
+
+    async def fetch(self, method: str, path: str, headers: dict = None, body: bytes = b"") -> tuple:
+        """
+        Send a request and read its whole body
+        Returns:
+            (status, headers, body)
+        """
+        response = await self.request(method, path, headers, body)
+        return response.status, response.headers, await response.read()
+
+    async def get(self, path: str, headers: dict = None) -> tuple:
+        return await self.fetch("GET", path, headers)
+
+    async def put(self, path: str, headers: dict = None, body: bytes = b"") -> tuple:
+        return await self.fetch("PUT", path, headers, body)
+
+    async def put_version(self, path: str, version, headers: dict = None) -> tuple:
+        """
+        PUT a version and its patches, concurrent calls use separate pooled connections
+        """
+        request_headers = version.request_headers()
+        request_headers.update(headers or {})
+        return await self.fetch("PUT", path, request_headers, version.request_body())
+
+    async def options(self, path: str, headers: dict = None) -> tuple:
+        return await self.fetch("OPTIONS", path, headers)
+
+    def subscribe(self, path: str, headers: dict = None) -> AsyncSubscription:
+        """
+        Subscribe to a resource
+        The request is sent once iteration starts.
+        Returns:
+            AsyncSubscription, an async iterator of Version
+        """
+        headers = dict(headers or {})
+        headers.setdefault("Subscribe", "keep-alive")
+        subscription = AsyncSubscription(self, path if path[0] == "/" else f"/{path}", headers)
+        self.subscriptions.add(subscription)
+        return subscription
+
+    def multiplex(self, resources: list, route: str = "/multiplex", headers: dict = None) -> AsyncSubscription:
+        """
+        Subscribe to many resources over a single stream
+        Each Version's resource tells which resource it belongs to, and
+        resources can be added and removed while the stream runs.
+        Returns:
+            AsyncSubscription, an async iterator of Version
+        """
+        headers = dict(headers or {})
+        headers["Resources"] = ", ".join(resources)
+        return self.subscribe(route, headers)
+
+    def close(self):
+        for subscription in list(self.subscriptions):
+            subscription.close()
+        self.pool.close()
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *args):
+        self.close()
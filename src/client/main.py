@@ -5,6 +5,9 @@ BraidiPy Client Library
 import requests
 import json
 import threading
+from stream import Version, VersionParser
+from publisher import Publisher
+from replica import Replica
 
 
 class BraidClient:
@@ -13,6 +16,10 @@ class BraidClient:
         self.host = host
         self.port = port
         self.config = config or {}
+        # keep-alive connections shared by every non-subscribe request
+        self.session = requests.Session()
+        # path -> Replica
+        self.replicas = {}
         self._init_rest_methods()
 
     def __str__(self):
@@ -41,6 +48,7 @@ class BraidClient:
             headers = {}
         if config is None:
             config = {}
+        path = path if path[0] == "/" else f"/{path}"
         url = f"http://{self.host}:{self.port}{path}"
         print(f"{method} {url}")
         if headers.get("subscribe") or headers.get("Subscribe"):
@@ -57,30 +65,154 @@ class BraidClient:
                 ).start()
             else:
                 self._subscription_stream(path, headers, config)
+            return
+        if isinstance(data, dict):
+            data = json.dumps(data)
+        return self.session.request(method, url, headers=headers, data=data)
 
-    def _subscription_stream(self, path: str, headers: dict, config: dict):
-        print(f"Subscribing to {path}")
-        buffer = ""
+    def put_version(self, path: str, version: Version, headers: dict = None):
+        """
+        PUT a version and its patches to a resource
+        Returns:
+            requests.Response
+        """
+        path = path if path[0] == "/" else f"/{path}"
+        request_headers = version.request_headers()
+        request_headers.update(headers or {})
+        return self.session.put(
+            f"http://{self.host}:{self.port}{path}",
+            headers=request_headers,
+            data=version.request_body(),
+        )
+
+    def publisher(self, path: str, window: float = 0.02, **kwargs) -> Publisher:
+        """
+        Publisher sending versions of a resource in the background
+        Versions queued within window seconds are coalesced into one PUT.
+        """
+        path = path if path[0] == "/" else f"/{path}"
+        return Publisher(self, path, window=window, **kwargs)
+
+    def replica(self, path: str, **kwargs) -> Replica:
+        """
+        Local replica of a resource, kept up to date by a background subscription
+        Reads are served from memory, see Replica.get()
+        """
         path = path if path[0] == "/" else f"/{path}"
+        replica = self.replicas.get(path)
+        if replica is None:
+            replica = self.replicas[path] = Replica(self, path, **kwargs)
+        return replica
+
+    def subscribe(self, path: str, headers: dict = None, chunk_size: int = None):
+        """
+        Subscribe to a resource and iterate over its Versions as they arrive
+        The stream is read incrementally, only the version being framed is buffered.
+        Args:
+            path: resource path
+            headers: extra request headers
+            chunk_size: read size, None to hand over data as soon as it arrives
+        Returns:
+            generator of Version
+        """
+        headers = dict(headers or {})
+        headers.setdefault("Subscribe", "keep-alive")
+        path = path if path[0] == "/" else f"/{path}"
+        if path in self.active_subscriptions:
+            raise ValueError(f"Subscription for resource {path} already exists")
+        self.active_subscriptions[path] = {}
+        return self._iter_versions(path, headers, chunk_size)
+
+    def multiplex(
+        self,
+        resources: list,
+        route: str = "/multiplex",
+        headers: dict = None,
+        chunk_size: int = None,
+    ):
+        """
+        Subscribe to many resources over a single stream
+        Each Version's resource tells which resource it belongs to.
+        Args:
+            resources: resource paths
+            route: path of the server's multiplex route
+        Returns:
+            generator of Version
+        """
+        headers = dict(headers or {})
+        headers["Resources"] = ", ".join(resources)
+        return self.subscribe(route, headers, chunk_size)
+
+    def add_resources(self, resources: list, route: str = "/multiplex"):
+        """
+        Add resources to the running multiplexed stream of a route
+        Returns:
+            requests.Response
+        """
+        return self._change_resources("POST", resources, route)
+
+    def remove_resources(self, resources: list, route: str = "/multiplex"):
+        """
+        Remove resources from the running multiplexed stream of a route
+        Returns:
+            requests.Response
+        """
+        return self._change_resources("DELETE", resources, route)
+
+    def _change_resources(self, method: str, resources: list, route: str):
+        route = route if route[0] == "/" else f"/{route}"
+        response = self.active_subscriptions.get(route, {}).get("response")
+        if response is None or "Multiplex-Id" not in response.headers:
+            raise ValueError(f"No multiplexed stream is running at {route}")
+        headers = {
+            "Multiplex-Id": response.headers["Multiplex-Id"],
+            "Resources": ", ".join(resources),
+        }
+        return self.session.request(
+            method, f"http://{self.host}:{self.port}{route}", headers=headers
+        )
+
+    def _iter_versions(self, path: str, headers: dict, chunk_size: int = None):
         url = f"http://{self.host}:{self.port}{path}"
+        subscription = self.active_subscriptions.get(path)
         try:
             with requests.get(url, headers=headers, stream=True) as r:
-                print(f"Subscription stream started for {path}")
                 if r.status_code < 200 or r.status_code >= 300:
                     raise ValueError(f"Subscription request for resource {path} failed with status code {r.status_code}")
-                while self.active_subscriptions.get(path):
-                    for line in r.iter_lines():
-                        if line:
-                            print(line)
-                        else:
-                            print("No data")
+                # kept so that cancel_subscription can interrupt a blocked read
+                subscription["response"] = r
+                parser = VersionParser(r.encoding or "utf-8")
+                for chunk in r.iter_content(chunk_size=chunk_size):
+                    if self.active_subscriptions.get(path) is not subscription:
+                        break
+                    yield from parser.feed(chunk)
+        except Exception:
+            # reading a response closed by cancel_subscription fails, that is expected
+            if self.active_subscriptions.get(path) is subscription:
+                raise
+        finally:
+            if self.active_subscriptions.get(path) is subscription:
+                del self.active_subscriptions[path]
+
+    def _subscription_stream(self, path: str, headers: dict, config: dict):
+        """
+        Hand every Version of a subscription to config["on_version"]
+        Versions are printed if no callback is configured
+        """
+        print(f"Subscribing to {path}")
+        on_version = config.get("on_version", print)
+        try:
+            for version in self._iter_versions(path, headers):
+                on_version(version)
         except Exception as e:
             print(e)
-        finally:
-            self.active_subscriptions.pop(path)
-                
+
     def cancel_subscription(self, path: str):
+        path = path if path[0] == "/" else f"/{path}"
         if path in self.active_subscriptions:
-            del self.active_subscriptions[path]
+            subscription = self.active_subscriptions.pop(path)
+            response = subscription.get("response")
+            if response is not None:
+                response.close()
         else:
             raise ValueError(f"No active subscription for resource {path}")
@@ -0,0 +1,144 @@
+"""
+Version publishing
+Sends versions of a resource from a background thread so that editors never
+wait on a round trip, coalescing the versions queued within a time window.
+"""
+
+import time
+import threading
+from collections import deque
+from stream import Version
+
+
+def coalesce(versions: list, max_patches: int = 256) -> list:
+    """
+    Merge chains of patch versions into single versions
+    A version extends the previous one if its only parent is that version and
+    both share merge and content types. The merged version keeps the first
+    version's parents, the last version's id and all of their patches in order.
+    Args:
+        versions: Versions in publishing order
+        max_patches: patch count at which a merged version is closed
+    Returns:
+        list of Version
+    """
+    merged = []
+    for version in versions:
+        if merged:
+            last = merged[-1]
+            if (
+                last.patches is not None
+                and version.patches is not None
+                and version.parents == [last.version]
+                and version.merge_type == last.merge_type
+                and version.content_type == last.content_type
+                and len(last.patches) + len(version.patches) <= max_patches
+            ):
+                merged[-1] = last._replace(
+                    version=version.version, patches=last.patches + version.patches
+                )
+                continue
+        merged.append(version)
+    return merged
+
+
+class Publisher:
+    """
+    Background publisher for one resource
+    publish() only queues a version. A sender thread waits for the window to
+    pass after the first queued version, coalesces everything queued by then and
+    PUTs the results in order over the client's persistent session.
+    """
+
+    def __init__(
+        self,
+        client,
+        path: str,
+        window: float = 0.02,
+        max_patches: int = 256,
+        on_error=None,
+    ):
+        """
+        Args:
+            client: BraidClient sending the requests
+            path: resource path
+            window: seconds to wait for more versions before sending, 0 sends at once
+            max_patches: most patches merged into one version
+            on_error: on_error(version, error) called when a PUT fails, errors are printed if None
+        """
+        self.client = client
+        self.path = path
+        self.window = window
+        self.max_patches = max_patches
+        self.on_error = on_error
+        self.pending = deque()
+        # time the oldest pending version was queued
+        self.since = None
+        self.sending = False
+        self.active = True
+        self.ready = threading.Condition()
+        self.thread = threading.Thread(target=self._run, daemon=True)
+        self.thread.start()
+
+    def __repr__(self):
+        return f"<Publisher {self.path} pending={len(self.pending)}>"
+
+    def publish(self, version: Version):
+        with self.ready:
+            if not self.active:
+                raise ValueError(f"Publisher for resource {self.path} is closed")
+            if not self.pending:
+                self.since = time.monotonic()
+            self.pending.append(version)
+            self.ready.notify_all()
+
+    def flush(self, timeout: float = None) -> bool:
+        """
+        Send pending versions now and wait until they were sent
+        Returns:
+            False if the timeout passed first
+        """
+        with self.ready:
+            self.since = 0
+            self.ready.notify_all()
+            return self.ready.wait_for(
+                lambda: not self.pending and not self.sending, timeout
+            )
+
+    def close(self, timeout: float = None):
+        """
+        Send pending versions and stop the sender thread
+        """
+        with self.ready:
+            self.active = False
+            self.ready.notify_all()
+        self.thread.join(timeout)
+
+    def _run(self):
+        while True:
+            with self.ready:
+                while True:
+                    if self.pending:
+                        delay = self.since + self.window - time.monotonic()
+                        if delay <= 0 or not self.active:
+                            break
+                        self.ready.wait(delay)
+                    elif not self.active:
+                        return
+                    else:
+                        self.ready.wait()
+                batch = list(self.pending)
+                self.pending.clear()
+                self.sending = True
+            for version in coalesce(batch, self.max_patches):
+                try:
+                    response = self.client.put_version(self.path, version)
+                    response.raise_for_status()
+                except Exception as e:
+                    if self.on_error is not None:
+                        self.on_error(version, e)
+                    else:
+                        print(f"Publishing version {version.version} to {self.path} failed: {e}")
+            with self.ready:
+                self.sending = False
+                self.ready.notify_all()
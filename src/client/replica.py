@@ -0,0 +1,288 @@
+"""
+Resource replicas
+Keeps a local copy of a subscribed resource up to date by applying the patches
+of every streamed version, so reads never leave the process.
+"""
+
+import re
+import sys
+import json
+import time
+import threading
+from collections import OrderedDict
+from stream import Version, VersionParser
+
+
+class Replica:
+    """
+    In-memory copy of one resource, kept in sync by a background subscription
+    The replica is seeded from a plain GET, then applies the patches of each
+    streamed version in the order the server sends them: "json <path>" ranges
+    set the value at a path, "text [start:end]" ranges replace characters and
+    a body or a patch without a range replaces the whole document.
+
+    When the stream drops, the replica resubscribes with Parents set to the
+    latest version it applied, so the server only replays the versions it missed.
+    A streamed version whose parents the replica never applied means versions
+    were lost on the way, the replica then starts over from a fresh snapshot.
+    So does a version with a Merge-Type made concurrently with the replica's
+    version, its patches only make sense to the server's merge.
+    """
+
+    JSON_PATH = re.compile(r"\.([^.\[\]]+)|\[(\d+)\]")
+    TEXT_RANGE = re.compile(r"^\[(\d+)(?::(\d+))?\]$")
+    # ids of recently applied versions remembered to skip replayed duplicates
+    MAX_SEEN = 1024
+
+    def __init__(
+        self,
+        client,
+        path: str,
+        headers: dict = None,
+        on_version=None,
+        retry: float = 0.5,
+        max_retry: float = 30,
+    ):
+        """
+        Args:
+            client: BraidClient used for the requests
+            path: resource path
+            headers: extra headers of the subscribe requests
+            on_version: on_version(replica, version) called after a version was applied
+            retry: seconds before the first reconnect, doubled after each failure
+            max_retry: longest wait between reconnects
+        """
+        self.client = client
+        self.path = path
+        self.headers = dict(headers or {})
+        self.on_version = on_version
+        self.retry = retry
+        self.max_retry = max_retry
+        self.value = None
+        self.version = None
+        self.content_type = None
+        self.seen = OrderedDict()
+        self.reconnects = 0
+        self.active = True
+        self.synced = threading.Condition()
+        self.thread = threading.Thread(target=self._run, daemon=True)
+        self.thread.start()
+
+    def __repr__(self):
+        return f"<Replica {self.path} version={self.version}>"
+
+    def get(self, path: str = None, default=None):
+        """
+        Read the document, or the value at a json path such as ".title" or ".tags[0]"
+        The returned value is shared with the replica and must not be modified,
+        the replica replaces it rather than modifying it
+        """
+        with self.synced:
+            if path is None:
+                return self.value
+            try:
+                target = self.value
+                for token in self.parse_path(path):
+                    target = target[token]
+                return target
+            except (KeyError, IndexError, TypeError):
+                return default
+
+    def wait(self, version: str = None, timeout: float = None) -> bool:
+        """
+        Wait until the replica holds a version, or any version if None
+        Returns:
+            False if the timeout passed first
+        """
+        with self.synced:
+            return self.synced.wait_for(
+                lambda: (self.version is not None if version is None else version in self.seen),
+                timeout,
+            )
+
+    def close(self, timeout: float = None):
+        """
+        Stop following the resource, the last state can still be read
+        """
+        self.active = False
+        try:
+            self.client.cancel_subscription(self.path)
+        except ValueError:
+            # between two connections
+            pass
+        if self.client.replicas.get(self.path) is self:
+            del self.client.replicas[self.path]
+        self.thread.join(timeout)
+
+    def _run(self):
+        delay = self.retry
+        while self.active:
+            try:
+                if self.version is None:
+                    self._fetch()
+                headers = dict(self.headers)
+                if self.version is not None:
+                    headers["Parents"] = self.version
+                gap = False
+                versions = self.client.subscribe(self.path, headers)
+                try:
+                    for version in versions:
+                        if not self.follows(version):
+                            gap = True
+                            break
+                        self.apply(version)
+                        delay = self.retry
+                        if not self.active:
+                            break
+                finally:
+                    versions.close()
+                if gap and self.active:
+                    print(
+                        f"Replica of {self.path} can not apply a version in order, fetching it again",
+                        file=sys.stderr,
+                    )
+                    self.version = None
+                    continue
+            except Exception as e:
+                if self.active:
+                    print(f"Replica of {self.path} lost its subscription: {e}", file=sys.stderr)
+            if not self.active:
+                return
+            self.reconnects += 1
+            time.sleep(delay)
+            delay = min(delay * 2, self.max_retry)
+
+    def _fetch(self):
+        """
+        Seed the replica with the current version of the resource
+        """
+        url = f"http://{self.client.host}:{self.client.port}{self.path}"
+        response = self.client.session.get(url)
+        response.raise_for_status()
+        versions = VersionParser(response.encoding or "utf-8").feed(response.content)
+        if versions and all(version.version is not None for version in versions):
+            for version in versions:
+                self.apply(version)
+            return
+        # a plain body, versioned by its ETag if there is one
+        etag = response.headers.get("ETag")
+        self.apply(
+            Version(
+                version=etag.strip('"') if etag else None,
+                content_type=response.headers.get("Content-Type"),
+                body=response.text,
+            )
+        )
+
+    def follows(self, version: Version) -> bool:
+        """
+        True if the replica applied every parent of a version, or the version itself
+        A version with a Merge-Type also has to be made on top of the replica's
+        version, concurrent versions are merged by the server in an order the
+        replica does not know.
+        """
+        with self.synced:
+            if version.version is not None and version.version in self.seen:
+                return True
+            if version.merge_type is not None:
+                return list(version.parents or []) == [self.version]
+            return not version.parents or all(
+                parent in self.seen for parent in version.parents
+            )
+
+    def apply(self, version: Version) -> bool:
+        """
+        Apply a version to the document, ignoring versions already applied
+        Returns:
+            True if the version changed the document
+        """
+        with self.synced:
+            if version.version is not None and version.version in self.seen:
+                return False
+            content_type = self.content_type
+            if version.content_type:
+                self.content_type = version.content_type
+            try:
+                if version.patches is None:
+                    value = self._parse_body(version.body)
+                else:
+                    # values returned by get() are never modified, and a failed
+                    # patch leaves the document as it was
+                    value = self.value
+                    for patch in version.patches:
+                        value = self._patch(value, patch)
+            except Exception:
+                self.content_type = content_type
+                raise
+            self.value = value
+            if version.version is not None:
+                self.version = version.version
+                self.seen[version.version] = None
+                if len(self.seen) > self.MAX_SEEN:
+                    self.seen.popitem(last=False)
+            self.synced.notify_all()
+        if self.on_version is not None:
+            self.on_version(self, version)
+        return True
+
+    def _parse_body(self, body: str):
+        if self.content_type is None or "json" in self.content_type:
+            try:
+                return json.loads(body) if body else None
+            except ValueError:
+                if self.content_type is not None:
+                    raise
+        return body
+
+    def _patch(self, value, patch):
+        unit, range = patch.content_range or (None, None)
+        if range is None:
+            return self._parse_body(patch.content)
+        if unit == "json":
+            return self._set(value, self.parse_path(range), json.loads(patch.content))
+        if unit == "text":
+            match = self.TEXT_RANGE.match(range.strip())
+            if not match:
+                raise ValueError(f"Invalid text range '{range}'")
+            start = int(match.group(1))
+            end = int(match.group(2)) if match.group(2) is not None else start
+            text = value or ""
+            return text[:start] + patch.content + text[end:]
+        raise ValueError(f"Unsupported range unit '{unit}'")
+
+    @classmethod
+    def parse_path(cls, path: str) -> tuple:
+        path = path.strip()
+        tokens = []
+        position = 0
+        for match in cls.JSON_PATH.finditer(path):
+            if match.start() != position:
+                raise ValueError(f"Invalid json range '{path}'")
+            name, index = match.groups()
+            tokens.append(name if name is not None else int(index))
+            position = match.end()
+        if position != len(path):
+            raise ValueError(f"Invalid json range '{path}'")
+        return tuple(tokens)
+
+    @classmethod
+    def _set(cls, document, path: tuple, value):
+        """
+        Copy of a document with the value at a path set, only the containers
+        along the path are copied
+        """
+        if not path:
+            return value
+        token, rest = path[0], path[1:]
+        if not isinstance(document, (dict, list)):
+            document = [] if isinstance(token, int) else {}
+        if isinstance(document, list):
+            document = list(document)
+            if token == len(document) and not rest:
+                document.append(value)
+            else:
+                document[token] = cls._set(document[token], rest, value)
+        else:
+            document = dict(document)
+            document[token] = cls._set(document.get(token), rest, value)
+        return document
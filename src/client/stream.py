@@ -0,0 +1,217 @@
+"""
+Braid stream parsing
+Incrementally frames the Versions of a subscription response
+"""
+
+from typing import NamedTuple
+
+
+class Patch(NamedTuple):
+    """
+    A Patch is an update to an HTTP resource
+    """
+
+    content: str
+    content_type: str = None
+    content_range: tuple = None
+
+    def __repr__(self):
+        return "<Patch content_type={} content_range={}>".format(
+            self.content_type, self.content_range
+        )
+
+    def encode(self) -> bytes:
+        """
+        Patch block of a request body, Content-Length counts bytes
+        """
+        content = self.content.encode("utf-8")
+        headers = f"Content-Length: {len(content)}\r\n"
+        if self.content_type:
+            headers += f"Content-Type: {self.content_type}\r\n"
+        if self.content_range:
+            headers += f"Content-Range: {' '.join(self.content_range)}\r\n"
+        return headers.encode("utf-8") + b"\r\n" + content + b"\r\n"
+
+
+class Version(NamedTuple):
+    """
+    A Version is a series of patches or a string body
+    describing the state of an HTTP resource
+    resource is only set for versions read from a multiplexed stream
+    """
+
+    version: str
+    parents: list = None
+    merge_type: str = None
+    content_type: str = None
+    patches: list = None
+    body: str = None
+    resource: str = None
+
+    def __repr__(self):
+        return f"<Version id={self.version}>"
+
+    def request_headers(self) -> dict:
+        """
+        Headers describing this version in a PUT request
+        """
+        headers = {"Version": self.version}
+        if self.parents:
+            headers["Parents"] = ", ".join(self.parents)
+        if self.merge_type:
+            headers["Merge-Type"] = self.merge_type
+        if self.content_type:
+            headers["Content-Type"] = self.content_type
+        if self.patches is not None:
+            headers["Patches"] = str(len(self.patches))
+        return headers
+
+    def request_body(self) -> bytes:
+        if self.patches is not None:
+            return b"".join(patch.encode() for patch in self.patches)
+        return (self.body or "").encode("utf-8")
+
+
+class VersionParser:
+    """
+    Incremental parser for a Braid subscription stream
+    Bytes are fed as they arrive and each Version is returned as soon as its
+    body, framed by Content-Length or by its patches' Content-Lengths, is complete.
+    Consumed bytes are dropped, so memory is bounded by the largest version.
+    """
+
+    # parser states
+    VERSION_HEADERS = 0
+    BODY = 1
+    PATCH_HEADERS = 2
+    PATCH_BODY = 3
+
+    def __init__(self, encoding: str = "utf-8"):
+        self.encoding = encoding
+        self.buffer = bytearray()
+        # offset of the first unconsumed byte in buffer
+        self.pos = 0
+        self.state = self.VERSION_HEADERS
+        self.headers = {}
+        self.version_headers = None
+        self.patches = []
+        self.patch_count = 0
+
+    def feed(self, chunk: bytes) -> list:
+        """
+        Add bytes to the parser
+        Returns:
+            list of the Versions completed by this chunk
+        """
+        self.buffer += chunk
+        versions = []
+        while True:
+            if self.state in (self.VERSION_HEADERS, self.PATCH_HEADERS):
+                if not self._parse_headers():
+                    break
+                self._headers_done()
+            elif self.state == self.BODY:
+                body = self._take(self.version_headers.get("content-length", 0))
+                if body is None:
+                    break
+                versions.append(self._version(body=body.decode(self.encoding)))
+            else:
+                content = self._take(self.headers.get("content-length"))
+                if content is None:
+                    break
+                self._patch_done(content)
+                if len(self.patches) == self.patch_count:
+                    versions.append(self._version(patches=self.patches))
+                else:
+                    self.state = self.PATCH_HEADERS
+        self._compact()
+        return versions
+
+    def _parse_headers(self) -> bool:
+        """
+        Consume header lines until the blank line ending a header block
+        Returns True once the headers are complete
+        """
+        buffer = self.buffer
+        while True:
+            if not self.headers:
+                # skip heartbeats and the newlines separating blocks
+                while self.pos < len(buffer) and buffer[self.pos] in b"\r\n":
+                    self.pos += 1
+            newline = buffer.find(b"\n", self.pos)
+            if newline < 0:
+                return False
+            line = bytes(buffer[self.pos : newline]).rstrip(b"\r")
+            self.pos = newline + 1
+            if line:
+                name, _, value = line.decode("latin-1").partition(":")
+                self.headers[name.strip().lower()] = value.strip()
+            elif self.headers:
+                return True
+
+    def _headers_done(self):
+        headers, self.headers = self.headers, {}
+        if self.state == self.PATCH_HEADERS:
+            if "content-length" not in headers:
+                raise ValueError("No 'Content-Length' header found in patch")
+            self.headers = headers
+            self.state = self.PATCH_BODY
+            return
+        self.version_headers = headers
+        if "patches" in headers:
+            self.patch_count = int(headers["patches"])
+            self.patches = []
+            if self.patch_count == 0:
+                self.state = self.BODY
+                headers["content-length"] = 0
+            else:
+                self.state = self.PATCH_HEADERS
+        else:
+            self.state = self.BODY
+
+    def _take(self, length) -> bytes:
+        """
+        Consume length bytes, None if they have not all arrived
+        """
+        end = self.pos + int(length)
+        if len(self.buffer) < end:
+            return None
+        data = bytes(self.buffer[self.pos : end])
+        self.pos = end
+        return data
+
+    def _patch_done(self, content: bytes):
+        headers, self.headers = self.headers, {}
+        content_range = headers.get("content-range")
+        if content_range:
+            content_range = tuple(content_range.split(" ", 1))
+        self.patches.append(
+            Patch(content.decode(self.encoding), headers.get("content-type"), content_range)
+        )
+
+    def _version(self, body: str = None, patches: list = None) -> Version:
+        headers = self.version_headers
+        parents = headers.get("parents")
+        if parents:
+            parents = [p.strip() for p in parents.split(",") if p.strip()]
+        version = Version(
+            version=headers.get("version"),
+            parents=parents or None,
+            merge_type=headers.get("merge-type"),
+            content_type=headers.get("content-type"),
+            patches=patches,
+            body=body,
+            resource=headers.get("resource"),
+        )
+        self.state = self.VERSION_HEADERS
+        self.version_headers = None
+        self.patches = []
+        self.patch_count = 0
+        return version
+
+    def _compact(self):
+        # dropping the consumed prefix only once it outweighs the rest keeps
+        # the amortized cost of compaction linear
+        if self.pos and self.pos * 2 >= len(self.buffer):
+            del self.buffer[: self.pos]
+            self.pos = 0
@@ -0,0 +1,424 @@
+"""
+Braid ASGI Handler
+Wraps an ASGI application to inject Braid request handling.
+Each subscription is served by a coroutine instead of a worker thread,
+so idle subscriptions only cost the memory of their queue.
+"""
+
+import sys
+import time
+import asyncio
+from core import (
+    Patch,
+    QueueLimits,
+    Subscription,
+    Version,
+    is_true,
+)
+from handler import BraidHandler
+from metrics import BEFORE_REQUEST
+
+
+class BraidRequest(object):
+    """
+    Minimal request view over an ASGI scope
+    Exposes the attributes the Flask middleware sets on flask.request
+    """
+
+    def __init__(self, scope):
+        self.scope = scope
+        self.method = scope["method"]
+        self.path = scope["path"]
+        self.query_string = scope.get("query_string", b"")
+        client = scope.get("client")
+        self.remote_addr = client[0] if client else None
+        self.remote_port = client[1] if client else None
+        # ASGI header names are lowercase bytes
+        self.headers = {
+            name.decode("latin-1").lower(): value.decode("latin-1")
+            for name, value in scope.get("headers", [])
+        }
+        self.data = b""
+        version = self.headers.get("version")
+        parents = self.headers.get("parents")
+        peer = self.headers.get("peer")
+        # change to only == "keep-alive" once braidify client doesn't auto set header to true
+        # true as a value for the header is not part of the Braid spec
+        subscribe = (
+            is_true(self.headers.get("subscribe", False))
+            or self.headers.get("subscribe") == "keep-alive"
+        )
+        self.version = version
+        self.parents = parents
+        self.peer = peer
+        self.subscribe = subscribe
+        self.subscription = None
+        self.caught_up = False
+        self.cache_generation = None
+
+
+class VersionResponse(object):
+    """
+    ASGI response for a single Version, the counterpart of Braid.create_version()
+    returning a flask.Response
+    """
+
+    def __init__(self, version: Version, status: int = 200):
+        self.version = version
+        self.status = status
+
+    async def __call__(self, scope, receive, send):
+        body = self.version.encode()
+        headers = [(b"content-length", str(len(body)).encode("latin-1"))]
+        content_type = self.version.declared_content_type()
+        if content_type:
+            headers.append((b"content-type", content_type.encode("latin-1")))
+        await send(
+            {"type": "http.response.start", "status": self.status, "headers": headers}
+        )
+        await send({"type": "http.response.body", "body": body})
+
+
+class BytesResponse(object):
+    """
+    ASGI response for an already encoded body
+    """
+
+    def __init__(self, body: bytes = b"", status: int = 200, headers: list = None):
+        self.body = body
+        self.status = status
+        self.headers = headers or []
+
+    async def __call__(self, scope, receive, send):
+        headers = [(b"content-length", str(len(self.body)).encode("latin-1"))]
+        headers += self.headers
+        await send(
+            {"type": "http.response.start", "status": self.status, "headers": headers}
+        )
+        await send({"type": "http.response.body", "body": self.body})
+
+
+class AsyncSubscription(Subscription):
+    """
+    Coroutine based counterpart of core.Subscription
+    Versions are queued with the same limits and overflow policies, and written
+    by the stream coroutine, which sleeps on an asyncio.Event until data arrives
+    or the heartbeat elapses.
+    """
+
+    def __init__(
+        self,
+        request,
+        s_id,
+        closed_cb,
+        heartbeat: float = None,
+        limits: QueueLimits = None,
+        max_batch: int = 65536,
+        metrics=None,
+        encoding: str = None,
+        resources: list = None,
+    ):
+        super().__init__(
+            request,
+            s_id,
+            closed_cb,
+            heartbeat=heartbeat,
+            limits=limits,
+            max_batch=max_batch,
+            metrics=metrics,
+            encoding=encoding,
+            resources=resources,
+        )
+        self.wakeup = asyncio.Event()
+
+    def stream(self):
+        """
+        ASGI response which streams queued versions until the client disconnects
+        """
+
+        async def _stream(scope, receive, send):
+            headers = [(b"content-type", b"text/plain; charset=utf-8")]
+            if self.encoding is not None:
+                headers.append((b"content-encoding", self.encoding.encode("latin-1")))
+                headers.append((b"vary", b"Accept-Encoding"))
+            if self.multiplexed:
+                headers.append((b"multiplex-id", self.multiplex_id.encode("latin-1")))
+            await send({"type": "http.response.start", "status": 209, "headers": headers})
+            disconnect = asyncio.ensure_future(self._wait_disconnect(receive))
+            try:
+                while self.active:
+                    data = await self.next()
+                    if data is None:
+                        break
+                    await send(
+                        {
+                            "type": "http.response.body",
+                            "body": self.encode_frame(data),
+                            "more_body": True,
+                        }
+                    )
+                await send({"type": "http.response.body", "body": b""})
+            except (OSError, asyncio.CancelledError):
+                print("client disconnected", file=sys.stdout)
+            finally:
+                disconnect.cancel()
+                self.close()
+
+        return _stream
+
+    async def _wait_disconnect(self, receive):
+        """
+        Close the subscription as soon as the server reports a disconnect
+        """
+        while True:
+            message = await receive()
+            if message["type"] == "http.disconnect":
+                print("client disconnected", file=sys.stdout)
+                self.close()
+                return
+
+    async def next(self):
+        """
+        Wait until data is queued, the subscription closes or the heartbeat elapses
+        Called again once the previous write completed, which renews the subscription
+        Returns:
+            queued data, a heartbeat frame, or None when closed
+        """
+        self.renewed = time.monotonic()
+        while self.active and not self.pending() and not self.probe_pending:
+            self.wakeup.clear()
+            try:
+                await asyncio.wait_for(self.wakeup.wait(), timeout=self.heartbeat)
+            except asyncio.TimeoutError:
+                # idle for a full heartbeat interval, probe the client
+                return self.HEARTBEAT_FRAME
+        if not self.active:
+            return None
+        probe, self.probe_pending = self.probe_pending, False
+        if probe and not self.pending():
+            return self.HEARTBEAT_FRAME
+        return self.dequeue()
+
+    def probe(self):
+        """
+        Send a heartbeat frame unless data is about to be written anyway
+        Must run on the event loop
+        """
+        self.probe_pending = True
+        self.wakeup.set()
+
+    def append(self, data):
+        """
+        Queue data to be streamed to the client
+        The same buffer may be shared with other subscriptions, it is never copied
+        """
+        if isinstance(data, str):
+            data = data.encode("utf-8")
+        keep = self.enqueue(data)
+        self.wakeup.set()
+        if not keep:
+            print(f"subscription {self.s_id} fell behind, disconnecting", file=sys.stdout)
+            self.close()
+
+    def close(self):
+        """
+        Close the stream
+        """
+        if not self.active:
+            return
+        self.active = False
+        # wake the stream coroutine so it can exit
+        self.wakeup.set()
+        self.closed_cb()
+
+
+class AsyncBraid(BraidHandler):
+    """
+    ASGI middleware with the same subscribe, PUT and advertise semantics as braid.Braid
+    Takes the options of handler.BraidHandler, app is the ASGI application.
+
+    The wrapped application finds the Braid request at scope["braid"] and
+    returns ASGI responses from it, for example:
+
+        async def app(scope, receive, send):
+            request = scope["braid"]
+            if request.subscribe:
+                response = request.subscription.stream()
+            else:
+                response = request.create_version({"version": "1", "body": "{}"})
+            await response(scope, receive, send)
+    """
+
+    subscription_class = AsyncSubscription
+
+    def __init__(self, app, **kwargs):
+        # event loop serving the subscriptions, set on the first request
+        self.loop = None
+        super().__init__(app, **kwargs)
+        self.broker.subscribe(self.deliver_threadsafe)
+
+    def dispatch(self, fn, *args):
+        """
+        Run a lifecycle call on the event loop, subscriptions are not thread safe
+        """
+        self.loop.call_soon_threadsafe(fn, *args)
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+        if self.loop is None:
+            self.loop = asyncio.get_running_loop()
+        if scope["path"] == self.metrics_route and scope["method"] == "GET":
+            await self.metrics_response()(scope, receive, send)
+            return
+        start = time.perf_counter()
+        request = BraidRequest(scope)
+        request.subscriptions = self.subscriptions
+        request.store = self.store
+        request.create_version = lambda data, subscription=None: self.create_version(
+            data, subscription, request
+        )
+        scope["braid"] = request
+
+        if request.path == self.multiplex_route:
+            response = self.multiplex_response(request)
+            self.metrics.observe(BEFORE_REQUEST, time.perf_counter() - start)
+            await response(scope, receive, send)
+            return
+        if request.method == "GET":
+            if request.subscribe:
+                self.subscribe(request)
+            elif self.cache is not None:
+                request.cache_generation = self.cache.generation(request.path)
+                # a cached response skips the application entirely
+                response = self.cached_response(request)
+                if response is not None:
+                    self.metrics.observe(BEFORE_REQUEST, time.perf_counter() - start)
+                    await response(scope, receive, send)
+                    return
+        elif request.method == "PUT":
+            # the body has to be read here to parse the patches,
+            # so it is replayed to the wrapped application afterwards
+            request.data = await self._read_body(receive)
+            receive = self._replay_body(request.data, receive)
+            version = self.version_from_request(request)
+            if version:
+                request.version = version
+            request.advertise_version = lambda v: self.advertise_version(
+                v, request.path
+            )
+            request.merge_version = lambda v, initial=None: self.merge_version(
+                v, request.path, initial
+            )
+            request.commit_version = lambda v, advertise=False: self.commit_version(
+                v, request.path, advertise
+            )
+
+        self.metrics.observe(BEFORE_REQUEST, time.perf_counter() - start)
+        await self.app(scope, receive, self._wrap_send(request, send))
+
+    def response(self, body: bytes = b"", status: int = 200, headers: dict = None):
+        return BytesResponse(
+            body,
+            status=status,
+            headers=[
+                (name.lower().encode("latin-1"), value.encode("latin-1"))
+                for name, value in (headers or {}).items()
+            ],
+        )
+
+    def version_response(self, version: Version):
+        return VersionResponse(version)
+
+    def _wrap_send(self, request, send):
+        """
+        Counterpart of the Flask after_request hook
+        """
+
+        async def wrapped_send(message):
+            # for a new subscription only
+            if (
+                message["type"] == "http.response.start"
+                and request.subscribe
+                and request.method == "GET"
+            ):
+                message = dict(message, status=209)
+            await send(message)
+
+        return wrapped_send
+
+    @staticmethod
+    async def _read_body(receive) -> bytes:
+        chunks = []
+        while True:
+            message = await receive()
+            if message["type"] == "http.disconnect":
+                break
+            chunks.append(message.get("body", b""))
+            if not message.get("more_body", False):
+                break
+        return b"".join(chunks)
+
+    @staticmethod
+    def _replay_body(body: bytes, receive):
+        sent = False
+
+        async def replay():
+            nonlocal sent
+            if not sent:
+                sent = True
+                return {"type": "http.request", "body": body, "more_body": False}
+            return await receive()
+
+        return replay
+
+    def deliver_threadsafe(self, resource: str, data: bytes):
+        """
+        Broker callback, brokers may deliver from their own threads
+        """
+        loop = self.loop
+        if loop is None:
+            # no request served yet, so there are no subscriptions either
+            return
+        try:
+            running = asyncio.get_running_loop()
+        except RuntimeError:
+            running = None
+        if running is loop:
+            self.deliver(resource, data)
+        else:
+            loop.call_soon_threadsafe(self.deliver, resource, data)
+
+    async def commit_version(self, version: Version, resource: str, advertise: bool = False):
+        """
+        Apply a version to the state of a resource in the store
+        Runs on the default executor, a durable store blocks until its
+        group commit is on disk and concurrent commits share it.
+        Args:
+            advertise: advertise the version once the store made it durable,
+                in commit order
+        Returns:
+            store.State
+        """
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(
+            None, super().commit_version, version, resource, advertise
+        )
+
+    def parse_patches(self, request: BraidRequest):
+        """
+        Parse patches from the buffered request body
+        """
+        num_patches = int(request.headers.get("patches", -1))
+        if num_patches < 0:
+            # if no patches are specified, ignore
+            return
+        if num_patches == 0:
+            return []
+        patches = Patch.list_from_buffer(request.data)
+        if len(patches) != num_patches:
+            raise RuntimeError(
+                "Number of patches does not match number given in 'Patches' header"
+            )
+        return patches
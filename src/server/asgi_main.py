@@ -0,0 +1,71 @@
+"""
+Run ASGI server
+Same sample Posts resource as main.py, served by the asyncio Braid adapter
+"""
+import json
+from asgi import AsyncBraid
+from cache import ResponseCache
+from posts import posts, store
+
+
+async def plain_response(send, status: int, body: bytes = b"", headers: list = None):
+    await send(
+        {"type": "http.response.start", "status": status, "headers": headers or []}
+    )
+    await send({"type": "http.response.body", "body": body})
+
+
+async def app(scope, receive, send):
+    """
+    Routes requests for the heartbeat and /post/<id> resources
+    """
+    request = scope["braid"]
+    if request.path == "/heartbeat":
+        await plain_response(send, 200, b"OK")
+        return
+    parts = request.path.strip("/").split("/")
+    if len(parts) != 2 or parts[0] != "post" or parts[1] not in posts:
+        await plain_response(send, 404)
+        return
+    id = parts[1]
+
+    if request.method == "OPTIONS":
+        # Braid options route informing client which methods can be given range requests
+        await plain_response(
+            send,
+            204,
+            headers=[
+                (b"range-request-allow-methods", b"PATCH, PUT"),
+                (b"range-request-allow-units", b"json"),
+                (b"patches", b"OK"),
+            ],
+        )
+    elif request.method == "GET":
+        # Middleware will have set up a subscription for this request + user
+        state = request.store.get(request.path)
+        snapshot = {"version": state.version, "body": json.dumps(state.value)}
+        if request.subscribe:
+            if not request.caught_up:
+                # the client's parents are unknown, start it from the current state
+                request.create_version(snapshot, request.subscription)
+            response = request.subscription.stream()
+        else:
+            response = request.create_version(snapshot)
+        await response(scope, receive, send)
+    elif request.method == "PUT":
+        # applied atomically and logged, advertised once it is durable, in the
+        # order concurrent PUTs were committed
+        await request.commit_version(request.version, advertise=True)
+        await plain_response(send, 200)
+    else:
+        await plain_response(send, 405)
+
+
+# every change of a post is advertised, so plain GETs can be cached
+app = AsyncBraid(app, store=store, cache=ResponseCache())
+
+# Run with any ASGI server
+if __name__ == "__main__":
+    import uvicorn
+
+    uvicorn.run(app, host="0.0.0.0", port=8080)
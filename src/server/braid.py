@@ -4,24 +4,39 @@ Wraps Python application object to inject lifecyle methods
 """
 
 import sys
-import json
+import time
 from flask import request, Response
 from core import (
-    Subscription,
     Version,
     is_true,
-    subscriber_id,
     generate_patch_stream_string,
     parse_patches,
     generate_articial_subscription_data,
 )
+from handler import BraidHandler
+from metrics import BEFORE_REQUEST
 
 
-class Braid(object):
-    def __init__(self, app):
-        self.app = app
+class Braid(BraidHandler):
+    """
+    Flask middleware
+    Takes the options of handler.BraidHandler, app is the Flask application.
+    Routes find the Braid request attributes on flask.request.
+    """
+
+    def __init__(self, app, **kwargs):
+        super().__init__(app, **kwargs)
+        self.broker.subscribe(self.deliver)
         self.setup_lifecycle_methods()
-        self.subscriptions = {}
+        if self.metrics_route is not None:
+            self.app.add_url_rule(self.metrics_route, "braid_metrics", self.metrics_response)
+        if self.multiplex_route is not None:
+            self.app.add_url_rule(
+                self.multiplex_route,
+                "braid_multiplex",
+                lambda: self.multiplex_response(request),
+                methods=["GET", "POST", "DELETE"],
+            )
 
     def setup_lifecycle_methods(self):
         """
@@ -54,26 +69,28 @@ class Braid(object):
             setattr(request, "parents", parents)
             setattr(request, "peer", peer)
             setattr(request, "subscribe", subscribe)
+            setattr(request, "caught_up", False)
             setattr(request, "subscriptions", self.subscriptions)
             setattr(request, "create_version", self.create_version)
+            setattr(request, "store", self.store)
 
+            if request.path == self.multiplex_route:
+                # handled by multiplex_response()
+                return
             # TODO: add REST method handler functions
             if request.method == "GET":
                 if request.subscribe:
-                    # Store new subscription
-                    s_id = subscriber_id(request)
-                    if s_id in self.subscriptions:
-                        # Kill existing subscription and replace with new one
-                        # TODO: figure out if the protocol allows for a user
-                        # to subscribe to the same resource multiple times concurrently
-                        self.subscriptions[s_id].close()
-                    subscription = Subscription(
-                        request, s_id, lambda: self.subscriptions.pop(s_id)
-                    )
-                    self.subscriptions[s_id] = subscription
-                    setattr(request, "subscription", subscription)
+                    self.subscribe(request)
+                elif self.cache is not None:
+                    # responses built from here on are cached only if the
+                    # resource does not change before they are stored
+                    setattr(request, "cache_generation", self.cache.generation(request.path))
+                    # a cached response skips the route entirely
+                    response = self.cached_response(request)
+                    if response is not None:
+                        return response
             elif request.method == "PUT":
-                version = self.version_from_request()
+                version = self.version_from_request(request)
                 if version:
                     setattr(request, "version", version)
                 # _patches allows user to control which patches are advertised
@@ -81,8 +98,17 @@ class Braid(object):
                 setattr(
                     request, "advertise_version", lambda v: self.advertise_version(v)
                 )
+                setattr(request, "merge_version", self.merge_version)
+                setattr(request, "commit_version", self.commit_version)
+
+        def timed_before_request():
+            start = time.perf_counter()
+            try:
+                return before_request()
+            finally:
+                self.metrics.observe(BEFORE_REQUEST, time.perf_counter() - start)
 
-        self.app.before_request(before_request)
+        self.app.before_request(timed_before_request)
 
     def setup_after_request(self):
         """
@@ -103,57 +129,52 @@ class Braid(object):
 
         self.app.after_request(after_request)
 
-    def advertise_version(self, version: list):
+    def response(self, body: bytes = b"", status: int = 200, headers: dict = None):
+        return Response(body, status=status, headers=headers)
+
+    def parse_patches(self, request):
+        # Flask reads the patches from the request stream
+        return parse_patches()
+
+    def advertise_version(self, version: Version, resource: str = None):
         """
         Advertise a resource update to all the subscribers of a resource
+        Defaults to the resource of the current request
         """
-        for subscription in self.subscriptions.values():
-            if subscription.resource == request.path:
-                self.create_version(
-                    version,
-                    subscription,
-                )
+        if resource is None:
+            resource = request.path
+        super().advertise_version(version, resource)
 
-    def version_from_request(self):
+    def merge_version(self, version: Version, initial=None, resource: str = None):
         """
-        Extract version metadata and body from request
+        Merge a version into the document of a resource with its Merge-Type
+        Defaults to the resource of the current request
+        Args:
+            initial: state of the resource before any merged version
+        Returns:
+            merge.Document, its value is the merged state
         """
-        version = request.headers.get("Version")
-        if version is None:
-            return
-        parents = request.headers.get("Parents")
-        if parents:
-            parents = parents.split(",")
-        content_type = request.headers.get("Content-Type")
-        merge_type = request.headers.get("Merge-Type")
-        patches = parse_patches()
-        body = request.data if patches is None else None
-        new_version = Version(
-            version=version,
-            parents=parents,
-            content_type=content_type,
-            merge_type=merge_type,
-            body=body,
-            patches=patches,
-        )
-        return new_version
-
-    def create_version(self, data, subscription: Subscription=None):
+        if resource is None:
+            resource = request.path
+        return super().merge_version(version, resource, initial)
+
+    def commit_version(self, version: Version, resource: str = None, advertise: bool = False):
+        """
+        Apply a version to the state of a resource in the store
+        Defaults to the resource of the current request
+        Args:
+            advertise: advertise the version once the store made it durable,
+                in commit order
+        Returns:
+            store.State, once the store made it durable
+        """
+        if resource is None:
+            resource = request.path
+        return super().commit_version(version, resource, advertise)
+
+    def create_version(self, data, subscription=None):
         """
         Create a new version of a resource and forward it depending on the request type
         returns: Flask.Response or None (write to stream)
         """
-        if isinstance(data, Version):
-            version = data
-        elif isinstance(data, dict):
-            if "patches" not in data and "body" not in data:
-                raise ValueError("No 'patches' or 'body' provided in new version data")
-            version = Version(**data)
-        if subscription:
-            # prepare for next version
-            subscription.append(str(version))
-        else:
-            response = Response(str(version), status=200)
-            if version.is_valid_json():
-                response.headers["Content-Type"] = "application/json"
-            return response
\ No newline at end of file
+        return super().create_version(data, subscription, request)
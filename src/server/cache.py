@@ -0,0 +1,121 @@
+"""
+Response cache
+Keeps the encoded responses of plain GETs per resource until the resource
+advertises its next version, so repeated reads skip serialization entirely.
+Only routes that advertise every change of their resources can be cached,
+a change that is never advertised is never seen by the cache.
+"""
+
+import threading
+from collections import OrderedDict
+from typing import NamedTuple
+
+
+class CachedResponse(NamedTuple):
+    """
+    Encoded snapshot of a resource at one version
+    """
+
+    version: str
+    body: bytes
+    content_type: str = None
+
+    @property
+    def etag(self) -> str:
+        return f'"{self.version}"'
+
+
+def etag_matches(if_none_match: str, etag: str) -> bool:
+    """
+    Checks an If-None-Match header against an entity tag, weak tags match too
+    """
+    if not if_none_match:
+        return False
+    if if_none_match.strip() == "*":
+        return True
+    for tag in if_none_match.split(","):
+        tag = tag.strip()
+        if tag.startswith("W/"):
+            tag = tag[2:]
+        if tag == etag:
+            return True
+    return False
+
+
+class ResponseCache(object):
+    """
+    Encoded GET responses per resource
+    A resource holds one snapshot per query string, the response at its current
+    version, and the responses listing the versions since a few recently
+    requested parents. Everything cached for a resource, under any query string,
+    is dropped when it advertises a version.
+    Each invalidation bumps the resource's generation, and responses built
+    during an older generation are not stored, so a read racing a write can
+    not cache a stale snapshot.
+    """
+
+    def __init__(self, max_since: int = 64):
+        """
+        Args:
+            max_since: versions-since responses kept per resource
+        """
+        self.max_since = max_since
+        # resource -> query string -> CachedResponse
+        self.snapshots = {}
+        # resource -> OrderedDict (query string, parents) -> body
+        self.since_responses = {}
+        self.generations = {}
+        self.lock = threading.Lock()
+
+    def generation(self, resource: str) -> int:
+        return self.generations.get(resource, 0)
+
+    def snapshot(self, resource: str, query: bytes = b"") -> CachedResponse:
+        return self.snapshots.get(resource, {}).get(query)
+
+    def store(
+        self, resource: str, generation: int, response: CachedResponse, query: bytes = b""
+    ) -> bool:
+        """
+        Cache the snapshot of a resource built during generation
+        Args:
+            query: query string of the request the snapshot answered
+        Returns:
+            False if the resource changed since, the response was not stored
+        """
+        with self.lock:
+            if self.generations.get(resource, 0) != generation:
+                return False
+            self.snapshots.setdefault(resource, {})[query] = response
+            return True
+
+    def since(self, resource: str, parents: list, history, query: bytes = b"") -> bytes:
+        """
+        Encoded versions of a resource that are not ancestors of parents
+        Returns:
+            bytes, None if the parents are unknown to history
+        """
+        key = (query, tuple(sorted(parents)))
+        with self.lock:
+            cached = self.since_responses.get(resource)
+            if cached is not None and key in cached:
+                cached.move_to_end(key)
+                return cached[key]
+            generation = self.generations.get(resource, 0)
+        missing = history.versions_since(resource, parents)
+        if missing is None:
+            return None
+        body = b"".join(version.encode() for version in missing)
+        with self.lock:
+            if self.generations.get(resource, 0) == generation:
+                cached = self.since_responses.setdefault(resource, OrderedDict())
+                cached[key] = body
+                if len(cached) > self.max_since:
+                    cached.popitem(last=False)
+        return body
+
+    def invalidate(self, resource: str):
+        with self.lock:
+            self.generations[resource] = self.generations.get(resource, 0) + 1
+            self.snapshots.pop(resource, None)
+            self.since_responses.pop(resource, None)
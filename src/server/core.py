@@ -4,144 +4,600 @@ Core data structures
 
 import sys
 import json
-import re
+import time
+import random
+import secrets
+import zlib
+import itertools
+import threading
+from collections import deque
 from flask import request, Response, stream_with_context
 from typing import NamedTuple
 from textwrap import dedent
+from metrics import BYTES_SENT, QUEUE_DEPTH
 
 
-class Patch(NamedTuple):
+class Patch(object):
     """
     A Patch is an update to an HTTP resource
+    Its content is kept as the bytes read off the request, possibly a
+    memoryview into the request buffer, and decoded only when read as a str.
+    Patches are immutable, their header block is encoded once and reused.
     """
 
-    content: str
-    content_type: str = None
-    content_range: tuple = None
+    __slots__ = ("data", "content_type", "content_range", "_header")
+
+    def __init__(self, content, content_type: str = None, content_range: tuple = None):
+        """
+        Args:
+            content: str, bytes or memoryview
+        """
+        if isinstance(content, str):
+            content = content.encode("utf-8")
+        self.data = content
+        self.content_type = content_type
+        self.content_range = content_range
+        self._header = None
+
+    @property
+    def content(self) -> str:
+        return str(self.data, "utf-8")
 
     @classmethod
-    def list_from_buffer(cls, buffer: str) -> "Patch":
+    def list_from_buffer(cls, buffer) -> list:
         """
-        Creates a list of Patches from a request buffer
+        Creates a list of Patches from a complete request buffer (str or bytes)
         """
-        patches = []
-        while len(buffer) > 0:
-            # find end of first patch's headers
-            dbl_newlines = list(re.finditer(r"(\r?\n)(\r?\n)", buffer))
-            if not len(dbl_newlines):
-                raise ValueError(
-                    "Could not parse patches with no end of headers marker"
-                )
-            std_newline = "\r\n"
-            headers_length = dbl_newlines[0].end()
-            # now we can get the headers based on headers_length
-            # remove all whitespaces (ie. not headers)
-            headers = buffer[:headers_length].strip()
-            # parse the headers
-            headers = headers.split("\r\n")
-            headers = [header.split(": ") for header in headers]
-            headers = {header[0]: header[1] for header in headers}
-            if "Content-Length" not in headers:
-                raise ValueError("No 'Content-Length' header found in patch")
-            content_length = int(headers.get("Content-Length"))
-            if "Content-Range" in headers:
-                content_range = tuple(headers["Content-Range"].split(" "))
-            content_type = headers.get("Content-Type", None)
-            if not content_type and not content_range:
-                raise ValueError(
-                    "No 'Content-Type' or 'Content-Range' header found in patch"
+        if isinstance(buffer, str):
+            buffer = buffer.encode("utf-8")
+        parser = PatchParser()
+        patches = parser.feed(buffer)
+        parser.close()
+        return patches
+
+    @classmethod
+    def iter_from_stream(cls, stream, content_length: int = None, chunk_size: int = 65536):
+        """
+        Lazily parse Patches from a binary stream
+        Each Patch is yielded as soon as its content has been read
+        Args:
+            stream: file-like object with a read(size) method
+            content_length: number of body bytes to read, None reads until EOF
+            chunk_size: maximum bytes read per call
+        """
+        parser = PatchParser()
+        remaining = content_length
+        while remaining is None or remaining > 0:
+            size = chunk_size if remaining is None else min(chunk_size, remaining)
+            chunk = stream.read(size)
+            if not chunk:
+                # end of stream
+                break
+            if remaining is not None:
+                remaining -= len(chunk)
+            yield from parser.feed(chunk)
+        parser.close()
+
+    def header(self) -> bytes:
+        """
+        Header block of the patch, Content-Length counts bytes
+        """
+        if self._header is None:
+            header = "Content-Length: {}".format(len(self.data))
+            if self.content_type:
+                header += "\r\nContent-Type: {}".format(self.content_type)
+            if self.content_range:
+                header += "\r\nContent-Range: {} {}".format(
+                    self.content_range[0], self.content_range[1]
                 )
-            content = buffer[
-                headers_length : headers_length + content_length + len(std_newline)
-            ].strip()
-            patches.append(cls(content, content_type, content_range))
-            # cut off the parsed patch from the buffer
-            buffer = buffer[headers_length + content_length + len(std_newline) :]
+            self._header = (header + "\r\n\r\n").encode("utf-8")
+        return self._header
 
-        return patches
+    def encode(self) -> bytes:
+        return self.header() + self.data
 
     def __str__(self):
-        p_str = "Content-Length: {}".format(len(self.content))
-        if self.content_type:
-            p_str += "\r\nContent-Type: {}".format(self.content_type)
-        if self.content_range:
-            p_str += "\r\nContent-Range: {} {}".format(
-                self.content_range[0], self.content_range[1]
-            )
-        p_str += "\r\n\r\n{}".format(self.content)
-        return p_str
+        return self.encode().decode("utf-8")
 
     def __repr__(self):
         return "<Patch content_type={} content_range={}>".format(
             self.content_type, self.content_range
         )
 
+    def __eq__(self, other):
+        if not isinstance(other, Patch):
+            return NotImplemented
+        return (
+            bytes(self.data) == bytes(other.data)
+            and self.content_type == other.content_type
+            and self.content_range == other.content_range
+        )
+
+    __hash__ = None
+
+
+class PatchParser:
+    """
+    Incremental parser for a multi-patch body
+    Bytes are fed in arbitrary chunks and complete Patches are returned as soon
+    as their content has arrived. Every byte is scanned once and consumed bytes
+    are dropped from the buffer, so parsing is linear in the body size and memory
+    is bounded by the largest patch rather than the whole body.
+    Content-Length is a byte count.
+    A bytes chunk starting with nothing left over is parsed in place, and the
+    content of the patches it holds whole are memoryviews into it, not copies.
+    """
+
+    # parser states
+    HEADERS = 0
+    CONTENT = 1
+
+    def __init__(self):
+        self.buffer = bytearray()
+        # offset of the first unconsumed byte in buffer
+        self.pos = 0
+        self.state = self.HEADERS
+        self.headers = {}
+
+    def feed(self, chunk: bytes) -> list:
+        """
+        Add bytes to the parser
+        Returns:
+            list of the Patches completed by this chunk
+        """
+        if self.pos >= len(self.buffer) and isinstance(chunk, bytes):
+            # nothing left over, read from the chunk itself
+            self.buffer = chunk
+            self.pos = 0
+        else:
+            if isinstance(self.buffer, bytes):
+                # keep the tail of a chunk parsed in place
+                self.buffer = bytearray(self.buffer[self.pos :])
+                self.pos = 0
+            self.buffer += chunk
+        patches = []
+        while True:
+            if self.state == self.HEADERS:
+                if not self._parse_headers():
+                    break
+            else:
+                patch = self._parse_content()
+                if patch is None:
+                    break
+                patches.append(patch)
+        self._compact()
+        return patches
+
+    def close(self):
+        """
+        Signal the end of the body
+        Raises ValueError if a patch was left incomplete
+        """
+        if self.state == self.CONTENT:
+            raise ValueError("Patch content is shorter than its 'Content-Length'")
+        if self.headers or self.buffer[self.pos :].strip():
+            raise ValueError("Could not parse patches with no end of headers marker")
+
+    def _parse_headers(self) -> bool:
+        """
+        Consume header lines until the blank line ending the patch headers
+        Returns True once the headers are complete
+        """
+        buffer = self.buffer
+        while True:
+            if not self.headers:
+                # skip the newlines separating a patch from the previous one
+                while self.pos < len(buffer) and buffer[self.pos] in b"\r\n":
+                    self.pos += 1
+            newline = buffer.find(b"\n", self.pos)
+            if newline < 0:
+                return False
+            line = bytes(buffer[self.pos : newline]).rstrip(b"\r")
+            self.pos = newline + 1
+            if line:
+                name, _, value = line.decode("latin-1").partition(":")
+                self.headers[name.strip().lower()] = value.strip()
+            elif self.headers:
+                self.state = self.CONTENT
+                return True
 
-class Version(NamedTuple):
+    def _parse_content(self) -> "Patch":
+        """
+        Consume the content of the current patch
+        Returns the Patch, or None if its content has not fully arrived
+        """
+        headers = self.headers
+        if "content-length" not in headers:
+            raise ValueError("No 'Content-Length' header found in patch")
+        content_length = int(headers["content-length"])
+        end = self.pos + content_length
+        if len(self.buffer) < end:
+            return None
+        content_type = headers.get("content-type")
+        content_range = headers.get("content-range")
+        if content_range:
+            content_range = tuple(content_range.split(" ", 1))
+        if not content_type and not content_range:
+            raise ValueError(
+                "No 'Content-Type' or 'Content-Range' header found in patch"
+            )
+        if isinstance(self.buffer, bytes):
+            content = memoryview(self.buffer)[self.pos : end]
+        else:
+            # the buffer is reused, so the content has to be copied out of it
+            content = bytes(self.buffer[self.pos : end])
+        self.pos = end
+        self.state = self.HEADERS
+        self.headers = {}
+        return Patch(content, content_type, content_range)
+
+    def _compact(self):
+        # dropping the consumed prefix only once it outweighs the rest keeps
+        # the amortized cost of compaction linear
+        if isinstance(self.buffer, bytes):
+            return
+        if self.pos and self.pos * 2 >= len(self.buffer):
+            del self.buffer[: self.pos]
+            self.pos = 0
+
+
+class Version(object):
     """
     A Version is a series of patches or a string body
     describing the state of an HTTP resource
+    The body may be str or bytes. Versions are immutable, their header block is
+    encoded on first use and reused by every later encoding.
     """
 
-    version: str
-    parents: list = None
-    merge_type: str = None
-    content_type: str = "application/json"
-    patches: list = None
-    body: str = ""
+    __slots__ = ("version", "parents", "merge_type", "content_type", "patches", "body", "_header")
 
-    def __str__(self):
-        v_str = f"Version: {self.version}"
-        if self.parents:
-            v_str += "\r\nParents: {}".format(",".join(self.parents))
-        if self.merge_type:
-            v_str += "\r\nMerge-Type: {}".format(self.merge_type)
-        if self.content_type:
-            v_str += "\r\nContent-Type: {}".format(self.content_type)
+    def __init__(
+        self,
+        version: str,
+        parents: list = None,
+        merge_type: str = None,
+        content_type: str = "application/json",
+        patches: list = None,
+        body="",
+    ):
+        self.version = version
+        self.parents = parents
+        self.merge_type = merge_type
+        self.content_type = content_type
+        self.patches = patches
+        self.body = body
+        self._header = None
+
+    def parts(self) -> list:
+        """
+        Buffers making up the version's content, in order
+        """
         if self.patches:
-            v_str += "\r\nPatches: {}".format(len(self.patches))
-        content = "".join(str(patch) for patch in self.patches) if self.patches else self.body
-        v_str += "\r\nContent-Length: {}".format(len(content))
-        v_str += f"\r\n\r\n{content}"
-        return v_str
+            parts = []
+            for patch in self.patches:
+                parts.append(patch.header())
+                parts.append(patch.data)
+            return parts
+        body = self.body or b""
+        return [body.encode("utf-8") if isinstance(body, str) else body]
+
+    def header(self, parts: list = None) -> bytes:
+        """
+        Header block of the version, Content-Length counts bytes
+        """
+        if self._header is None:
+            if parts is None:
+                parts = self.parts()
+            header = f"Version: {self.version}"
+            if self.parents:
+                header += "\r\nParents: {}".format(",".join(self.parents))
+            if self.merge_type:
+                header += "\r\nMerge-Type: {}".format(self.merge_type)
+            if self.content_type:
+                header += "\r\nContent-Type: {}".format(self.content_type)
+            if self.patches:
+                header += "\r\nPatches: {}".format(len(self.patches))
+            header += "\r\nContent-Length: {}".format(sum(len(part) for part in parts))
+            self._header = (header + "\r\n\r\n").encode("utf-8")
+        return self._header
+
+    def encode(self) -> bytes:
+        """
+        Encode the version to its wire format
+        Broadcasts encode once and share the resulting immutable buffer
+        between all subscriber queues. Patch contents are copied straight
+        from the request buffer, nothing is decoded.
+        """
+        parts = self.parts()
+        return b"".join([self.header(parts)] + parts)
+
+    def __str__(self):
+        return self.encode().decode("utf-8")
 
     def __repr__(self):
         return f"<Version id={self.version}>"
 
+    def __eq__(self, other):
+        if not isinstance(other, Version):
+            return NotImplemented
+        return all(
+            getattr(self, name) == getattr(other, name) for name in self.__slots__[:-1]
+        )
+
+    __hash__ = None
+
+    def _asdict(self) -> dict:
+        return {name: getattr(self, name) for name in self.__slots__[:-1]}
+
+    def dumps(self) -> str:
+        """
+        Serialize the version to JSON, see loads()
+        """
+        data = self._asdict()
+        if self.patches is not None:
+            data["patches"] = [
+                [patch.content, patch.content_type, patch.content_range]
+                for patch in self.patches
+            ]
+        if isinstance(self.body, (bytes, bytearray, memoryview)):
+            data["body"] = bytes(self.body).decode("utf-8")
+        return json.dumps(data)
+
+    @classmethod
+    def loads(cls, data: str) -> "Version":
+        """
+        Version serialized with dumps()
+        """
+        data = json.loads(data)
+        if data.get("patches") is not None:
+            data["patches"] = [
+                Patch(
+                    content,
+                    content_type,
+                    tuple(content_range) if content_range else None,
+                )
+                for content, content_type, content_range in data["patches"]
+            ]
+        return cls(**data)
+
+    def collapsed(self) -> "Version":
+        """
+        Drop the patches overwritten by the next one
+        Within a run of consecutive JSON patches to the same range, only the
+        last one is kept. Other units, such as text, address positions
+        that shift with every edit and are never collapsed.
+        Returns:
+            a new Version, or this one if nothing was dropped
+        """
+        if not self.patches or len(self.patches) < 2:
+            return self
+        patches = []
+        for patch in self.patches:
+            if (
+                patches
+                and patch.content_range is not None
+                and patch.content_range[0] == "json"
+                and patches[-1].content_range == patch.content_range
+            ):
+                patches[-1] = patch
+            else:
+                patches.append(patch)
+        if len(patches) == len(self.patches):
+            return self
+        return Version(
+            self.version,
+            self.parents,
+            self.merge_type,
+            self.content_type,
+            patches,
+            self.body,
+        )
+
+    def declared_content_type(self) -> str:
+        """
+        Content-Type declared by the version, or else the one all of its patches declare
+        Nothing is parsed, this is metadata only
+        """
+        if self.content_type or not self.patches:
+            return self.content_type
+        content_types = {patch.content_type for patch in self.patches}
+        if len(content_types) == 1:
+            return content_types.pop()
+        return None
+
     def is_valid_json(self):
         """
-        Checks if the body or stringified patches is valid JSON
+        Checks if the body, or the content of every patch, is valid JSON
         Returns:
             bool
         """
-        content = (
-            self.body
-            if self.patches is None
-            else "".join(str(patch) for patch in self.patches)
-        )
+        contents = [self.body] if self.patches is None else [p.content for p in self.patches]
         try:
-            json.loads(content)
+            for content in contents:
+                json.loads(content)
             return True
-        except ValueError:
+        except (TypeError, ValueError):
             return False
 
 
+# Content-Type validation modes
+VALIDATE_ONCE = "once"
+VALIDATE_SAMPLED = "sampled"
+
+
+class ContentTypes(object):
+    """
+    Picks the Content-Type header of a version's response
+    The declared type is trusted by default. JSON can be validated once per
+    version of a resource with the result cached, or for a sampled fraction of responses,
+    and the header is omitted when the content is not JSON after all.
+    """
+
+    def __init__(self, validate: str = None, sample_rate: float = 0.01, max_cached: int = 4096):
+        """
+        Args:
+            validate: None, VALIDATE_ONCE or VALIDATE_SAMPLED
+            sample_rate: fraction of responses validated by VALIDATE_SAMPLED
+            max_cached: versions whose result VALIDATE_ONCE remembers
+        """
+        if validate not in (None, VALIDATE_ONCE, VALIDATE_SAMPLED):
+            raise ValueError(f"Unknown validation mode '{validate}'")
+        self.validate = validate
+        self.sample_rate = sample_rate
+        self.max_cached = max_cached
+        # (resource, version id) -> valid JSON
+        self.checked = {}
+        self.lock = threading.Lock()
+
+    def __call__(self, version: Version, resource: str = None) -> str:
+        content_type = version.declared_content_type()
+        if self.validate is None or content_type != "application/json":
+            return content_type
+        if self.validate == VALIDATE_SAMPLED:
+            if random.random() >= self.sample_rate:
+                return content_type
+            valid = self._check(version)
+        else:
+            key = (resource, version.version)
+            valid = self.checked.get(key)
+            if valid is None:
+                valid = self._check(version)
+                with self.lock:
+                    if len(self.checked) >= self.max_cached:
+                        # forget the oldest result
+                        del self.checked[next(iter(self.checked))]
+                    self.checked[key] = valid
+        if not valid:
+            return None
+        return content_type
+
+    @staticmethod
+    def _check(version: Version) -> bool:
+        valid = version.is_valid_json()
+        if not valid:
+            print(f"Version {version.version} declares JSON content but is not valid JSON", file=sys.stderr)
+        return valid
+
+
+# Overflow policies of bounded subscription queues
+DROP_OLDEST = "drop-oldest"
+COALESCE = "coalesce"
+DISCONNECT = "disconnect"
+
+
+class QueueLimits(NamedTuple):
+    """
+    Bounds of a subscription send queue and what to do when they are exceeded
+    max_versions: queued versions allowed, None for no limit
+    max_bytes: queued bytes allowed, None for no limit
+    overflow: DROP_OLDEST drops the oldest queued versions,
+        COALESCE replaces the queue with a single snapshot of the resource,
+        DISCONNECT closes the subscription
+    snapshot: callable(resource) returning the current Version (or its dict/bytes),
+        required by COALESCE
+    """
+
+    max_versions: int = None
+    max_bytes: int = None
+    overflow: str = DROP_OLDEST
+    snapshot: object = None
+
+
 class Subscription:
     """
     A subscription is a stream of data that is sent to a subscribed client
     When another client advertises a new version, the subscription is appended with
     the new version and all subscribers are notified.
 
-    NOTE: currently a single subscription is allowed per request.path + request.remote_addr
+    The stream blocks on a condition variable and only wakes when data is
+    appended, the subscription is closed, or the heartbeat timeout elapses.
+    A heartbeat writes a blank line so a disconnected client is detected
+    on the next write instead of lingering until the next advertise.
+    Heartbeats are either timed by the subscription itself or requested with
+    probe() by a lifecycle.LifecycleManager, which also expires subscriptions
+    whose stream stopped renewing them.
+
+    The send queue is bounded by QueueLimits, so a slow consumer cannot grow
+    server memory without limit. Each wake-up drains everything queued, up to
+    max_batch bytes, into a single write.
+
+    A peer may hold any number of subscriptions, to one resource or several,
+    each identified by a SubscriberId. A multiplexed subscription streams the
+    versions of many resources at once, each tagged with a Resource header,
+    and resources can be added to or removed from it while it streams.
     """
 
-    def __init__(self, request, s_id, closed_cb):
+    HEARTBEAT_FRAME = b"\r\n"
+    # every compressed stream keeps its own zlib state, a window of 2**13 and
+    # memLevel 6 cost about 64KB per subscription instead of zlib's default 256KB
+    COMPRESS_LEVEL = 6
+    COMPRESS_WINDOW_BITS = 13
+    COMPRESS_MEM_LEVEL = 6
+
+    def __init__(
+        self,
+        request,
+        s_id,
+        closed_cb,
+        heartbeat: float = None,
+        limits: QueueLimits = None,
+        max_batch: int = 65536,
+        metrics=None,
+        encoding: str = None,
+        resources: list = None,
+    ):
+        """
+        Args:
+            encoding: "gzip" or "deflate" to compress the stream, see negotiate_encoding()
+            resources: resources to multiplex over the stream, None streams the
+                requested resource only
+        """
         self.s_id = s_id
+        self.peer = getattr(s_id, "peer", None)
         # can change later, resource ID can be decided by the user
         self.resource = request.path
-        self.send_queue = []
+        # resources whose versions are streamed, updated by the registry
+        self.multiplexed = resources is not None
+        self.resources = set(resources) if self.multiplexed else {self.resource}
+        # identifies a multiplexed stream to the requests changing its resources
+        self.multiplex_id = secrets.token_urlsafe(16) if self.multiplexed else None
+        self.send_queue = deque()
+        # ids of the versions queued by history replay, their live copies are skipped
+        self.replayed = set()
         self.active = True
         self.closed_cb = closed_cb
+        # seconds of inactivity before a heartbeat frame is sent, None disables
+        self.heartbeat = heartbeat
+        # bytes written per wake-up, a single larger version is still sent whole
+        self.max_batch = max_batch
+        self.limits = limits or QueueLimits()
+        if self.limits.overflow == COALESCE and self.limits.snapshot is None:
+            raise ValueError("The 'coalesce' overflow policy requires a snapshot callable")
+        # set when the queue was coalesced, the snapshot is taken when it is sent
+        self.snapshot_pending = False
+        self.queued_bytes = 0
+        # lag counters
+        self.high_water = 0
+        self.dropped = 0
+        self.overflows = 0
+        # last time the stream completed a write or the subscription was renewed
+        self.renewed = time.monotonic()
+        # set by probe(), the next write is a heartbeat frame
+        self.probe_pending = False
+        # metrics.Metrics recording queue depth and bytes of every write
+        self.metrics = metrics
+        # one compression context for the whole stream, so the keys and
+        # headers repeated by every version compress against earlier ones
+        self.encoding = encoding
+        self.compressor = None
+        if encoding is not None:
+            if encoding not in ("gzip", "deflate"):
+                raise ValueError(f"Unsupported stream encoding '{encoding}'")
+            window_bits = self.COMPRESS_WINDOW_BITS + (16 if encoding == "gzip" else 0)
+            self.compressor = zlib.compressobj(
+                self.COMPRESS_LEVEL, zlib.DEFLATED, window_bits, self.COMPRESS_MEM_LEVEL
+            )
+        self.ready = threading.Condition()
 
     def stream(self):
         """
@@ -152,37 +608,385 @@ class Subscription:
         def _stream():
             try:
                 # While client connected
-                # TODO: is this the best way to keep a conn. alive? Two while loops?
                 while self.active:
-                    while len(self.send_queue) > 0:
-                        data = self.send_queue.pop(0)
-                        yield data
+                    data = self.next()
+                    if data is not None:
+                        yield self.encode_frame(data)
                 self.close()
                 # Exception thrown when client disconnects
-                # NOTE: the generator will never terminate until
-                # the client disconnects and a yield is invoked
-                # TODO: is a heartbeat necessary to avoid zombie streams?
-                # TODO: implement a way for subscriptions to have n minute lifetimes for renewals
+                # NOTE: the generator terminates on close() or on the first
+                # failed write, which the heartbeat guarantees will happen
             except GeneratorExit:
                 print("client disconnected", file=sys.stdout)
                 self.close()
 
-        return Response(stream_with_context(_stream()))
+        headers = {}
+        if self.encoding is not None:
+            headers["Content-Encoding"] = self.encoding
+            headers["Vary"] = "Accept-Encoding"
+        if self.multiplexed:
+            headers["Multiplex-Id"] = self.multiplex_id
+        return Response(stream_with_context(_stream()), headers=headers)
 
-    def append(self, data: str):
+    def encode_frame(self, data: bytes) -> bytes:
         """
-        Queue string data to be streamed to the client
+        Compress a write with the stream's encoding, if any
+        Each write is flushed, so the client can decode it as soon as it arrives
         """
+        if self.compressor is None:
+            return data
+        return self.compressor.compress(data) + self.compressor.flush(zlib.Z_SYNC_FLUSH)
+
+    def next(self):
+        """
+        Block until data is queued, the subscription closes or the heartbeat elapses
+        Called again once the previous write completed, which renews the subscription
+        Returns:
+            queued data, a heartbeat frame, or None when closed
+        """
+        self.renewed = time.monotonic()
+        with self.ready:
+            while self.active and not self.pending() and not self.probe_pending:
+                if not self.ready.wait(timeout=self.heartbeat):
+                    # idle for a full heartbeat interval, probe the client
+                    return self.HEARTBEAT_FRAME
+            probe, self.probe_pending = self.probe_pending, False
+            if probe and self.active and not self.pending():
+                return self.HEARTBEAT_FRAME
+            return self.dequeue()
+
+    def probe(self):
+        """
+        Send a heartbeat frame unless data is about to be written anyway
+        """
+        with self.ready:
+            self.probe_pending = True
+            self.ready.notify()
+
+    def pending(self) -> bool:
+        return bool(self.send_queue) or self.snapshot_pending
+
+    def dequeue(self):
+        """
+        Pop the queued data to send in one write, None if nothing is queued
+        The caller must hold the queue lock
+        """
+        depth = len(self.send_queue)
+        data = self._dequeue()
+        if self.metrics is not None and data is not None:
+            self.metrics.observe(QUEUE_DEPTH, depth)
+            self.metrics.observe(BYTES_SENT, len(data))
+        return data
+
+    def _dequeue(self):
+        if self.snapshot_pending:
+            self.snapshot_pending = False
+            if self.multiplexed:
+                return b"".join(
+                    tag_resource(resource, self._snapshot(resource))
+                    for resource in list(self.resources)
+                )
+            return self._snapshot(self.resource)
+        if not self.send_queue:
+            return None
+        data = self.send_queue.popleft()
+        size = len(data)
+        if not self.send_queue or size + len(self.send_queue[0]) > self.max_batch:
+            # nothing to coalesce, send the shared buffer without copying it
+            self.queued_bytes -= size
+            return data
+        batch = [data]
+        while self.send_queue and size + len(self.send_queue[0]) <= self.max_batch:
+            data = self.send_queue.popleft()
+            size += len(data)
+            batch.append(data)
+        self.queued_bytes -= size
+        return b"".join(batch)
+
+    def _snapshot(self, resource: str) -> bytes:
+        snapshot = self.limits.snapshot(resource)
+        if isinstance(snapshot, dict):
+            snapshot = Version(**snapshot)
+        return snapshot.encode() if isinstance(snapshot, Version) else snapshot
+
+    def enqueue(self, data: bytes) -> bool:
+        """
+        Queue data and apply the overflow policy
+        The caller must hold the queue lock
+        Returns:
+            False if the subscription must be disconnected
+        """
+        if not self.active:
+            return True
+        if self.snapshot_pending:
+            # the snapshot is taken at send time and will include this version
+            self.dropped += 1
+            return True
         self.send_queue.append(data)
+        self.queued_bytes += len(data)
+        self.high_water = max(self.high_water, len(self.send_queue))
+        if not self.over_limit():
+            return True
+        self.overflows += 1
+        if self.limits.overflow == DISCONNECT:
+            return False
+        if self.limits.overflow == COALESCE:
+            self.dropped += len(self.send_queue)
+            self.send_queue.clear()
+            self.queued_bytes = 0
+            self.snapshot_pending = True
+        else:
+            # always keep the newest version, even if it alone exceeds max_bytes
+            while self.over_limit() and len(self.send_queue) > 1:
+                self.queued_bytes -= len(self.send_queue.popleft())
+                self.dropped += 1
+        return True
+
+    def over_limit(self) -> bool:
+        limits = self.limits
+        return (
+            limits.max_versions is not None and len(self.send_queue) > limits.max_versions
+        ) or (limits.max_bytes is not None and self.queued_bytes > limits.max_bytes)
+
+    @property
+    def lagging(self) -> bool:
+        """
+        True while the queue holds more than half of its limit
+        """
+        limits = self.limits
+        return self.snapshot_pending or (
+            limits.max_versions is not None
+            and len(self.send_queue) * 2 > limits.max_versions
+        ) or (limits.max_bytes is not None and self.queued_bytes * 2 > limits.max_bytes)
+
+    def stats(self) -> dict:
+        """
+        Queue depth and lag counters
+        """
+        return {
+            "id": str(self.s_id),
+            "peer": self.peer,
+            "resource": self.resource,
+            "resources": len(self.resources),
+            "queued": len(self.send_queue),
+            "queued_bytes": self.queued_bytes,
+            "high_water": self.high_water,
+            "dropped": self.dropped,
+            "overflows": self.overflows,
+            "lagging": self.lagging,
+        }
+
+    def append(self, data: bytes):
+        """
+        Queue encoded data to be streamed to the client
+        The same buffer may be shared with other subscriptions, it is never copied
+        """
+        with self.ready:
+            keep = self.enqueue(data)
+            self.ready.notify()
+        if not keep:
+            print(f"subscription {self.s_id} fell behind, disconnecting", file=sys.stdout)
+            self.close()
 
     def close(self):
         """
         Close the stream
         """
-        self.active = False
+        with self.ready:
+            if not self.active:
+                return
+            self.active = False
+            self.ready.notify_all()
         self.closed_cb()
 
 
+class SubscriptionRegistry:
+    """
+    Index of live subscriptions by subscriber ID, by resource and by peer
+    Fan-out only visits the subscribers of the advertised resource,
+    so its cost does not grow with unrelated subscriptions. A multiplexed
+    subscription is indexed under each of its resources.
+    """
+
+    def __init__(self):
+        self.by_id = {}
+        # resource -> {s_id: Subscription}
+        self.by_resource = {}
+        # peer -> {s_id: Subscription}
+        self.by_peer = {}
+        # multiplex_id -> Subscription
+        self.by_multiplex_id = {}
+        self.lock = threading.Lock()
+
+    def add(self, subscription):
+        """
+        Register a subscription
+        Returns:
+            the subscription previously registered under the same ID, or None
+        """
+        with self.lock:
+            replaced = self.by_id.get(subscription.s_id)
+            if replaced is not None:
+                self._unlink(replaced)
+            self.by_id[subscription.s_id] = subscription
+            for resource in subscription.resources:
+                self.by_resource.setdefault(resource, {})[subscription.s_id] = subscription
+            if subscription.multiplexed:
+                self.by_multiplex_id[subscription.multiplex_id] = subscription
+            self.by_peer.setdefault(subscription.peer, {})[
+                subscription.s_id
+            ] = subscription
+            return replaced
+
+    def remove(self, subscription):
+        """
+        Unregister a subscription
+        A no-op if the subscription was already replaced or removed, so a stale
+        closed_cb can never evict the subscription that replaced it
+        """
+        with self.lock:
+            if self.by_id.get(subscription.s_id) is subscription:
+                self._unlink(subscription)
+
+    def discard(self, s_id):
+        """
+        Unregister the subscription with an ID
+        Returns:
+            the subscription, None if there was none
+        """
+        with self.lock:
+            subscription = self.by_id.get(s_id)
+            if subscription is not None:
+                self._unlink(subscription)
+            return subscription
+
+    def discard_peer(self, peer) -> list:
+        """
+        Unregister every subscription of a peer
+        Returns:
+            the unregistered subscriptions, still open
+        """
+        with self.lock:
+            subscriptions = list(self.by_peer.get(peer, {}).values())
+            for subscription in subscriptions:
+                self._unlink(subscription)
+            return subscriptions
+
+    def discard_resource(self, resource: str) -> list:
+        """
+        Unregister every subscription to a resource
+        Multiplexed subscriptions only stop streaming the resource and keep
+        the others, they are not returned
+        Returns:
+            the unregistered subscriptions, still open
+        """
+        with self.lock:
+            subscriptions = []
+            for subscription in list(self.by_resource.get(resource, {}).values()):
+                if subscription.multiplexed:
+                    self._unlink_resource(subscription, resource)
+                else:
+                    self._unlink(subscription)
+                    subscriptions.append(subscription)
+            return subscriptions
+
+    def multiplexed(self, multiplex_id: str):
+        """
+        The multiplexed subscription with an ID, None if there is none
+        """
+        return self.by_multiplex_id.get(multiplex_id)
+
+    def link(self, subscription, resource: str) -> bool:
+        """
+        Add a resource to a registered multiplexed subscription
+        Returns:
+            False if the subscription is no longer registered
+        """
+        with self.lock:
+            if self.by_id.get(subscription.s_id) is not subscription:
+                return False
+            subscription.resources.add(resource)
+            self.by_resource.setdefault(resource, {})[subscription.s_id] = subscription
+            return True
+
+    def unlink(self, subscription, resource: str) -> bool:
+        """
+        Remove a resource from a registered multiplexed subscription
+        The subscription stays open, even without any resource left
+        Returns:
+            False if the subscription is no longer registered
+        """
+        with self.lock:
+            if self.by_id.get(subscription.s_id) is not subscription:
+                return False
+            self._unlink_resource(subscription, resource)
+            return True
+
+    def _unlink_resource(self, subscription, resource: str):
+        subscription.resources.discard(resource)
+        subscribers = self.by_resource.get(resource)
+        if subscribers is not None:
+            subscribers.pop(subscription.s_id, None)
+            if not subscribers:
+                del self.by_resource[resource]
+
+    def _unlink(self, subscription):
+        del self.by_id[subscription.s_id]
+        if subscription.multiplexed:
+            self.by_multiplex_id.pop(subscription.multiplex_id, None)
+        for resource in subscription.resources:
+            subscribers = self.by_resource.get(resource)
+            if subscribers is not None:
+                subscribers.pop(subscription.s_id, None)
+                if not subscribers:
+                    del self.by_resource[resource]
+        subscribers = self.by_peer.get(subscription.peer)
+        if subscribers is not None:
+            subscribers.pop(subscription.s_id, None)
+            if not subscribers:
+                del self.by_peer[subscription.peer]
+
+    def for_resource(self, resource: str) -> list:
+        """
+        Snapshot of the subscriptions to a resource
+        """
+        with self.lock:
+            return list(self.by_resource.get(resource, {}).values())
+
+    def for_peer(self, peer) -> list:
+        """
+        Snapshot of the subscriptions of a peer
+        """
+        with self.lock:
+            return list(self.by_peer.get(peer, {}).values())
+
+    def get(self, s_id, default=None):
+        return self.by_id.get(s_id, default)
+
+    def lagging(self) -> list:
+        """
+        Stats of the subscriptions falling behind, deepest queue first
+        """
+        stats = [s.stats() for s in self.values() if s.lagging]
+        return sorted(stats, key=lambda stat: stat["queued_bytes"], reverse=True)
+
+    def values(self):
+        with self.lock:
+            return list(self.by_id.values())
+
+    def __getitem__(self, s_id):
+        return self.by_id[s_id]
+
+    def __contains__(self, s_id):
+        return s_id in self.by_id
+
+    def __iter__(self):
+        return iter(self.values())
+
+    def __len__(self):
+        return len(self.by_id)
+
+
 # Util functions
 def generate_patch_stream_string(patches: list) -> str:
     """
@@ -210,49 +1014,134 @@ def is_true(value: str) -> bool:
     return value.lower() in ("true", "True", "t", "T" "1")
 
 
-def subscriber_id(request) -> str:
+def split_header_list(value: str) -> list:
     """
-    Hashes Flask request object remote_address as a subscriber ID
-    TODO: make this more robust to avoid collisions
+    Split a comma separated header value such as Parents into its items
     """
-    return hash((request.remote_addr, request.path))
+    if not value:
+        return []
+    return [item.strip() for item in value.split(",") if item.strip()]
 
 
-def parse_patches():
+def encoded_version_id(data: bytes) -> str:
     """
-    Parse patches from request
-    Flask will read the patches as an incoming stream
+    Version id of an encoded version, read from its leading Version header
+    """
+    prefix = b"Version: "
+    if not data.startswith(prefix):
+        return None
+    end = data.find(b"\r\n", len(prefix))
+    if end < 0:
+        return None
+    return bytes(data[len(prefix) : end]).decode("utf-8")
+
+
+def tag_resource(resource: str, data: bytes) -> bytes:
+    """
+    Prefix an encoded version with the Resource header of a multiplexed stream
+    The header becomes part of the version's header block.
+    """
+    return f"Resource: {resource}\r\n".encode("utf-8") + data
+
+
+def negotiate_encoding(accept_encoding: str) -> str:
+    """
+    Pick a stream compression from an Accept-Encoding header
+    Returns:
+        "gzip", "deflate", or None to send the stream uncompressed
+    """
+    accepted = {}
+    for item in split_header_list(accept_encoding):
+        coding, _, params = item.partition(";")
+        q = 1.0
+        params = params.strip()
+        if params.startswith("q="):
+            try:
+                q = float(params[2:])
+            except ValueError:
+                q = 0
+        accepted[coding.strip().lower()] = q
+    for coding in ("gzip", "deflate"):
+        if accepted.get(coding, 0) > 0:
+            return coding
+    return None
+
+
+class SubscriberId(NamedTuple):
+    """
+    Identity of a subscription
+    The peer is the client's Peer header, or its address if it sent none. The
+    connection token tells apart the subscriptions a peer opens concurrently,
+    even from behind the same proxy or NAT address.
+    """
+
+    peer: str
+    connection: str
+    resource: str
+
+    def __str__(self):
+        return f"{self.peer}/{self.connection}{self.resource}"
+
+
+# tokens for servers which do not report the client's port
+_connection_tokens = itertools.count(1)
+
+
+def subscriber_id(request) -> SubscriberId:
+    """
+    Identifies a subscription by its peer, connection and resource
+    A connection streams one response at a time, so a subscription can only
+    collide with an earlier one of the same connection, which must be dead.
+    """
+    port = getattr(request, "remote_port", None)
+    if port is None:
+        environ = getattr(request, "environ", None) or {}
+        port = environ.get("REMOTE_PORT")
+    if port is None:
+        connection = f"#{next(_connection_tokens)}"
+    else:
+        connection = f"{request.remote_addr}:{port}"
+    return SubscriberId(request.peer or request.remote_addr, connection, request.path)
+
+
+def iter_patches():
+    """
+    Lazily parse patches from request
+    Flask will read the patches as an incoming stream, each patch is
+    yielded as soon as it is complete
     """
     num_patches = int(request.headers.get("patches", -1))
-    if num_patches < 0:
+    if num_patches <= 0:
         # if no patches are specified, ignore
         return
-    buffer = ""
-    patches = []
-    if num_patches == 0:
-        return patches
-    while True:
-        # Read a line from the stream
-        chunk = request.stream.read()
-        if not chunk:
-            # end of stream
+    count = 0
+    for patch in Patch.iter_from_stream(request.stream, request.content_length):
+        count += 1
+        if count > num_patches:
             break
-        buffer += chunk.decode("utf-8")
-        # buffer is sliced after each patch is parsed
-        # read while buffer is not empty (ie. patches still exist)
-    patches = Patch.list_from_buffer(buffer)
-    if len(patches) != num_patches:
+        yield patch
+    if count != num_patches:
         raise RuntimeError(
             "Number of patches does not match number given in 'Patches' header"
         )
-    return patches
+
+
+def parse_patches():
+    """
+    Parse patches from request
+    Flask will read the patches as an incoming stream
+    """
+    num_patches = int(request.headers.get("patches", -1))
+    if num_patches < 0:
+        # if no patches are specified, ignore
+        return
+    return list(iter_patches())
 
 
 """
 Temporary functions for testing
 Should not be included in production code
 """
-import threading, time
 
 
 def generate_articial_subscription_data(subscription):
@@ -272,7 +1161,7 @@ def generate_articial_subscription_data(subscription):
     def gen_data():
         while subscription.active:
             time.sleep(1)
-            subscription.append(str(version))
+            subscription.append(version.encode())
 
     thread = threading.Thread(target=gen_data)
     thread.start()
\ No newline at end of file
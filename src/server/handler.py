@@ -0,0 +1,386 @@
+"""
+Braid request handling shared by the Flask and ASGI adapters
+Everything here takes the request explicitly, the adapters only translate
+between their framework and these methods.
+"""
+
+import json
+import time
+import threading
+from core import (
+    ContentTypes,
+    QueueLimits,
+    Subscription,
+    SubscriptionRegistry,
+    Version,
+    encoded_version_id,
+    negotiate_encoding,
+    split_header_list,
+    subscriber_id,
+    tag_resource,
+)
+from cache import CachedResponse, ResponseCache, etag_matches
+from history import MemoryHistory
+from lifecycle import LifecycleManager
+from metrics import (
+    ADVERTISE,
+    FANOUT,
+    PARSE,
+    VERSION_FROM_REQUEST,
+    Metrics,
+)
+from merge import MergeEngine
+from pubsub import LocalBroker
+from store import MemoryStore
+
+
+class BraidHandler(object):
+    """
+    Base class of the Braid middlewares
+    Subclasses set subscription_class, and implement response() and
+    parse_patches() for their framework. Request headers are read with
+    lowercase names, which both frameworks accept.
+    """
+
+    subscription_class = Subscription
+    # locks shared by the resources hashing to the same stripe
+    RESOURCE_LOCKS = 64
+    # dispatch(fn, *args) running the lifecycle manager's subscription calls,
+    # None calls them from its own thread
+    dispatch = None
+
+    def __init__(
+        self,
+        app,
+        heartbeat: float = 30,
+        history=None,
+        limits: QueueLimits = None,
+        max_batch: int = 65536,
+        broker=None,
+        cache: ResponseCache = None,
+        validate_json: str = None,
+        ttl: float = None,
+        metrics: Metrics = None,
+        metrics_route: str = None,
+        compress: bool = False,
+        collapse_patches: bool = False,
+        multiplex_route: str = None,
+        store=None,
+    ):
+        """
+        Args:
+            app: wrapped application
+            heartbeat: seconds an idle subscription waits before sending a heartbeat frame
+            history: history.History backend used to replay missed versions
+                to reconnecting subscribers, defaults to MemoryHistory
+            limits: core.QueueLimits bounding each subscription's send queue
+            max_batch: bytes of queued versions coalesced into a single stream write
+            broker: pubsub.Broker carrying advertised versions to the subscribers
+                held by other processes, defaults to LocalBroker
+            cache: cache.ResponseCache serving repeated plain GETs from before the
+                route runs, per path and query string, None serves every GET from the
+                route. Only cache routes that advertise every change of their resources
+            validate_json: core.VALIDATE_ONCE or core.VALIDATE_SAMPLED to check that
+                JSON responses really are JSON, by default the declared Content-Type is trusted
+            ttl: seconds a subscription lives without a completed write or
+                renewal before it is closed, None keeps it until the client disconnects
+            metrics: metrics.Metrics recording the hot path timings, defaults to a new Metrics
+            metrics_route: path at which the metrics are served as JSON, None serves nothing
+            compress: compress subscription streams with gzip or deflate when the
+                subscribe request accepts it
+            collapse_patches: drop the JSON patches of an advertised version that
+                the next patch to the same range overwrites, see Version.collapsed()
+            multiplex_route: path at which many resources are streamed over one
+                subscription, see multiplex_response(), None serves nothing
+            store: store.Store holding the state of each resource, routes commit
+                versions to it with request.commit_version(), defaults to MemoryStore
+        """
+        self.app = app
+        self.heartbeat = heartbeat
+        self.limits = limits
+        self.max_batch = max_batch
+        self.compress = compress
+        self.collapse_patches = collapse_patches
+        self.broker = broker if broker is not None else LocalBroker()
+        self.history = history if history is not None else MemoryHistory()
+        self.store = store if store is not None else MemoryStore()
+        self.documents = MergeEngine()
+        self.cache = cache or None
+        self.content_types = ContentTypes(validate_json)
+        self.metrics = metrics if metrics is not None else Metrics()
+        self.metrics_route = metrics_route
+        self.multiplex_route = multiplex_route
+        self.subscriptions = SubscriptionRegistry()
+        # serialize registering and replaying a subscription with deliver()
+        self.resource_locks = [threading.RLock() for _ in range(self.RESOURCE_LOCKS)]
+        # heartbeats, expires and reaps subscriptions, see lifecycle.stats()
+        self.lifecycle = LifecycleManager(
+            self.subscriptions, heartbeat=heartbeat, ttl=ttl, dispatch=self.dispatch
+        )
+
+    def response(self, body: bytes = b"", status: int = 200, headers: dict = None):
+        """
+        Framework response for an encoded body
+        """
+        raise NotImplementedError
+
+    def parse_patches(self, request):
+        """
+        Patches of a PUT request, None if it has no Patches header
+        """
+        raise NotImplementedError
+
+    def version_response(self, version: Version):
+        """
+        Response for a single version outside of any request
+        """
+        headers = {}
+        content_type = version.declared_content_type()
+        if content_type:
+            headers["Content-Type"] = content_type
+        return self.response(version.encode(), headers=headers)
+
+    def resource_lock(self, resource: str) -> threading.RLock:
+        return self.resource_locks[hash(resource) % len(self.resource_locks)]
+
+    def subscribe(self, request) -> Subscription:
+        """
+        Open the subscription of a subscribe GET and queue the versions its client missed
+        Sets request.subscription, and request.caught_up which tells the route
+        the client only needs the stream, not a full snapshot of the resource.
+        A version delivered meanwhile is queued either before the subscription
+        is registered, and then read from the history, or after the replay.
+        """
+        with self.resource_lock(request.path):
+            request.subscription = self.open_subscription(request)
+            request.caught_up = self.replay_history(request, request.subscription)
+        return request.subscription
+
+    def open_subscription(self, request, resources: list = None) -> Subscription:
+        """
+        Register a subscription for a request
+        Args:
+            resources: resources to multiplex over the stream, None subscribes
+                to the requested resource only
+        """
+        s_id = subscriber_id(request)
+        encoding = None
+        if self.compress:
+            encoding = negotiate_encoding(request.headers.get("accept-encoding"))
+        subscription = self.subscription_class(
+            request,
+            s_id,
+            lambda: self.subscriptions.remove(subscription),
+            # heartbeats are sent by the lifecycle manager
+            limits=self.limits,
+            max_batch=self.max_batch,
+            metrics=self.metrics,
+            encoding=encoding,
+            resources=resources,
+        )
+        replaced = self.subscriptions.add(subscription)
+        self.lifecycle.start()
+        if replaced is not None:
+            # Kill the earlier subscription of this connection,
+            # a connection can only stream one response at a time
+            replaced.close()
+        return subscription
+
+    def multiplex_response(self, request):
+        """
+        Multiplex route
+        A subscribe GET streams the versions of every resource listed in its
+        Resources header over one connection, each version tagged with a
+        Resource header. The Multiplex-Id response header identifies the stream
+        to later POST and DELETE requests, which add and remove the resources
+        listed in their own Resources header.
+        """
+        resources = split_header_list(request.headers.get("resources"))
+        if request.method == "GET":
+            if not request.subscribe:
+                return self.response(b"Multiplexed streams require a Subscribe header", 400)
+            request.subscription = self.open_subscription(request, resources)
+            return request.subscription.stream()
+        if request.method not in ("POST", "DELETE"):
+            return self.response(status=405, headers={"Allow": "GET, POST, DELETE"})
+        subscription = self.subscriptions.multiplexed(request.headers.get("multiplex-id"))
+        if subscription is None:
+            return self.response(b"Unknown Multiplex-Id", 404)
+        change = self.subscriptions.link if request.method == "POST" else self.subscriptions.unlink
+        for resource in resources:
+            change(subscription, resource)
+        return self.response(status=204)
+
+    def advertise_version(self, version: Version, resource: str):
+        """
+        Advertise a resource update to all the subscribers of a resource
+        """
+        start = time.perf_counter()
+        if isinstance(version, dict):
+            version = Version(**version)
+        if self.collapse_patches:
+            version = version.collapsed()
+        self.history.add(resource, version)
+        # serialize once, every subscriber queue shares the same buffer
+        self.broker.publish(resource, version.encode())
+        self.metrics.observe(ADVERTISE, time.perf_counter() - start)
+
+    def deliver(self, resource: str, data: bytes):
+        """
+        Queue an encoded version published by any process on the local subscriptions
+        """
+        start = time.perf_counter()
+        if self.cache is not None:
+            self.cache.invalidate(resource)
+        # tagged once, every multiplexed stream shares the same buffer
+        tagged = None
+        version_id = None
+        with self.resource_lock(resource):
+            for subscription in self.subscriptions.for_resource(resource):
+                if subscription.replayed:
+                    # the history was read after this version was added
+                    if version_id is None:
+                        version_id = encoded_version_id(data)
+                    if version_id in subscription.replayed:
+                        subscription.replayed.discard(version_id)
+                        continue
+                if subscription.multiplexed:
+                    if tagged is None:
+                        tagged = tag_resource(resource, data)
+                    subscription.append(tagged)
+                else:
+                    subscription.append(data)
+        self.metrics.observe(FANOUT, time.perf_counter() - start)
+
+    def merge_version(self, version: Version, resource: str, initial=None):
+        """
+        Merge a version into the document of a resource with its Merge-Type
+        Args:
+            initial: state of the resource before any merged version
+        Returns:
+            merge.Document, its value is the merged state
+        """
+        return self.documents.apply(resource, version, initial)
+
+    def commit_version(self, version: Version, resource: str, advertise: bool = False):
+        """
+        Apply a version to the state of a resource in the store
+        Args:
+            advertise: advertise the version once the store made it durable,
+                concurrent commits are advertised in the order they were committed
+        Returns:
+            store.State, once the store made it durable
+        """
+        on_commit = None
+        if advertise:
+            on_commit = lambda state: self.advertise_version(version, resource)
+        return self.store.commit(resource, version, on_commit)
+
+    def version_from_request(self, request):
+        """
+        Extract version metadata and body from request
+        """
+        version = request.headers.get("version")
+        if version is None:
+            return
+        start = time.perf_counter()
+        parents = split_header_list(request.headers.get("parents")) or None
+        content_type = request.headers.get("content-type")
+        merge_type = request.headers.get("merge-type")
+        patches = self.parse_patches(request)
+        self.metrics.observe(PARSE, time.perf_counter() - start)
+        body = request.data if patches is None else None
+        new_version = Version(
+            version=version,
+            parents=parents,
+            content_type=content_type,
+            merge_type=merge_type,
+            body=body,
+            patches=patches,
+        )
+        # recorded in the history once the route advertises it, not before
+        # the route accepted it
+        self.metrics.observe(VERSION_FROM_REQUEST, time.perf_counter() - start)
+        return new_version
+
+    def metrics_response(self):
+        """
+        Metrics route, histograms plus live subscriptions per resource as JSON
+        """
+        snapshot = self.metrics.snapshot(self.subscriptions, self.lifecycle)
+        return self.response(
+            json.dumps(snapshot).encode("utf-8"),
+            headers={"Content-Type": "application/json"},
+        )
+
+    def replay_history(self, request, subscription: Subscription) -> bool:
+        """
+        Seed a new subscription with the versions its client is missing
+        Returns:
+            True if the client's parents were known and the missing versions were queued
+        """
+        parents = split_header_list(request.parents)
+        missing = self.history.versions_since(subscription.resource, parents)
+        if missing is None:
+            return False
+        for version in missing:
+            subscription.replayed.add(version.version)
+            subscription.append(version.encode())
+        return True
+
+    def cached_response(self, request):
+        """
+        Answer a plain GET from the cache
+        A Parents header asks for the versions since those parents only,
+        otherwise the snapshot at the current version is sent, or 304 Not Modified
+        if it matches If-None-Match.
+        Returns:
+            response or None if nothing is cached
+        """
+        parents = split_header_list(request.parents)
+        if parents:
+            body = self.cache.since(
+                request.path, parents, self.history, request.query_string
+            )
+            if body is not None:
+                return self.response(body)
+        cached = self.cache.snapshot(request.path, request.query_string)
+        if cached is not None:
+            return self.snapshot_response(request, cached)
+
+    def snapshot_response(self, request, cached: CachedResponse):
+        headers = {"ETag": cached.etag}
+        if etag_matches(request.headers.get("if-none-match"), cached.etag):
+            return self.response(status=304, headers=headers)
+        if cached.content_type:
+            headers["Content-Type"] = cached.content_type
+        return self.response(cached.body, headers=headers)
+
+    def create_version(self, data, subscription: Subscription = None, request=None):
+        """
+        Create a new version of a resource and forward it depending on the request type
+        Pass the request to cache the response and answer conditional GETs
+        returns: response or None (write to stream)
+        """
+        if isinstance(data, Version):
+            version = data
+        elif isinstance(data, dict):
+            if "patches" not in data and "body" not in data:
+                raise ValueError("No 'patches' or 'body' provided in new version data")
+            version = Version(**data)
+        if subscription:
+            # prepare for next version, its advertised copy is not sent again
+            subscription.replayed.add(version.version)
+            subscription.append(version.encode())
+        elif request is None:
+            return self.version_response(version)
+        else:
+            cached = CachedResponse(
+                version.version,
+                version.encode(),
+                self.content_types(version, request.path),
+            )
+            generation = getattr(request, "cache_generation", None)
+            if generation is not None:
+                self.cache.store(request.path, generation, cached, request.query_string)
+            return self.snapshot_response(request, cached)
@@ -0,0 +1,213 @@
+"""
+Version history
+Per-resource version DAG used to replay missed versions to reconnecting subscribers
+"""
+
+import json
+import sqlite3
+import threading
+from collections import OrderedDict
+from core import Version
+
+
+class History(object):
+    """
+    Base class for version history backends
+    Versions of a resource are kept in the order they were added, which is a
+    topological order of the DAG since a version is added after its parents.
+    """
+
+    def __init__(self, max_versions: int = 1000):
+        """
+        Args:
+            max_versions: versions kept per resource, older versions are compacted away
+        """
+        self.max_versions = max_versions
+        self.lock = threading.Lock()
+
+    def add(self, resource: str, version: Version):
+        """
+        Record a version of a resource, ignoring versions already recorded
+        """
+        raise NotImplementedError
+
+    def get(self, resource: str, version_id: str) -> Version:
+        """
+        Returns the recorded version or None
+        """
+        raise NotImplementedError
+
+    def graph(self, resource: str) -> OrderedDict:
+        """
+        Version DAG of a resource as version id -> parent ids, oldest first
+        """
+        raise NotImplementedError
+
+    def select(self, resource: str, version_ids: list) -> list:
+        """
+        The recorded versions with the given ids, oldest first
+        """
+        raise NotImplementedError
+
+    def compact(self, resource: str):
+        """
+        Drop the oldest versions of a resource beyond max_versions
+        """
+        raise NotImplementedError
+
+    def versions_since(self, resource: str, parents: list) -> list:
+        """
+        Versions of a resource which are not ancestors of the given parents, oldest first
+        Returns:
+            list of Versions, or None if a parent is unknown (never seen or compacted away)
+            in which case the client needs a full snapshot
+        """
+        if not parents:
+            return None
+        graph = self.graph(resource)
+        if any(parent not in graph for parent in parents):
+            return None
+        # everything reachable from the client's parents is already on the client
+        seen = set()
+        stack = list(parents)
+        while stack:
+            version_id = stack.pop()
+            if version_id in seen or version_id not in graph:
+                continue
+            seen.add(version_id)
+            stack.extend(graph[version_id])
+        missing = [version_id for version_id in graph if version_id not in seen]
+        return self.select(resource, missing) if missing else []
+
+
+class MemoryHistory(History):
+    """
+    In-memory history, lost on restart
+    """
+
+    def __init__(self, max_versions: int = 1000):
+        super().__init__(max_versions)
+        # resource -> OrderedDict(version id -> Version)
+        self.resources = {}
+
+    def add(self, resource: str, version: Version):
+        with self.lock:
+            versions = self.resources.setdefault(resource, OrderedDict())
+            if version.version in versions:
+                return
+            versions[version.version] = version
+        self.compact(resource)
+
+    def get(self, resource: str, version_id: str) -> Version:
+        with self.lock:
+            return self.resources.get(resource, {}).get(version_id)
+
+    def graph(self, resource: str) -> OrderedDict:
+        with self.lock:
+            return OrderedDict(
+                (version_id, version.parents or [])
+                for version_id, version in self.resources.get(resource, {}).items()
+            )
+
+    def select(self, resource: str, version_ids: list) -> list:
+        with self.lock:
+            versions = self.resources.get(resource, {})
+            return [versions[id] for id in version_ids if id in versions]
+
+    def compact(self, resource: str):
+        with self.lock:
+            versions = self.resources.get(resource)
+            while versions and len(versions) > self.max_versions:
+                versions.popitem(last=False)
+
+
+class SQLiteHistory(History):
+    """
+    File backed history using SQLite with memory-mapped reads
+    Survives restarts, only the versions being replayed are loaded into memory
+    """
+
+    def __init__(self, path: str, max_versions: int = 1000, mmap_size: int = 2 ** 28):
+        """
+        Args:
+            path: database file
+            max_versions: versions kept per resource, older versions are compacted away
+            mmap_size: bytes of the database file read through mmap
+        """
+        super().__init__(max_versions)
+        self.db = sqlite3.connect(path, check_same_thread=False)
+        self.db.execute("PRAGMA journal_mode=WAL")
+        self.db.execute(f"PRAGMA mmap_size={int(mmap_size)}")
+        self.db.execute(
+            """
+            CREATE TABLE IF NOT EXISTS versions (
+                seq INTEGER PRIMARY KEY AUTOINCREMENT,
+                resource TEXT NOT NULL,
+                version TEXT NOT NULL,
+                parents TEXT NOT NULL,
+                data TEXT NOT NULL,
+                UNIQUE (resource, version)
+            )
+            """
+        )
+        self.db.commit()
+
+    def add(self, resource: str, version: Version):
+        with self.lock:
+            cursor = self.db.execute(
+                "INSERT OR IGNORE INTO versions (resource, version, parents, data) "
+                "VALUES (?, ?, ?, ?)",
+                (
+                    resource,
+                    version.version,
+                    json.dumps(version.parents or []),
+                    version.dumps(),
+                ),
+            )
+            self.db.commit()
+            if not cursor.rowcount:
+                return
+        self.compact(resource)
+
+    def get(self, resource: str, version_id: str) -> Version:
+        with self.lock:
+            row = self.db.execute(
+                "SELECT data FROM versions WHERE resource = ? AND version = ?",
+                (resource, version_id),
+            ).fetchone()
+        return Version.loads(row[0]) if row else None
+
+    def graph(self, resource: str) -> OrderedDict:
+        # only the DAG is read here, version bodies stay on disk
+        with self.lock:
+            rows = self.db.execute(
+                "SELECT version, parents FROM versions WHERE resource = ? ORDER BY seq",
+                (resource,),
+            ).fetchall()
+        return OrderedDict((version, json.loads(parents)) for version, parents in rows)
+
+    def select(self, resource: str, version_ids: list) -> list:
+        wanted = set(version_ids)
+        with self.lock:
+            rows = self.db.execute(
+                "SELECT version, data FROM versions WHERE resource = ? ORDER BY seq",
+                (resource,),
+            )
+            data = [row[1] for row in rows if row[0] in wanted]
+        return [Version.loads(row) for row in data]
+
+    def compact(self, resource: str):
+        with self.lock:
+            self.db.execute(
+                """
+                DELETE FROM versions WHERE resource = ? AND seq NOT IN (
+                    SELECT seq FROM versions WHERE resource = ?
+                    ORDER BY seq DESC LIMIT ?
+                )
+                """,
+                (resource, resource, self.max_versions),
+            )
+            self.db.commit()
+
+    def close(self):
+        self.db.close()
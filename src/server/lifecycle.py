@@ -0,0 +1,125 @@
+"""
+Subscription lifecycle
+A single background thread heartbeats idle subscriptions, expires the ones
+that stopped making progress and reaps dead entries from the registry in bulk.
+"""
+
+import sys
+import time
+import threading
+
+
+class LifecycleManager(object):
+    """
+    Sweeps a SubscriptionRegistry at a fixed interval
+    A subscription renews itself every time its stream completes a write, and
+    renew() extends it explicitly. Idle subscriptions are sent a heartbeat
+    frame, which renews a live client and makes the write fail for a
+    disconnected one. A subscription not renewed for ttl seconds, such as a
+    stream that was never started or is stuck on a dead connection, is closed.
+    Args:
+        registry: core.SubscriptionRegistry to sweep
+        heartbeat: seconds without a write before a heartbeat frame is sent, None disables
+        ttl: seconds without renewal before a subscription is closed, None disables
+        interval: seconds between sweeps, defaults to a quarter of the shortest timeout
+        dispatch: dispatch(fn, *args) runs subscription calls, an event loop's
+            call_soon_threadsafe for coroutine based subscriptions
+    """
+
+    def __init__(
+        self,
+        registry,
+        heartbeat: float = None,
+        ttl: float = None,
+        interval: float = None,
+        dispatch=None,
+    ):
+        if ttl is not None and heartbeat is not None and ttl <= heartbeat:
+            raise ValueError("The subscription ttl must be longer than the heartbeat")
+        self.registry = registry
+        self.heartbeat = heartbeat
+        self.ttl = ttl
+        if interval is None:
+            timeouts = [t for t in (heartbeat, ttl) if t]
+            interval = min(min(timeouts) / 4, 5) if timeouts else None
+        self.interval = interval
+        self.dispatch = dispatch or (lambda fn, *args: fn(*args))
+        # counters
+        self.heartbeats = 0
+        self.expired = 0
+        self.reaped = 0
+        self.thread = None
+        self.stopped = threading.Event()
+        self.lock = threading.Lock()
+
+    def start(self):
+        """
+        Start the sweeper thread, a no-op if it runs already or nothing is enabled
+        """
+        with self.lock:
+            if self.interval is None or self.thread is not None:
+                return
+            self.stopped.clear()
+            self.thread = threading.Thread(target=self._run, daemon=True)
+            self.thread.start()
+
+    def stop(self):
+        with self.lock:
+            thread, self.thread = self.thread, None
+        if thread is not None:
+            self.stopped.set()
+            thread.join()
+
+    def renew(self, subscription):
+        """
+        Extend the lifetime of a subscription by a full ttl
+        """
+        subscription.renewed = time.monotonic()
+
+    def _run(self):
+        while not self.stopped.wait(self.interval):
+            try:
+                self.sweep()
+            except Exception as e:
+                print(f"lifecycle: sweep failed: {e}", file=sys.stderr)
+
+    def sweep(self):
+        """
+        Heartbeat, expire and reap every registered subscription once
+        Returns:
+            number of subscriptions removed from the registry
+        """
+        now = time.monotonic()
+        dead = []
+        for subscription in self.registry.values():
+            if not subscription.active:
+                # closed, but its closed_cb never unregistered it
+                dead.append(subscription)
+                continue
+            idle = now - subscription.renewed
+            if self.ttl is not None and idle > self.ttl:
+                self.expired += 1
+                self.dispatch(subscription.close)
+                dead.append(subscription)
+            elif (
+                self.heartbeat is not None
+                and idle >= self.heartbeat
+                and not subscription.probe_pending
+            ):
+                self.heartbeats += 1
+                self.dispatch(subscription.probe)
+        for subscription in dead:
+            self.registry.remove(subscription)
+        self.reaped += len(dead)
+        return len(dead)
+
+    def stats(self) -> dict:
+        """
+        Live subscriptions and lifetime counters
+        """
+        return {
+            "live": len(self.registry),
+            "reaped": self.reaped,
+            "expired": self.expired,
+            "heartbeats": self.heartbeats,
+        }
@@ -7,16 +7,14 @@ import json
 from flask import Flask, request, Response, stream_with_context
 from werkzeug.serving import WSGIRequestHandler
 from braid import Braid
+from cache import ResponseCache
 from core import Patch, generate_patch_stream_string
+from posts import store
 
 # Create Flask app
 app = Flask(__name__)
-Braid(app)
-
-posts = {
-    "1": {"title": "Hello World", "body": "This is the first post"},
-    "2": {"title": "Hello World 2", "body": "This is the second post"},
-}
+# every change of a post is advertised, so plain GETs can be cached
+Braid(app, store=store, cache=ResponseCache())
 
 # Create heartbeat route
 @app.route("/heartbeat", methods=["GET"])
@@ -49,13 +47,15 @@ def get_post(id: str):
 
     # Braid has no way of knowing how to fetch a resource.
     # TODO: implement an optional way for Braid to fetch resource
+    state = request.store.get(request.path)
+    snapshot = {"version": state.version, "body": json.dumps(state.value)}
     if request.subscribe:
+        if not request.caught_up:
+            # the client's parents are unknown, start it from the current state
+            request.create_version(snapshot, request.subscription)
         return request.subscription.stream()
     else:
-        # TODO: include "real" version once CRDT is implemented, for now just return a hardcoded value
-        version = request.create_version(
-            {"version": "1", "body": json.dumps(posts[id])}
-        )
+        version = request.create_version(snapshot)
 
         return version
 
@@ -65,14 +65,9 @@ def put_post(id: str):
     """
     Tests Braid patching (ie. PUT) on sample Posts resource
     """
-    # For testing purposes, simply overwrite the current resource
-    # with the content of each patch in the request
-    # Later on, use op based CRDT to merge patches
-    for patch in request.version.patches:
-        json_patch = json.loads(patch.content)
-        posts[id][json_patch["type"]] = json_patch["value"]
-    # TODO: allow user to set field for auto-advertising of patches
-    request.advertise_version(request.version)
+    # applied atomically and logged, advertised once it is durable, in the
+    # order concurrent PUTs were committed
+    request.commit_version(request.version, advertise=True)
     return Response(status=200)
 
 
@@ -0,0 +1,699 @@
+"""
+Merge types
+Documents which apply the range patches of versions and merge concurrent
+versions deterministically, selected by a version's Merge-Type
+"""
+
+import re
+import json
+import copy
+import heapq
+import threading
+from bisect import bisect_right
+from core import Version
+
+MERGE_TYPES = {}
+
+
+def merge_type(name: str):
+    """
+    Class decorator registering a Document under a Merge-Type name
+    """
+
+    def register(cls):
+        cls.name = name
+        MERGE_TYPES[name] = cls
+        return cls
+
+    return register
+
+
+class Document(object):
+    """
+    Base class for mergeable documents
+    Tracks the version DAG with Lamport clocks. Each version is ordered by the key
+    (clock, version id), which is consistent with causality and identical on every
+    replica, so concurrent versions merge the same way whatever order they arrive in.
+    Versions must be applied after their parents. Parents the document has never
+    seen, such as the version of the snapshot it was seeded from, are treated as the root.
+    A version is validated before any of its patches is applied, so a version
+    that fails leaves the document untouched and can be retried.
+    """
+
+    # version id of the initial state
+    ROOT = ""
+
+    def __init__(self):
+        # version id -> Lamport clock
+        self.clocks = {}
+        # version id -> parent ids known to the document
+        self.parents = {}
+        self.heads = set()
+        self.lock = threading.Lock()
+
+    def apply(self, version: Version) -> bool:
+        """
+        Apply a version, ignoring versions already applied
+        Returns:
+            True if the version changed the document
+        """
+        with self.lock:
+            if version.version in self.clocks:
+                return False
+            parents = [p for p in (version.parents or []) if p in self.clocks]
+            if not parents and self.ROOT in self.clocks:
+                parents = [self.ROOT]
+            clock = max((self.clocks[p] for p in parents), default=0) + 1
+            # None in the common case, the version was made on top of the current state
+            concurrent = None
+            if set(parents) != self.heads:
+                concurrent = self.concurrent(parents) or None
+            key = (clock, version.version)
+            self.validate(version, key, concurrent)
+            if version.patches is None:
+                self.replace(version.body, key, concurrent)
+            else:
+                for patch in version.patches:
+                    self.patch(patch, key, concurrent)
+            self.clocks[version.version] = clock
+            self.parents[version.version] = parents
+            self.heads.difference_update(parents)
+            self.heads.add(version.version)
+            return True
+
+    def concurrent(self, parents: list) -> set:
+        """
+        Applied versions which are not ancestors of the given parents
+        Walks back from the heads in descending clock order and stops once every
+        queued version is an ancestor of the parents, so the cost depends on the
+        number of concurrent versions rather than on the length of the history.
+        """
+        heap = []
+        # version id -> True if it is an ancestor of the parents
+        queued = {}
+        pending = 0
+
+        def push(version_id, shared):
+            nonlocal pending
+            if version_id in queued:
+                if shared and not queued[version_id]:
+                    queued[version_id] = True
+                    pending -= 1
+                return
+            queued[version_id] = shared
+            if not shared:
+                pending += 1
+            heapq.heappush(heap, (-self.clocks[version_id], version_id))
+
+        for parent in parents:
+            push(parent, True)
+        for head in self.heads:
+            push(head, False)
+        concurrent = set()
+        while pending:
+            _, version_id = heapq.heappop(heap)
+            shared = queued[version_id]
+            if not shared:
+                pending -= 1
+                concurrent.add(version_id)
+            # children have greater clocks, so a popped version is never pushed again
+            for parent in self.parents[version_id]:
+                push(parent, shared)
+        return concurrent
+
+    def validate(self, version: Version, key: tuple, concurrent: set):
+        """
+        Raise ValueError if a patch of the version can not be applied
+        Called before the document changes. Afterwards only the first patch may
+        fail, and only before changing the document.
+        """
+        raise NotImplementedError
+
+    def replace(self, body, key: tuple, concurrent: set):
+        """
+        Replace the whole document with a version body
+        """
+        raise NotImplementedError
+
+    def patch(self, patch, key: tuple, concurrent: set):
+        """
+        Apply a single range patch
+        concurrent is None when the patch applies to the current state, otherwise it
+        holds the applied versions missing from the state the patch's ranges are relative to
+        """
+        raise NotImplementedError
+
+    @property
+    def value(self):
+        raise NotImplementedError
+
+
+class Span(object):
+    """
+    Run of characters inserted with consecutive local ids
+    """
+
+    __slots__ = ("lv", "text", "deleters")
+
+    def __init__(self, lv: int, text: str, deleters: frozenset = frozenset()):
+        # local id of the first character
+        self.lv = lv
+        self.text = text
+        # versions which deleted the run, empty if visible
+        self.deleters = deleters
+
+    def split(self, offset: int) -> "Span":
+        """
+        Cut the span at offset and return the right half
+        """
+        right = Span(self.lv + offset, self.text[offset:], self.deleters)
+        self.text = self.text[:offset]
+        return right
+
+
+class View(object):
+    """
+    Visibility of characters in the parent state of a concurrent version
+    """
+
+    __slots__ = ("concurrent", "starts", "ends", "clock")
+
+    def __init__(self, concurrent: set, ranges: dict, clocks: dict):
+        self.concurrent = concurrent
+        inserted = sorted(ranges[v] for v in concurrent if v in ranges)
+        # local id ranges inserted by the concurrent versions
+        self.starts = [start for start, end in inserted]
+        self.ends = [end for start, end in inserted]
+        # oldest concurrent version, chunks untouched since are unaffected
+        self.clock = min(clocks[v] for v in concurrent)
+
+
+TEXT_RANGE = re.compile(r"^\[(\d+)(?::(\d+))?\]$")
+
+
+def parse_text_range(range: str) -> tuple:
+    """
+    (start, end) of a text range such as "[2:5]", or "[2]" which inserts at 2
+    """
+    match = TEXT_RANGE.match(range.strip())
+    if not match:
+        raise ValueError(f"Invalid text range '{range}'")
+    start = int(match.group(1))
+    end = int(match.group(2)) if match.group(2) is not None else start
+    if end < start:
+        raise ValueError(f"Invalid text range '{range}'")
+    return start, end
+
+
+@merge_type("text")
+class TextDocument(Document):
+    """
+    Sequence CRDT for plain text edited with "text [start:end]" ranges
+
+    Characters are ordered like RGA: a character is inserted after its left
+    neighbour in the parent state, skipping concurrent insertions with a greater
+    key. Deleted characters stay as tombstones.
+
+    Characters get local ids in application order, so characters typed one after
+    another share a single Span even across versions. Spans are kept in chunks of
+    at most 2 * CHUNK spans with a cached visible length per chunk, so finding a
+    position costs O(spans / CHUNK + CHUNK) instead of O(characters). Concurrent
+    versions only rescan the chunks touched since the oldest concurrent version.
+    """
+
+    CHUNK = 64
+    # longest run merged into one span, bounds the cost of extending its text
+    MAX_SPAN = 1024
+
+    def __init__(self, initial: str = ""):
+        super().__init__()
+        self.chunks = [[]]
+        # visible characters per chunk
+        self.lengths = [0]
+        # greatest clock of a version which edited each chunk
+        self.touched = [0]
+        self.next_lv = 0
+        # first local id of each version that inserted text, and its key
+        self.bases = []
+        self.keys = []
+        # version id -> (first, last + 1) local ids it inserted
+        self.ranges = {}
+        self.cache = None
+        if initial:
+            self.apply(Version(version=self.ROOT, body=initial))
+
+    @property
+    def value(self) -> str:
+        if self.cache is None:
+            self.cache = "".join(
+                span.text for chunk in self.chunks for span in chunk if not span.deleters
+            )
+        return self.cache
+
+    def __len__(self):
+        return sum(self.lengths)
+
+    def validate(self, version: Version, key: tuple, concurrent: set):
+        if version.patches is None or len(version.patches) < 2:
+            # a single patch fails before changing the document
+            return
+        # a range ending at end needs end - delta characters of the parent
+        # state, delta being the length earlier patches of the version added
+        needed = delta = 0
+        length = None
+        for patch in version.patches:
+            start, end, content = self._parse(patch)
+            if start is None:
+                length = len(content)
+            elif length is not None:
+                if end > length:
+                    raise ValueError("Range is past the end of the document")
+                length += len(content) - (end - start)
+            else:
+                needed = max(needed, end - delta)
+                delta += len(content) - (end - start)
+        if not needed:
+            return
+        view = self._view(concurrent)
+        if view is None:
+            if needed > len(self):
+                raise ValueError("Range is past the end of the document")
+        else:
+            # raises if the parent state is shorter
+            self._seek(needed, view)
+
+    def replace(self, body, key: tuple, concurrent: set):
+        body = self._text(body)
+        view = self._view(concurrent)
+        length = sum(self._chunk_length(ci, view) for ci in range(len(self.chunks)))
+        self._delete(0, length, key, view)
+        self._insert(0, body or "", key, view)
+
+    def patch(self, patch, key: tuple, concurrent: set):
+        start, end, content = self._parse(patch)
+        if start is None:
+            self.replace(content, key, concurrent)
+            return
+        view = self._view(concurrent)
+        self._delete(start, end, key, view)
+        self._insert(start, content, key, view)
+
+    def _parse(self, patch) -> tuple:
+        """
+        (start, end, text) of a patch, start and end are None without a range
+        """
+        unit, range = patch.content_range or ("text", None)
+        if unit != "text":
+            raise ValueError(f"Unsupported range unit '{unit}' for text merge type")
+        content = self._text(patch.content)
+        if range is None:
+            return None, None, content
+        start, end = parse_text_range(range)
+        return start, end, content
+
+    @staticmethod
+    def _text(content) -> str:
+        if isinstance(content, bytes):
+            return content.decode("utf-8")
+        return content or ""
+
+    def _view(self, concurrent: set) -> View:
+        if concurrent is None:
+            return None
+        return View(concurrent, self.ranges, self.clocks)
+
+    def _key(self, lv: int) -> tuple:
+        index = bisect_right(self.bases, lv) - 1
+        clock, version = self.keys[index]
+        return (clock, version, lv - self.bases[index])
+
+    def _runs(self, span: Span, view: View):
+        """
+        Split a span into (start, end, visible) runs
+        view None means visible in the current state
+        """
+        length = len(span.text)
+        if view is None:
+            yield 0, length, not span.deleters
+            return
+        if span.deleters - view.concurrent:
+            # deleted by a version of the parent state
+            yield 0, length, False
+            return
+        # characters inserted by concurrent versions are hidden
+        start = 0
+        index = bisect_right(view.ends, span.lv)
+        while index < len(view.starts) and view.starts[index] < span.lv + length:
+            hidden_start = max(view.starts[index] - span.lv, 0)
+            hidden_end = min(view.ends[index] - span.lv, length)
+            if hidden_start > start:
+                yield start, hidden_start, True
+            yield hidden_start, hidden_end, False
+            start = hidden_end
+            index += 1
+        if start < length:
+            yield start, length, True
+
+    def _chunk_length(self, ci: int, view: View) -> int:
+        if view is None or self.touched[ci] < view.clock:
+            return self.lengths[ci]
+        return sum(
+            end - start
+            for span in self.chunks[ci]
+            for start, end, visible in self._runs(span, view)
+            if visible
+        )
+
+    # cursors are (chunk index, span index, offset) pointing before a character
+
+    def _seek(self, pos: int, view: View) -> tuple:
+        """
+        Cursor just after the pos-th visible character
+        """
+        if pos == 0:
+            return 0, 0, 0
+        ci = 0
+        # skip whole chunks using the cached lengths
+        while ci < len(self.chunks) - 1:
+            length = self._chunk_length(ci, view)
+            if length >= pos:
+                break
+            pos -= length
+            ci += 1
+        for si, span in enumerate(self.chunks[ci]):
+            for start, end, visible in self._runs(span, view):
+                if not visible:
+                    continue
+                if pos <= end - start:
+                    return ci, si, start + pos
+                pos -= end - start
+        raise ValueError("Range is past the end of the document")
+
+    def _insert(self, pos: int, text: str, key: tuple, view: View):
+        if not text:
+            return
+        lv = self.next_lv
+        extends = self.bases and self.keys[-1] == key
+        # key of the first inserted character
+        char_key = (key[0], key[1], lv - (self.bases[-1] if extends else lv))
+        ci, si, offset = self._seek(pos, view)
+        if not extends:
+            self.bases.append(lv)
+            self.keys.append(key)
+        if view is not None:
+            ci, si, offset = self._skip_greater(ci, si, offset, char_key)
+        self.next_lv += len(text)
+        first = self.ranges.get(key[1], (lv,))[0]
+        self.ranges[key[1]] = (first, self.next_lv)
+        chunk = self.chunks[ci]
+        if offset == 0 and si > 0:
+            si, offset = si - 1, len(chunk[si - 1].text)
+        if si < len(chunk) and offset == len(chunk[si].text):
+            span = chunk[si]
+            if (
+                not span.deleters
+                and span.lv + len(span.text) == lv
+                and len(span.text) + len(text) <= self.MAX_SPAN
+                and self._key(lv - 1) < char_key
+            ):
+                # typing at the end of a run extends it
+                span.text += text
+                self._edited(ci, len(text), key)
+                return
+            si += 1
+        elif si < len(chunk) and offset > 0:
+            chunk.insert(si + 1, chunk[si].split(offset))
+            si += 1
+        chunk.insert(si, Span(lv, text))
+        self._edited(ci, len(text), key)
+        if len(chunk) > 2 * self.CHUNK:
+            self._split_chunk(ci)
+
+    def _skip_greater(self, ci: int, si: int, offset: int, key: tuple) -> tuple:
+        """
+        Move a cursor past concurrent insertions ordered before the new text
+        Keys increase along a span, so one comparison per span is enough
+        """
+        while True:
+            chunk = self.chunks[ci]
+            while si < len(chunk):
+                if offset < len(chunk[si].text):
+                    if self._key(chunk[si].lv + offset) < key:
+                        return ci, si, offset
+                si, offset = si + 1, 0
+            if ci == len(self.chunks) - 1:
+                return ci, si, 0
+            ci, si = ci + 1, 0
+
+    def _delete(self, start: int, end: int, key: tuple, view: View):
+        count = end - start
+        if count <= 0:
+            return
+        ci, si, offset = self._seek(start, view)
+        touched = set()
+        # (chunk index, span, deleters, visible length removed) to undo a failed delete
+        deleted = []
+        while count > 0:
+            if ci >= len(self.chunks):
+                for ci, span, deleters, length in reversed(deleted):
+                    span.deleters = deleters
+                    self.lengths[ci] += length
+                raise ValueError("Range is past the end of the document")
+            chunk = self.chunks[ci]
+            if si >= len(chunk):
+                ci, si, offset = ci + 1, 0, 0
+                continue
+            span = chunk[si]
+            for run_start, run_end, visible in self._runs(span, view):
+                if run_end <= offset or not visible:
+                    continue
+                run_start = max(run_start, offset)
+                if run_start > 0:
+                    chunk.insert(si + 1, span.split(run_start))
+                    si, span = si + 1, chunk[si + 1]
+                    run_end -= run_start
+                    run_start = 0
+                length = min(run_end, count)
+                if length < len(span.text):
+                    chunk.insert(si + 1, span.split(length))
+                removed = 0 if span.deleters else length
+                deleted.append((ci, span, span.deleters, removed))
+                self._edited(ci, -removed, key)
+                span.deleters = span.deleters | {key[1]}
+                touched.add(ci)
+                count -= length
+                break
+            si, offset = si + 1, 0
+        for ci in sorted(touched, reverse=True):
+            if len(self.chunks[ci]) > 2 * self.CHUNK:
+                self._split_chunk(ci)
+
+    def _edited(self, ci: int, length: int, key: tuple):
+        self.lengths[ci] += length
+        self.touched[ci] = max(self.touched[ci], key[0])
+        self.cache = None
+
+    def _split_chunk(self, ci: int):
+        chunk = self.chunks[ci]
+        right = chunk[self.CHUNK :]
+        del chunk[self.CHUNK :]
+        self.chunks.insert(ci + 1, right)
+        visible = sum(len(span.text) for span in right if not span.deleters)
+        self.lengths[ci] -= visible
+        self.lengths.insert(ci + 1, visible)
+        self.touched.insert(ci + 1, self.touched[ci])
+
+
+JSON_PATH = re.compile(r"\.([^.\[\]]+)|\[(\d+)\]")
+
+
+def parse_path(path: str) -> tuple:
+    """
+    Tokens of a json range such as ".tags[0]", names are strings and indexes ints
+    """
+    path = path.strip()
+    tokens = []
+    position = 0
+    for match in JSON_PATH.finditer(path):
+        if match.start() != position:
+            raise ValueError(f"Invalid json range '{path}'")
+        name, index = match.groups()
+        tokens.append(name if name is not None else int(index))
+        position = match.end()
+    if position != len(path):
+        raise ValueError(f"Invalid json range '{path}'")
+    return tuple(tokens)
+
+
+def set_path(document, path: tuple, value):
+    """
+    Copy of a JSON document with the value at a path set
+    Only the containers along the path are copied, document is never modified.
+    Missing objects along the path are created, an index equal to the length
+    of its list appends to it.
+    Raises:
+        ValueError if the path runs through a list item that does not exist
+    """
+    if not path:
+        return value
+    token, rest = path[0], path[1:]
+    if isinstance(document, list):
+        if not isinstance(token, int) or token > len(document) or (rest and token == len(document)):
+            raise ValueError(f"No list item at json path {path}")
+        document = list(document)
+        if token == len(document):
+            document.append(value)
+        else:
+            document[token] = set_path(document[token], rest, value)
+        return document
+    if not isinstance(document, dict):
+        raise ValueError(f"No object at json path {path}")
+    document = dict(document)
+    child = document.get(token)
+    if rest and not isinstance(child, (dict, list)):
+        child = [] if isinstance(rest[0], int) else {}
+    document[token] = set_path(child, rest, value)
+    return document
+
+
+@merge_type("json")
+class JSONDocument(Document):
+    """
+    JSON document edited with "json <path>" ranges such as ".title" or ".tags[0]"
+    A patch sets the value at its path. Writes are applied in key order, so
+    concurrent writes to a path resolve to the version with the greatest key.
+    A write which does not fit the document, such as a list index past the end
+    or a path below a number, is skipped rather than rejected. Whether it fits
+    depends on the writes before it in key order, which every replica agrees on
+    whatever the order in which the versions arrived.
+    The writes since the last replacement of the whole document are kept, with
+    the value before every CHECKPOINT-th write, so a version arriving out of key
+    order only replays the writes from the checkpoint before its place.
+    The value is replaced rather than modified, so it can be shared.
+    """
+
+    CHECKPOINT = 64
+
+    def __init__(self, initial=None):
+        super().__init__()
+        self.initial = copy.deepcopy(initial) if initial is not None else {}
+        # (path, value) in key order, the writes of a version in patch order
+        self.writes = []
+        self.keys = []
+        # value before the writes at multiples of CHECKPOINT
+        self.checkpoints = [self.initial]
+        self.cache = self.initial
+
+    @property
+    def value(self):
+        return self.cache
+
+    def validate(self, version: Version, key: tuple, concurrent: set):
+        # only the content is checked, writes that do not fit are skipped
+        if version.patches is None:
+            self.parse_body(version.body)
+        else:
+            for patch in version.patches:
+                self.parse_patch(patch)
+
+    def replace(self, body, key: tuple, concurrent: set):
+        self.write((), self.parse_body(body), key)
+
+    def patch(self, patch, key: tuple, concurrent: set):
+        self.write(*self.parse_patch(patch), key)
+
+    @staticmethod
+    def parse_body(body):
+        return json.loads(body) if body else None
+
+    @staticmethod
+    def parse_patch(patch) -> tuple:
+        """
+        (path, value) written by a patch
+        """
+        unit, path = patch.content_range or ("json", "")
+        if unit != "json":
+            raise ValueError(f"Unsupported range unit '{unit}' for json merge type")
+        return parse_path(path), json.loads(patch.content)
+
+    def write(self, path: tuple, value, key: tuple):
+        if not path:
+            # the whole document was replaced, the writes before it can never show again
+            replaced = bisect_right(self.keys, key)
+            if replaced:
+                del self.keys[:replaced]
+                del self.writes[:replaced]
+                self.checkpoints = [self.initial]
+        position = bisect_right(self.keys, key)
+        self.keys.insert(position, key)
+        self.writes.insert(position, (path, value))
+        if position == len(self.writes) - 1:
+            self._checkpoint(position, self.cache)
+            self.cache = self._set(self.cache, path, value)
+        else:
+            # arrived out of key order, replay so every replica ends up identical
+            self._replay(position)
+
+    def _checkpoint(self, position: int, value):
+        if position % self.CHECKPOINT == 0 and position // self.CHECKPOINT == len(
+            self.checkpoints
+        ):
+            self.checkpoints.append(value)
+
+    def _replay(self, position: int):
+        index = position // self.CHECKPOINT
+        del self.checkpoints[index + 1 :]
+        value = self.checkpoints[index]
+        for i in range(index * self.CHECKPOINT, len(self.writes)):
+            self._checkpoint(i, value)
+            value = self._set(value, *self.writes[i])
+        self.cache = value
+
+    @staticmethod
+    def _set(value, path: tuple, content):
+        try:
+            return set_path(value, path, content)
+        except ValueError:
+            # does not fit, skipped
+            return value
+
+
+class MergeEngine(object):
+    """
+    Per-resource documents, created for the Merge-Type of the first version applied
+    """
+
+    def __init__(self):
+        self.documents = {}
+        self.lock = threading.Lock()
+
+    def document(self, resource: str, merge_type: str = None, initial=None) -> Document:
+        """
+        The document of a resource, created if missing
+        Args:
+            merge_type: registered Merge-Type name used to create the document
+            initial: document state before any version, used on creation only
+        """
+        with self.lock:
+            document = self.documents.get(resource)
+            if document is None:
+                if merge_type not in MERGE_TYPES:
+                    raise ValueError(f"Unknown merge type '{merge_type}'")
+                if initial is None:
+                    document = MERGE_TYPES[merge_type]()
+                else:
+                    document = MERGE_TYPES[merge_type](initial)
+                self.documents[resource] = document
+            elif merge_type is not None and merge_type != document.name:
+                raise ValueError(
+                    f"Resource {resource} uses merge type '{document.name}', not '{merge_type}'"
+                )
+            return document
+
+    def apply(self, resource: str, version: Version, initial=None) -> Document:
+        """
+        Merge a version into the document of a resource
+        """
+        document = self.document(resource, version.merge_type, initial)
+        document.apply(version)
+        return document
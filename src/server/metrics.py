@@ -0,0 +1,135 @@
+"""
+Instrumentation
+Histograms of the Braid hot paths: request hooks, patch parsing, fan-out and
+stream writes. Recording a value is a bisect and a few additions, cheap enough
+to leave on in production.
+"""
+
+import threading
+from bisect import bisect_left
+
+# histogram names
+BEFORE_REQUEST = "before_request_seconds"
+PARSE = "parse_seconds"
+VERSION_FROM_REQUEST = "version_from_request_seconds"
+ADVERTISE = "advertise_seconds"
+FANOUT = "fanout_seconds"
+QUEUE_DEPTH = "queue_depth"
+BYTES_SENT = "bytes_sent"
+
+
+class Histogram(object):
+    """
+    Histogram over exponentially growing buckets
+    Percentiles are estimated as the upper bound of the bucket they fall in,
+    capped by the maximum, so they are exact to within one bucket factor.
+    """
+
+    def __init__(self, start: float, factor: float = 2, buckets: int = 32):
+        """
+        Args:
+            start: upper bound of the first bucket
+            factor: ratio between consecutive bucket bounds
+            buckets: number of bounded buckets, larger values share an overflow bucket
+        """
+        self.bounds = [start * factor ** i for i in range(buckets)]
+        self.counts = [0] * (buckets + 1)
+        self.count = 0
+        self.sum = 0
+        self.max = None
+        self.lock = threading.Lock()
+
+    def observe(self, value):
+        i = bisect_left(self.bounds, value)
+        with self.lock:
+            self.counts[i] += 1
+            self.count += 1
+            self.sum += value
+            if self.max is None or value > self.max:
+                self.max = value
+
+    def percentile(self, p: float):
+        """
+        Estimated value below which p percent of the observations fall
+        """
+        if not self.count:
+            return None
+        rank = self.count * p / 100
+        seen = 0
+        for i, count in enumerate(self.counts):
+            seen += count
+            if count and seen >= rank:
+                return min(self.bounds[i], self.max) if i < len(self.bounds) else self.max
+        return self.max
+
+    def snapshot(self) -> dict:
+        with self.lock:
+            return {
+                "count": self.count,
+                "sum": self.sum,
+                "mean": self.sum / self.count if self.count else None,
+                "p50": self.percentile(50),
+                "p90": self.percentile(90),
+                "p99": self.percentile(99),
+                "max": self.max,
+            }
+
+
+class Metrics(object):
+    """
+    Named histograms plus profiling hooks
+    A hook is called as hook(name, value) for every recorded value, for
+    example to forward them to an external profiler or statistics daemon.
+    Hooks run inline on the hot path and should return quickly.
+    """
+
+    def __init__(self):
+        self.histograms = {
+            BEFORE_REQUEST: Histogram(1e-6),
+            PARSE: Histogram(1e-6),
+            VERSION_FROM_REQUEST: Histogram(1e-6),
+            ADVERTISE: Histogram(1e-6),
+            FANOUT: Histogram(1e-6),
+            QUEUE_DEPTH: Histogram(1, buckets=24),
+            BYTES_SENT: Histogram(16, buckets=28),
+        }
+        self.hooks = []
+
+    def add_hook(self, hook):
+        """
+        Register hook(name: str, value) for every recorded value
+        """
+        self.hooks.append(hook)
+
+    def remove_hook(self, hook):
+        self.hooks.remove(hook)
+
+    def observe(self, name: str, value):
+        histogram = self.histograms.get(name)
+        if histogram is None:
+            # seconds unless told otherwise, register it first for other units
+            histogram = self.histograms.setdefault(name, Histogram(1e-6))
+        histogram.observe(value)
+        for hook in self.hooks:
+            hook(name, value)
+
+    def snapshot(self, subscriptions=None, lifecycle=None) -> dict:
+        """
+        Every histogram, plus live subscription counts per resource if a
+        registry is given and lifecycle counters if a manager is given
+        """
+        snapshot = {
+            "histograms": {
+                name: histogram.snapshot()
+                for name, histogram in list(self.histograms.items())
+            }
+        }
+        if subscriptions is not None:
+            with subscriptions.lock:
+                snapshot["subscriptions"] = {
+                    resource: len(subscribers)
+                    for resource, subscribers in subscriptions.by_resource.items()
+                }
+        if lifecycle is not None:
+            snapshot["lifecycle"] = lifecycle.stats()
+        return snapshot
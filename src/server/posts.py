@@ -0,0 +1,48 @@
+"""
+Sample Posts resource
+State of the posts served by main.py and asgi_main.py
+"""
+import os
+import json
+from merge import MERGE_TYPES, MergeEngine
+from store import LogStore
+
+posts = {
+    "1": {"title": "Hello World", "body": "This is the first post"},
+    "2": {"title": "Hello World 2", "body": "This is the second post"},
+}
+# merged documents of the posts, rebuilt when the log is replayed
+documents = MergeEngine()
+# directory of the posts' snapshot and write-ahead log
+STORE_PATH = os.environ.get(
+    "BRAID_STORE_PATH", os.path.join(os.path.dirname(os.path.abspath(__file__)), "data")
+)
+
+
+def apply_post(resource: str, post: dict, version):
+    """
+    Compute the state of a post after a version, without modifying post
+    Also replays the logged versions on startup
+    """
+    if version.merge_type in MERGE_TYPES:
+        # Merge concurrent versions with the requested merge type. A version
+        # that fails leaves its document untouched, so documents only ever
+        # hold the committed versions, and merged values are never modified
+        document = documents.apply(resource, version, initial=post)
+        return document.value
+    # For testing purposes, simply overwrite the current resource
+    # with the content of each patch in the request
+    post = dict(post)
+    for patch in version.patches:
+        json_patch = json.loads(patch.content)
+        post[json_patch["type"]] = json_patch["value"]
+    return post
+
+
+# posts survive restarts, concurrent PUTs share fsyncs. The store is opened
+# by the first request, so only the serving process locks it
+store = LogStore(
+    STORE_PATH,
+    apply=apply_post,
+    initial={f"/post/{id}": ("1", post) for id, post in posts.items()},
+)
@@ -0,0 +1,244 @@
+"""
+Broadcast backends
+Carry advertised versions between the processes serving a resource's subscribers.
+Braid publishes every encoded version to its broker and delivers whatever the
+broker hands back to the subscriptions it holds locally.
+"""
+
+import os
+import sys
+import errno
+import socket
+import struct
+import threading
+from collections import deque
+
+# frame header: resource length, data length
+FRAME = struct.Struct("!II")
+
+
+class Broker(object):
+    """
+    Base class for broadcast backends
+    A backend delivers every published (resource, data) pair to the callbacks
+    subscribed in every process sharing it, including the publishing process.
+    A service with publish/subscribe channels, such as Redis, can implement it by
+    publishing frames to a channel and calling deliver() from its listener.
+    """
+
+    def __init__(self):
+        self.callbacks = []
+
+    def subscribe(self, callback):
+        """
+        Register callback(resource: str, data: bytes) for every published version
+        """
+        self.callbacks.append(callback)
+
+    def unsubscribe(self, callback):
+        self.callbacks.remove(callback)
+
+    def deliver(self, resource: str, data: bytes):
+        """
+        Hand a published version to the local callbacks
+        """
+        for callback in list(self.callbacks):
+            callback(resource, data)
+
+    def publish(self, resource: str, data: bytes):
+        raise NotImplementedError
+
+    def close(self):
+        pass
+
+
+class LocalBroker(Broker):
+    """
+    In-process backend, delivers synchronously to the publishing process only
+    """
+
+    def publish(self, resource: str, data: bytes):
+        self.deliver(resource, data)
+
+
+class Peer(object):
+    """
+    Connection of a SocketBroker to one peer process, written by its own thread
+    Frames are queued without blocking the publisher. A peer which does not take
+    a write within the send timeout, or falls more than max_queue frames behind,
+    is dropped along with its queue and reconnected by a later publish.
+    """
+
+    def __init__(self, path: str, dropped_cb, timeout: float, max_queue: int):
+        self.path = path
+        self.dropped_cb = dropped_cb
+        self.timeout = timeout
+        self.max_queue = max_queue
+        self.queue = deque()
+        self.active = True
+        self.ready = threading.Condition()
+        threading.Thread(target=self._run, daemon=True).start()
+
+    def send(self, frame: bytes):
+        with self.ready:
+            if not self.active:
+                return
+            if len(self.queue) >= self.max_queue:
+                print(f"broker: {self.path} fell behind, dropping it", file=sys.stderr)
+                self.active = False
+            else:
+                self.queue.append(frame)
+            self.ready.notify()
+
+    def _run(self):
+        connection = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        connection.settimeout(self.timeout)
+        try:
+            connection.connect(self.path)
+            while True:
+                with self.ready:
+                    while self.active and not self.queue:
+                        self.ready.wait()
+                    if not self.active:
+                        return
+                    frames = list(self.queue)
+                    self.queue.clear()
+                connection.sendall(b"".join(frames))
+        except socket.timeout:
+            print(f"broker: {self.path} timed out, dropping it", file=sys.stderr)
+        except OSError as e:
+            if e.errno in (errno.ECONNREFUSED, errno.ENOENT):
+                # nobody listens there anymore
+                SocketBroker._unlink(self.path)
+            else:
+                print(f"broker: could not publish to {self.path}: {e}", file=sys.stderr)
+        finally:
+            connection.close()
+            self.close()
+            self.dropped_cb(self)
+
+    def close(self):
+        with self.ready:
+            self.active = False
+            self.queue.clear()
+            self.ready.notify()
+
+
+class SocketBroker(Broker):
+    """
+    Unix domain socket backend for the worker processes of one host
+    Every process listens on its own socket in a shared directory and keeps a
+    persistent connection to each peer it publishes to, written by a Peer thread
+    so a slow or stuck peer never blocks a publisher. Peers are discovered by
+    listing the directory whenever it changes, sockets left behind by dead
+    processes are removed.
+    Create it in each worker after forking, the socket is named after the process id.
+
+    Versions only reach the subscriptions open when they are published. For a
+    client reconnecting to another worker to be replayed what it missed, every
+    worker needs the same history, such as a history.SQLiteHistory on one file,
+    since a MemoryHistory only holds the versions PUT to its own process.
+    """
+
+    def __init__(self, directory: str, send_timeout: float = 5, max_queue: int = 10000):
+        """
+        Args:
+            directory: directory shared by all the processes, created if missing
+            send_timeout: seconds a peer may take to accept a write before it is dropped
+            max_queue: frames queued for a peer before it is dropped
+        """
+        super().__init__()
+        self.directory = directory
+        self.send_timeout = send_timeout
+        self.max_queue = max_queue
+        os.makedirs(directory, exist_ok=True)
+        self.path = os.path.join(directory, f"{os.getpid()}.sock")
+        if os.path.exists(self.path):
+            os.unlink(self.path)
+        self.server = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.server.bind(self.path)
+        self.server.listen()
+        # peer socket path -> Peer
+        self.peers = {}
+        # modification time of the directory when it was last listed
+        self.listed = None
+        self.lock = threading.Lock()
+        self.active = True
+        threading.Thread(target=self._accept, daemon=True).start()
+
+    def publish(self, resource: str, data: bytes):
+        # local subscribers first, they should not wait on other processes
+        self.deliver(resource, data)
+        resource = resource.encode("utf-8")
+        frame = FRAME.pack(len(resource), len(data)) + resource + data
+        with self.lock:
+            self._discover()
+            peers = list(self.peers.values())
+        for peer in peers:
+            peer.send(frame)
+
+    def _discover(self):
+        """
+        Connect to new peers and forget the removed ones, the caller must hold the lock
+        """
+        modified = os.stat(self.directory).st_mtime_ns
+        if modified == self.listed:
+            return
+        self.listed = modified
+        paths = set()
+        for name in os.listdir(self.directory):
+            path = os.path.join(self.directory, name)
+            if name.endswith(".sock") and path != self.path:
+                paths.add(path)
+        for path in set(self.peers) - paths:
+            self.peers.pop(path).close()
+        for path in paths - set(self.peers):
+            self.peers[path] = Peer(path, self._dropped, self.send_timeout, self.max_queue)
+
+    def _dropped(self, peer: Peer):
+        with self.lock:
+            if self.peers.get(peer.path) is peer:
+                del self.peers[peer.path]
+                # list again on the next publish, the peer may still be there
+                self.listed = None
+
+    @staticmethod
+    def _unlink(path: str):
+        try:
+            os.unlink(path)
+        except FileNotFoundError:
+            pass
+
+    def _accept(self):
+        while self.active:
+            try:
+                connection, _ = self.server.accept()
+            except OSError:
+                return
+            threading.Thread(target=self._receive, args=(connection,), daemon=True).start()
+
+    def _receive(self, connection):
+        with connection, connection.makefile("rb") as stream:
+            while self.active:
+                header = stream.read(FRAME.size)
+                if len(header) < FRAME.size:
+                    return
+                resource_length, data_length = FRAME.unpack(header)
+                resource = stream.read(resource_length).decode("utf-8")
+                data = stream.read(data_length)
+                if len(data) < data_length:
+                    return
+                try:
+                    self.deliver(resource, data)
+                except Exception as e:
+                    print(f"broker: delivery failed: {e}", file=sys.stderr)
+
+    def close(self):
+        self.active = False
+        self.server.close()
+        self._unlink(self.path)
+        with self.lock:
+            peers = list(self.peers.values())
+            self.peers.clear()
+        for peer in peers:
+            peer.close()
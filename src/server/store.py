@@ -0,0 +1,431 @@
+"""
+Resource stores
+Current state of each resource, updated one version at a time. The durable
+store appends every version to a write-ahead log and group-commits concurrent
+writes, so a burst of PUTs shares a single fsync.
+"""
+
+import os
+import json
+import fcntl
+import mmap
+import zlib
+import struct
+import threading
+from typing import NamedTuple
+from core import Version
+from merge import parse_path, parse_text_range, set_path
+
+# log record header: sequence number, crc32, resource length, data length
+RECORD = struct.Struct("!QIII")
+
+
+class State(NamedTuple):
+    """
+    State of a resource at one version
+    """
+
+    version: str
+    value: object
+
+
+def apply_patches(resource: str, value, version: Version):
+    """
+    Default update of a store, leaves value untouched
+    A body replaces the whole value, "json <path>" patches set the value at
+    their path, "text [start:end]" patches replace characters and patches
+    without a range replace the whole value.
+    Returns:
+        the new value
+    """
+    if version.patches is None:
+        return parse_content(version.body, version.content_type)
+    for patch in version.patches:
+        unit, range = patch.content_range or (None, None)
+        if range is None:
+            value = parse_content(patch.content, patch.content_type or version.content_type)
+        elif unit == "json":
+            if not isinstance(value, (dict, list)):
+                value = {}
+            # same path semantics as the json merge type
+            value = set_path(value, parse_path(range), json.loads(patch.content))
+        elif unit == "text":
+            # same range syntax as the text merge type
+            start, end = parse_text_range(range)
+            text = value or ""
+            value = text[:start] + patch.content + text[end:]
+        else:
+            raise ValueError(f"Unsupported range unit '{unit}'")
+    return value
+
+
+def parse_content(content, content_type: str = None):
+    if isinstance(content, (bytes, bytearray, memoryview)):
+        content = bytes(content).decode("utf-8")
+    if content_type is None or "json" in content_type:
+        return json.loads(content) if content else None
+    return content
+
+
+class Store(object):
+    """
+    Base class for resource state backends
+    commit() applies a version with the store's update function. Commits are
+    serialized, and a version that fails to apply leaves the state untouched.
+    The update function must not modify the value it is given, and durable
+    stores replay it on startup, so it must also be deterministic.
+    """
+
+    def __init__(self, apply=None, initial: dict = None):
+        """
+        Args:
+            apply: apply(resource, value, version) returning the new value,
+                defaults to apply_patches
+            initial: resource -> (version, value) before any version is committed
+        """
+        self.apply = apply if apply is not None else apply_patches
+        # resource -> State
+        self.states = {
+            resource: State(*state) for resource, state in (initial or {}).items()
+        }
+        self.lock = threading.Lock()
+
+    def get(self, resource: str) -> State:
+        """
+        Returns the current State of a resource or None
+        """
+        return self.states.get(resource)
+
+    def commit(self, resource: str, version: Version, on_commit=None) -> State:
+        """
+        Apply a version to a resource
+        Args:
+            on_commit: on_commit(state) called once the version is as durable as
+                the store makes it, in commit order across concurrent commits,
+                such as a publish of the version to its subscribers
+        Returns:
+            the new State, once it is as durable as the store makes it
+        """
+        raise NotImplementedError
+
+    def _apply(self, resource: str, version: Version) -> State:
+        """
+        Update the state of a resource, the caller must hold the lock
+        """
+        current = self.states.get(resource)
+        value = self.apply(resource, current.value if current else None, version)
+        state = self.states[resource] = State(version.version, value)
+        return state
+
+    def close(self):
+        pass
+
+
+class MemoryStore(Store):
+    """
+    In-memory store, lost on restart
+    """
+
+    def commit(self, resource: str, version: Version, on_commit=None) -> State:
+        with self.lock:
+            state = self._apply(resource, version)
+            if on_commit is not None:
+                on_commit(state)
+            return state
+
+
+class LogStore(Store):
+    """
+    Durable store backed by a write-ahead log and a snapshot in a directory
+
+    A commit applies its version, appends it to an in-memory batch and waits
+    until the batch is on disk. The first waiter writes and fsyncs everything
+    batched so far while the next commits gather into the following batch, so
+    under contention each fsync covers many versions. Committed state may be
+    read before its fsync completes, but commit() only returns afterwards.
+    The commit callbacks of a batch are run by the thread that synced it, in
+    sequence order and before the next batch is written.
+
+    Once the log outgrows max_log_bytes, the state of every resource is written
+    to a new snapshot and the log is emptied. On startup the snapshot is loaded
+    and the log records that follow it are replayed through the update function,
+    read straight from a memory map. A torn record left by a crash ends the log.
+
+    The directory is opened on first use rather than on creation, so a module
+    can create its store at import time without touching the disk in processes
+    that never serve, such as the parent of a reloader or a test collector.
+    A directory belongs to one process at a time, it is locked while the store
+    is open and a second store on it fails to open. A server running several
+    worker processes, see pubsub.SocketBroker, has to route every request that
+    reads or writes the store to the one worker that opened it, the other
+    workers only serve subscriptions.
+    """
+
+    SNAPSHOT = "snapshot.json"
+    LOG = "wal.log"
+    LOCK = "lock"
+
+    def __init__(
+        self,
+        path: str,
+        apply=None,
+        initial: dict = None,
+        max_log_bytes: int = 2 ** 26,
+    ):
+        """
+        Args:
+            path: directory of the snapshot and log, created if missing
+            apply: apply(resource, value, version) returning the new value,
+                defaults to apply_patches
+            initial: resource -> (version, value) the log is replayed onto when
+                there is no snapshot yet, so it must be the same on every start
+            max_log_bytes: log size at which it is compacted into the snapshot,
+                values must be JSON serializable
+        """
+        super().__init__(apply, initial)
+        self.path = path
+        self.max_log_bytes = max_log_bytes
+        # None until open()
+        self.log = None
+        self.lock_file = None
+        self.opening = threading.Lock()
+        # sequence numbers of the last record applied and of the last one synced
+        self.seq = 0
+        self.durable = 0
+        # records applied but not written yet, and their (on_commit, state)
+        self.batch = []
+        self.committed = []
+        self.syncing = False
+        self.error = None
+        self.synced = threading.Condition()
+        # held while writing to the log, always taken before self.lock
+        self.writing = threading.Lock()
+        # counters
+        self.fsyncs = 0
+        self.compactions = 0
+
+    def open(self):
+        """
+        Lock the directory, recover the state and open the log, unless already open
+        Raises:
+            RuntimeError if another store holds the directory
+        """
+        if self.log is not None:
+            return
+        with self.opening:
+            if self.log is not None:
+                return
+            os.makedirs(self.path, exist_ok=True)
+            lock_file = open(os.path.join(self.path, self.LOCK), "a")
+            try:
+                fcntl.flock(lock_file.fileno(), fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except OSError:
+                lock_file.close()
+                raise RuntimeError(
+                    f"Store {self.path} is already open, by this or another process"
+                )
+            self.lock_file = lock_file
+            self.recover()
+            self.log = open(os.path.join(self.path, self.LOG), "ab")
+
+    def get(self, resource: str) -> State:
+        self.open()
+        return super().get(resource)
+
+    def recover(self):
+        """
+        Load the snapshot and replay the log
+        """
+        snapshot = os.path.join(self.path, self.SNAPSHOT)
+        if os.path.exists(snapshot):
+            with open(snapshot) as f:
+                data = json.load(f)
+            self.seq = data["seq"]
+            self.states = {
+                resource: State(version, value)
+                for resource, (version, value) in data["resources"].items()
+            }
+        log = os.path.join(self.path, self.LOG)
+        if not os.path.exists(log) or not os.path.getsize(log):
+            self.durable = self.seq
+            return
+        with open(log, "r+b") as f:
+            end = 0
+            with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as buffer:
+                view = memoryview(buffer)
+                try:
+                    for seq, resource, data, end in self.records(view):
+                        if seq <= self.seq:
+                            # already in the snapshot, compaction was interrupted
+                            continue
+                        self._apply(resource, Version.loads(data))
+                        self.seq = seq
+                finally:
+                    view.release()
+            if end < os.path.getsize(log):
+                print(f"store: dropping a torn log record at offset {end}")
+                f.truncate(end)
+                os.fsync(f.fileno())
+        self.durable = self.seq
+
+    @staticmethod
+    def records(buffer):
+        """
+        Yield (seq, resource, data, end offset) for each intact record of a log buffer
+        """
+        offset = 0
+        size = len(buffer)
+        while offset + RECORD.size <= size:
+            seq, crc, resource_length, data_length = RECORD.unpack_from(buffer, offset)
+            start = offset + RECORD.size
+            end = start + resource_length + data_length
+            if end > size or zlib.crc32(buffer[start:end]) != crc:
+                return
+            resource = bytes(buffer[start : start + resource_length]).decode("utf-8")
+            data = bytes(buffer[start + resource_length : end]).decode("utf-8")
+            offset = end
+            yield seq, resource, data, end
+
+    def commit(self, resource: str, version: Version, on_commit=None) -> State:
+        self.open()
+        resource_data = resource.encode("utf-8")
+        data = version.dumps().encode("utf-8")
+        payload = resource_data + data
+        with self.lock:
+            if self.error is not None:
+                raise OSError(f"Store {self.path} failed to write its log: {self.error}")
+            state = self._apply(resource, version)
+            self.seq += 1
+            self.batch.append(
+                RECORD.pack(self.seq, zlib.crc32(payload), len(resource_data), len(data))
+                + payload
+            )
+            if on_commit is not None:
+                self.committed.append((on_commit, state))
+            seq = self.seq
+        self.sync(seq)
+        return state
+
+    def sync(self, seq: int = None):
+        """
+        Wait until the record with a sequence number, or every record, is on disk
+        """
+        with self.synced:
+            if seq is None:
+                seq = self.seq
+            while self.durable < seq:
+                if self.error is not None:
+                    raise OSError(f"Store {self.path} failed to write its log: {self.error}")
+                if not self.syncing:
+                    # lead the next group commit
+                    self.syncing = True
+                    break
+                self.synced.wait()
+            else:
+                return
+        last = None
+        try:
+            with self.writing:
+                with self.lock:
+                    batch, self.batch = self.batch, []
+                    committed, self.committed = self.committed, []
+                    last = self.seq
+                self.log.write(b"".join(batch))
+                self.log.flush()
+                os.fsync(self.log.fileno())
+                self.fsyncs += 1
+                self._run_callbacks(committed)
+        except OSError as e:
+            # the state in memory is ahead of the log now, refuse further commits
+            self.error = e
+            raise
+        finally:
+            with self.synced:
+                self.syncing = False
+                if self.error is None and last is not None:
+                    self.durable = max(self.durable, last)
+                self.synced.notify_all()
+        if self.log.tell() > self.max_log_bytes:
+            self.compact()
+
+    def compact(self):
+        """
+        Write the state of every resource to a new snapshot and empty the log
+        Commits wait until it is done.
+        """
+        self.open()
+        with self.writing:
+            with self.lock:
+                batch, self.batch = self.batch, []
+                committed, self.committed = self.committed, []
+                if batch:
+                    # records not synced yet, the snapshot includes them
+                    self.log.write(b"".join(batch))
+                    self.log.flush()
+                data = {
+                    "seq": self.seq,
+                    "resources": {
+                        resource: [state.version, state.value]
+                        for resource, state in self.states.items()
+                    },
+                }
+                path = os.path.join(self.path, self.SNAPSHOT)
+                with open(path + ".tmp", "w") as f:
+                    json.dump(data, f)
+                    f.flush()
+                    os.fsync(f.fileno())
+                os.replace(path + ".tmp", path)
+                self._fsync_directory()
+                # records up to seq are in the snapshot, a crash before the
+                # truncation is fine since recovery skips them
+                self.log.truncate(0)
+                self.log.seek(0)
+                os.fsync(self.log.fileno())
+                self.compactions += 1
+                last = self.seq
+            self._run_callbacks(committed)
+            with self.synced:
+                self.durable = max(self.durable, last)
+                self.synced.notify_all()
+
+    @staticmethod
+    def _run_callbacks(committed: list):
+        for on_commit, state in committed:
+            try:
+                on_commit(state)
+            except Exception as e:
+                # the version is committed, the other callbacks still run
+                print(f"store: commit callback failed: {e}")
+
+    def _fsync_directory(self):
+        try:
+            fd = os.open(self.path, os.O_RDONLY)
+        except OSError:
+            # directories can not be opened on every platform
+            return
+        try:
+            os.fsync(fd)
+        finally:
+            os.close(fd)
+
+    def stats(self) -> dict:
+        self.open()
+        return {
+            "resources": len(self.states),
+            "seq": self.seq,
+            "durable": self.durable,
+            "fsyncs": self.fsyncs,
+            "compactions": self.compactions,
+            "log_bytes": self.log.tell(),
+        }
+
+    def close(self):
+        """
+        Sync pending records and close the log
+        """
+        if self.log is None:
+            return
+        self.sync()
+        self.log.close()
+        # releases the lock
+        self.lock_file.close()
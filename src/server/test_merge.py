@@ -0,0 +1,233 @@
+"""
+Merge type tests
+Run with: python -m unittest test_merge (from src/server)
+"""
+
+import os
+import sys
+import json
+import itertools
+import unittest
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+from core import Patch, Version
+from merge import JSONDocument, MergeEngine, TextDocument, set_path
+
+
+def text_version(version: str, parents: list, *edits) -> Version:
+    return Version(
+        version=version,
+        parents=parents,
+        merge_type="text",
+        patches=[Patch(text, content_range=("text", range)) for range, text in edits],
+    )
+
+
+def json_version(version: str, parents: list, *writes) -> Version:
+    return Version(
+        version=version,
+        parents=parents,
+        merge_type="json",
+        patches=[
+            Patch(json.dumps(value), content_range=("json", path)) for path, value in writes
+        ],
+    )
+
+
+class TextConvergenceTest(unittest.TestCase):
+    def test_sequential_edits(self):
+        document = TextDocument("hello")
+        document.apply(text_version("a", [""], ("[5]", " world")))
+        document.apply(text_version("b", ["a"], ("[0:1]", "J")))
+        self.assertEqual(document.value, "Jello world")
+
+    def test_concurrent_versions_converge_in_any_order(self):
+        versions = [
+            text_version("a", [""], ("[0]", "A")),
+            text_version("b", [""], ("[5]", "B"), ("[1:3]", "")),
+            text_version("c", [""], ("[2:4]", "xy")),
+        ]
+        values = set()
+        for order in itertools.permutations(versions):
+            document = TextDocument("hello")
+            for version in order:
+                document.apply(version)
+            values.add(document.value)
+        self.assertEqual(len(values), 1, values)
+
+    def test_duplicate_version_is_ignored(self):
+        document = TextDocument("hello")
+        version = text_version("a", [""], ("[5]", "!"))
+        self.assertTrue(document.apply(version))
+        self.assertFalse(document.apply(version))
+        self.assertEqual(document.value, "hello!")
+
+
+class TextFailureTest(unittest.TestCase):
+    def test_failed_version_leaves_document_untouched(self):
+        document = TextDocument("hello")
+        bad = text_version("a", [""], ("[0:1]", "J"), ("[9]", "?"))
+        with self.assertRaises(ValueError):
+            document.apply(bad)
+        self.assertEqual(document.value, "hello")
+        self.assertNotIn("a", document.clocks)
+        self.assertEqual(document.heads, {""})
+
+    def test_retry_after_failure_applies_once(self):
+        document = TextDocument("hello")
+        with self.assertRaises(ValueError):
+            document.apply(text_version("a", [""], ("[5]", "!"), ("[7]", "?")))
+        document.apply(text_version("a", [""], ("[5]", "!"), ("[6]", "?")))
+        self.assertEqual(document.value, "hello!?")
+
+    def test_delete_past_the_end_is_undone(self):
+        document = TextDocument("hello")
+        document.apply(text_version("a", [""], ("[5]", " world")))
+        with self.assertRaises(ValueError):
+            document.apply(text_version("b", ["a"], ("[3:20]", "")))
+        self.assertEqual(document.value, "hello world")
+        self.assertEqual(len(document), 11)
+
+    def test_failed_concurrent_version_leaves_document_untouched(self):
+        document = TextDocument("hello")
+        document.apply(text_version("a", [""], ("[5]", " world")))
+        # made on top of "hello", so [7] is past the end of ">hello"
+        with self.assertRaises(ValueError):
+            document.apply(text_version("b", [""], ("[0]", ">"), ("[7]", "!")))
+        self.assertEqual(document.value, "hello world")
+        document.apply(text_version("b", [""], ("[0]", ">"), ("[6]", "!")))
+        self.assertEqual(document.value, ">hello! world")
+        self.assertEqual(document.heads, {"a", "b"})
+
+    def test_ranges_follow_earlier_patches_of_the_version(self):
+        document = TextDocument("ab")
+        # the second range is only valid after the first patch grew the text
+        document.apply(text_version("a", [""], ("[2]", "cd"), ("[3:4]", "D")))
+        self.assertEqual(document.value, "abcD")
+
+    def test_invalid_range_and_unit(self):
+        document = TextDocument("hello")
+        with self.assertRaises(ValueError):
+            document.apply(text_version("a", [""], ("[0]", "x"), ("[3:1]", "")))
+        with self.assertRaises(ValueError):
+            document.apply(
+                Version(
+                    version="b",
+                    parents=[""],
+                    merge_type="text",
+                    patches=[
+                        Patch("x", content_range=("text", "[0]")),
+                        Patch('"x"', content_range=("json", ".a")),
+                    ],
+                )
+            )
+        self.assertEqual(document.value, "hello")
+        self.assertEqual(set(document.clocks), {""})
+
+
+class JSONConvergenceTest(unittest.TestCase):
+    def test_concurrent_writes_converge_in_any_order(self):
+        initial = {"title": "t", "tags": []}
+        versions = [
+            json_version("a", None, (".title", "a"), (".tags[0]", 1)),
+            json_version("b", None, (".title", "b")),
+            json_version("c", None, (".body", "c"), (".tags", ["x"])),
+        ]
+        values = []
+        for order in itertools.permutations(versions):
+            document = JSONDocument(initial)
+            for version in order:
+                document.apply(version)
+            values.append(document.value)
+        for value in values:
+            self.assertEqual(value, values[0])
+        self.assertEqual(initial, {"title": "t", "tags": []})
+
+    def test_write_below_a_concurrent_replacement_in_any_order(self):
+        versions = [
+            json_version("v0", None, ("", 1)),
+            json_version("v1", None, ("", {"c": 2})),
+            # made on top of v0, where .l does not fit
+            json_version("v2", ["v0"], (".l", 1)),
+        ]
+        for order in itertools.permutations(versions):
+            document = JSONDocument({})
+            for version in order:
+                document.apply(version)
+            self.assertEqual(document.value, {"c": 2, "l": 1}, [v.version for v in order])
+
+    def test_write_that_does_not_fit_is_skipped_in_any_order(self):
+        versions = [
+            json_version("a", None, (".tags", [])),
+            json_version("b", None, (".tags[1]", "x"), (".title", "b")),
+        ]
+        for order in itertools.permutations(versions):
+            document = JSONDocument({"tags": ["t"]})
+            for version in order:
+                document.apply(version)
+            self.assertEqual(document.value, {"tags": [], "title": "b"})
+
+    def test_value_is_never_modified_in_place(self):
+        document = JSONDocument({"post": {"title": "t"}})
+        before = document.value
+        document.apply(json_version("a", None, (".post.title", "new")))
+        self.assertEqual(before, {"post": {"title": "t"}})
+        self.assertEqual(document.value, {"post": {"title": "new"}})
+
+
+class JSONFailureTest(unittest.TestCase):
+    def test_failed_version_leaves_document_untouched(self):
+        document = JSONDocument({"tags": ["a"]})
+        bad = json_version("a", None, (".title", "x"), ("tags", "b"))
+        with self.assertRaises(ValueError):
+            document.apply(bad)
+        self.assertEqual(document.value, {"tags": ["a"]})
+        self.assertEqual(document.writes, [])
+        self.assertNotIn("a", document.clocks)
+
+    def test_invalid_content_leaves_document_untouched(self):
+        document = JSONDocument({"title": "t"})
+        bad = Version(
+            version="a",
+            merge_type="json",
+            patches=[
+                Patch('"x"', content_range=("json", ".title")),
+                Patch("not json", content_range=("json", ".body")),
+            ],
+        )
+        with self.assertRaises(ValueError):
+            document.apply(bad)
+        self.assertEqual(document.value, {"title": "t"})
+
+    def test_engine_retry_after_failure(self):
+        engine = MergeEngine()
+        with self.assertRaises(ValueError):
+            engine.apply("/r", json_version("a", None, (".n", 1), (".l[", 2)), {"l": []})
+        document = engine.apply("/r", json_version("a", None, (".n", 1), (".l[0]", 2)))
+        self.assertEqual(document.value, {"l": [2], "n": 1})
+
+
+class SetPathTest(unittest.TestCase):
+    def test_copies_only_the_path(self):
+        document = {"a": {"b": [1, 2]}, "c": {"d": 1}}
+        value = set_path(document, ("a", "b", 2), 3)
+        self.assertEqual(value, {"a": {"b": [1, 2, 3]}, "c": {"d": 1}})
+        self.assertEqual(document, {"a": {"b": [1, 2]}, "c": {"d": 1}})
+        self.assertIs(value["c"], document["c"])
+
+    def test_creates_missing_containers(self):
+        self.assertEqual(set_path({}, ("a", 0), 1), {"a": [1]})
+        self.assertEqual(set_path({"a": "x"}, ("a", "b"), 1), {"a": {"b": 1}})
+
+    def test_missing_list_item(self):
+        with self.assertRaises(ValueError):
+            set_path({"a": []}, ("a", 1), 1)
+        with self.assertRaises(ValueError):
+            set_path({"a": []}, ("a", 0, "b"), 1)
+        with self.assertRaises(ValueError):
+            set_path([], ("a",), 1)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,171 @@
+"""
+Log store tests
+Run with: python -m unittest test_store (from src/server)
+"""
+
+import os
+import sys
+import shutil
+import tempfile
+import threading
+import unittest
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+from core import Patch, Version
+from store import LogStore, State
+
+
+def json_version(version: str, path: str, value: str) -> Version:
+    return Version(
+        version=version,
+        content_type="application/json",
+        patches=[Patch(value, content_range=("json", path))],
+    )
+
+
+class LogStoreTest(unittest.TestCase):
+    def setUp(self):
+        self.path = tempfile.mkdtemp()
+        self.stores = []
+
+    def tearDown(self):
+        for store in self.stores:
+            store.close()
+        shutil.rmtree(self.path)
+
+    def open(self, **kwargs) -> LogStore:
+        store = LogStore(self.path, initial={"/r": ("0", {})}, **kwargs)
+        self.stores.append(store)
+        return store
+
+    def reopen(self, store: LogStore, **kwargs) -> LogStore:
+        store.close()
+        self.stores.remove(store)
+        return self.open(**kwargs)
+
+    def log_path(self) -> str:
+        return os.path.join(self.path, LogStore.LOG)
+
+
+class RecoveryTest(LogStoreTest):
+    def test_replays_the_log(self):
+        store = self.open()
+        store.commit("/r", json_version("1", ".a", "1"))
+        store.commit("/r", json_version("2", ".b", "[1]"))
+        store.commit("/s", json_version("3", ".c", '"x"'))
+        store = self.reopen(store)
+        self.assertEqual(store.get("/r"), State("2", {"a": 1, "b": [1]}))
+        self.assertEqual(store.get("/s"), State("3", {"c": "x"}))
+        self.assertEqual(store.seq, 3)
+        store.commit("/r", json_version("4", ".a", "2"))
+        self.assertEqual(self.reopen(store).get("/r"), State("4", {"a": 2, "b": [1]}))
+
+    def test_failed_version_is_not_logged(self):
+        store = self.open()
+        store.commit("/r", json_version("1", ".a", "1"))
+        with self.assertRaises(ValueError):
+            store.commit("/r", json_version("2", ".a", "not json"))
+        self.assertEqual(store.get("/r"), State("1", {"a": 1}))
+        store = self.reopen(store)
+        self.assertEqual(store.get("/r"), State("1", {"a": 1}))
+        self.assertEqual(store.seq, 1)
+
+    def test_nothing_is_touched_before_first_use(self):
+        path = os.path.join(self.path, "store")
+        LogStore(path)
+        self.assertFalse(os.path.exists(path))
+
+    def test_directory_is_locked(self):
+        store = self.open()
+        store.get("/r")
+        with self.assertRaises(RuntimeError):
+            LogStore(self.path).get("/r")
+        store = self.reopen(store)
+        self.assertEqual(store.get("/r"), State("0", {}))
+
+
+class TornRecordTest(LogStoreTest):
+    def test_partial_record_is_truncated(self):
+        store = self.open()
+        store.commit("/r", json_version("1", ".a", "1"))
+        intact = os.path.getsize(self.log_path())
+        store.commit("/r", json_version("2", ".a", "2"))
+        store.close()
+        # the second record cut short by a crash
+        with open(self.log_path(), "r+b") as f:
+            f.truncate(os.path.getsize(self.log_path()) - 3)
+        store = self.reopen(store)
+        self.assertEqual(store.get("/r"), State("1", {"a": 1}))
+        self.assertEqual(os.path.getsize(self.log_path()), intact)
+        store.commit("/r", json_version("3", ".b", "3"))
+        store = self.reopen(store)
+        self.assertEqual(store.get("/r"), State("3", {"a": 1, "b": 3}))
+
+    def test_corrupt_record_ends_the_log(self):
+        store = self.open()
+        store.commit("/r", json_version("1", ".a", "1"))
+        store.commit("/r", json_version("2", ".a", "2"))
+        store.close()
+        with open(self.log_path(), "r+b") as f:
+            f.seek(-2, os.SEEK_END)
+            f.write(b"??")
+        store = self.reopen(store)
+        self.assertEqual(store.get("/r"), State("1", {"a": 1}))
+        self.assertEqual(store.seq, 1)
+
+
+class CompactionTest(LogStoreTest):
+    def test_snapshot_replaces_the_log(self):
+        store = self.open(max_log_bytes=512)
+        for i in range(1, 21):
+            store.commit("/r", json_version(str(i), f".k{i % 3}", str(i)))
+        self.assertGreater(store.compactions, 0)
+        self.assertTrue(os.path.exists(os.path.join(self.path, LogStore.SNAPSHOT)))
+        self.assertLessEqual(os.path.getsize(self.log_path()), 512)
+        expected = store.get("/r")
+        store = self.reopen(store)
+        self.assertEqual(store.get("/r"), expected)
+        self.assertEqual(store.seq, 20)
+
+    def test_interrupted_compaction_skips_snapshotted_records(self):
+        store = self.open()
+        store.commit("/r", json_version("1", ".a", "1"))
+        store.commit("/r", json_version("2", ".a", "2"))
+        with open(self.log_path(), "rb") as f:
+            log = f.read()
+        store.compact()
+        # crashed before the log was emptied
+        with open(self.log_path(), "wb") as f:
+            f.write(log)
+        store = self.reopen(store)
+        self.assertEqual(store.get("/r"), State("2", {"a": 2}))
+        self.assertEqual(store.seq, 2)
+
+
+class CommitOrderTest(LogStoreTest):
+    def test_callbacks_run_in_log_order(self):
+        store = self.open()
+        called = []
+        threads = [
+            threading.Thread(
+                target=store.commit,
+                args=("/r", json_version(str(i), ".n", str(i)), called.append),
+            )
+            for i in range(1, 41)
+        ]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        store.sync()
+        with open(self.log_path(), "rb") as f:
+            logged = [
+                Version.loads(data).version for _, _, data, _ in LogStore.records(f.read())
+            ]
+        self.assertEqual([state.version for state in called], logged)
+        self.assertEqual(len(logged), 40)
+
+
+if __name__ == "__main__":
+    unittest.main()